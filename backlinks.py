@@ -0,0 +1,57 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Persistent index of the notes referring to every note (backlinks).
+
+The index keeps, by note GUID, the GUIDs of the notes it refers to
+(in its content and in its parent, thumbnail and project attributes),
+and the WordPress ID and link it was last published with.
+The notes referring to a note are looked up in an inverted map, built
+when the index is loaded and kept up to date.
+
+When a note is published with a new ID or link, only the notes referring
+to it need to be republished, instead of a forced sync of all notes.
+"""
+
+import common
+
+class BacklinkIndex(common.JsonFileMap):
+    """Index of references between notes, saved to a JSON file
+    on every update.
+
+    :param path: Index file path.
+    """
+
+    def __init__(self, path):
+        super(BacklinkIndex, self).__init__(path)
+        # Referring note GUIDs by referenced note GUID
+        self._referrers = dict()
+        for guid, attrs in self._items.iteritems():
+            for ref_guid in attrs.get('refs', ()):
+                self._referrers.setdefault(ref_guid, set()).add(guid)
+
+    def referrers(self, guid):
+        """Return a sorted list of the GUIDs of notes referring to `guid`."""
+        with self._lock:
+            return sorted(self._referrers.get(guid, ()))
+
+    def set_refs(self, guid, ref_guids, save=True):
+        """Set the GUIDs of the notes that note `guid` refers to."""
+        ref_guids = sorted(set(ref_guids))
+        old_refs = self.get(guid).get('refs', [])
+        self.update(guid, {'refs': ref_guids}, save)
+        with self._lock:
+            for ref_guid in set(old_refs) - set(ref_guids):
+                self._referrers[ref_guid].discard(guid)
+            for ref_guid in ref_guids:
+                self._referrers.setdefault(ref_guid, set()).add(guid)
+
+    def set_published(self, guid, item_id, link, save=True):
+        """Record the ID and link note `guid` was published with,
+        and return whether they changed since it was last published
+        (a link that was not known yet, e.g. of a stub, did not change)."""
+        attrs = dict((name, value) for name, value
+                     in (('id', item_id), ('link', link)) if value is not None)
+        previous = self.get(guid)
+        self.update(guid, attrs, save)
+        return any(previous.get(name) not in (None, value)
+                   for name, value in attrs.iteritems())
@@ -0,0 +1,154 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Micro benchmark of slugifying post titles.
+
+Slugifies a generated corpus of multilingual titles (with character
+entity references, as titles of notes clipped from the web have) and
+reports the titles per second of the entity decoder (against the former
+decoder, a regular expression of all the entity names), of cold and
+memoized `slugify`, of `slugify_many`, and of reading auto slugs of
+WordPress items.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_slugify --json slugify.json
+    python -m benchmarks.bench_slugify --baseline slugify.json
+
+With `--baseline`, the exit status is non-zero if a case regressed
+beyond the tolerance.
+"""
+
+import re
+import sys
+import json
+import time
+import random
+import argparse
+from htmlentitydefs import name2codepoint
+
+import slugify
+from wordpress import WordPressAttribute
+
+# Title words by language
+WORDS = (
+    (u'the', u'quick', u'notes', u'on', u'Python', u'and', u'WordPress'),
+    (u'café', u'crème', u'brûlée', u'naïve', u'résumé', u'à', u'la'),
+    (u'Straße', u'über', u'Größe', u'schön', u'Mädchen', u'für'),
+    (u'привет', u'мир', u'заметки', u'о', u'программировании'),
+    (u'καλημέρα', u'κόσμε', u'σημειώσεις', u'Ελλάδα'),
+    (u'שלום', u'עולם', u'הערות'),
+    (u'你好', u'世界', u'笔记', u'编程'),
+    (u'こんにちは', u'世界', u'ノート'),
+    )
+
+# Character references, including an unknown entity name
+ENTITIES = (u'&amp;', u'&eacute;', u'&ndash;', u'&hellip;', u'&#39;',
+            u'&#x263a;', u'&nbsp;', u'&bogus;')
+
+def generate_titles(count, unique, seed=0):
+    """Return `count` titles, of `unique` distinct titles."""
+    rand = random.Random(seed)
+    distinct = list()
+    for _ in xrange(unique):
+        words = list()
+        for _ in xrange(rand.randint(3, 8)):
+            words.append(rand.choice(rand.choice(WORDS)))
+            if rand.random() < 0.2:
+                words.append(rand.choice(ENTITIES))
+        distinct.append(u' '.join(words))
+    return [distinct[index % unique] for index in xrange(count)]
+
+class TitledItem(object):
+    """Minimal WordPress item, with a title and an auto slug."""
+
+    def __init__(self, title):
+        self.title = title
+        self.slug = WordPressAttribute.create('slug', '<auto>', self)
+
+def legacy_decode(titles):
+    rexp = re.compile('&(%s);' % '|'.join(name2codepoint))
+    for title in titles:
+        rexp.sub(lambda m: unichr(name2codepoint[m.group(1)]), title)
+
+def decode(titles):
+    for title in titles:
+        slugify.CHAR_ENTITY_REXP.sub(slugify._decode_entity, title)
+
+def slugify_cold(titles):
+    slugify._slugs.clear()
+    for title in titles:
+        slugify.slugify(title)
+
+def slugify_warm(titles):
+    for title in titles:
+        slugify.slugify(title)
+
+def slugify_batch(titles):
+    slugify._slugs.clear()
+    slugify.slugify_many(titles)
+
+def slug_reads(items):
+    for item in items:
+        item.slug.fget()
+
+def best_seconds(func, arg, repeat):
+    times = list()
+    for _ in xrange(repeat):
+        start = time.time()
+        func(arg)
+        times.append(time.time() - start)
+    return min(times)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--titles', type=int, default=20000,
+                        help='Number of titles.')
+    parser.add_argument('--unique', type=int, default=2000,
+                        help='Number of distinct titles.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Corpus random seed.')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of runs of every case.')
+    parser.add_argument('--json', metavar='PATH',
+                        help='Write results as JSON to file.')
+    parser.add_argument('--baseline', metavar='PATH',
+                        help='Compare results with JSON results file.')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='Allowed relative regression against baseline '
+                        '(default: %(default)s).')
+    args = parser.parse_args(argv)
+    titles = generate_titles(args.titles, args.unique, args.seed)
+    items = [TitledItem(title) for title in titles]
+    cases = (
+        ('decode_legacy', legacy_decode, titles),
+        ('decode', decode, titles),
+        ('slugify_cold', slugify_cold, titles),
+        ('slugify_warm', slugify_warm, titles),
+        ('slugify_many', slugify_batch, titles),
+        ('slug_reads', slug_reads, items),
+        )
+    results = {'params': vars(args), 'cases': dict()}
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    failures = list()
+    print '%-16s %14s' % ('case', 'titles/s')
+    for name, func, arg in cases:
+        rate = len(arg) / max(best_seconds(func, arg, args.repeat), 1e-9)
+        results['cases'][name] = {'titles_per_second': rate}
+        status = ''
+        if baseline and name in baseline['cases']:
+            ratio = baseline['cases'][name]['titles_per_second'] / rate
+            status = ' (%+.0f%%)' % ((1 / ratio - 1) * 100)
+            if ratio > 1 + args.tolerance:
+                status += '  REGRESSION'
+                failures.append(name)
+        print '%-16s %14.0f%s' % (name, rate, status)
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2, sort_keys=True)
+    return failures and 1 or 0
+
+if '__main__' == __name__:
+    sys.exit(main())
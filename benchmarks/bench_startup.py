@@ -0,0 +1,121 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Startup time benchmark of the wordpress_evernote.py command line tool.
+
+Runs `--help` of the tool and of every subcommand in fresh interpreter
+processes, and reports the median and best wall time of each, and the
+heavy modules (API SDKs, lxml) loaded just by importing the tool.
+These should be loaded only by the commands that use them.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_startup --json startup.json
+    python -m benchmarks.bench_startup --baseline startup.json
+
+The exit status is non-zero if a heavy module is loaded at import,
+if a command is slower than `--max_seconds`, or (with `--baseline`)
+if a command regressed beyond the tolerance.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TOOL = os.path.join(REPO_DIR, 'wordpress_evernote.py')
+
+# Modules that only commands working with the APIs should load
+HEAVY_MODULES = (
+    'evernote.api.client',
+    'evernote.edam.notestore.NoteStore',
+    'evernote.edam.type.ttypes',
+    'wordpress_xmlrpc',
+    'lxml.etree',
+    )
+
+COMMANDS = (
+    ('--help',),
+    ('post-note', '--help'),
+    ('sync', '--help'),
+    ('detach', '--help'),
+    ('import-images', '--help'),
+    ('preprocess', '--help'),
+    ('plan', '--help'),
+    )
+
+def time_command(args, repeat):
+    """Return the sorted wall times of `repeat` runs of the tool."""
+    times = list()
+    with open(os.devnull, 'w') as devnull:
+        for _ in xrange(repeat):
+            start = time.time()
+            subprocess.check_call([sys.executable, TOOL] + list(args),
+                                  cwd=REPO_DIR, stdout=devnull)
+            times.append(time.time() - start)
+    return sorted(times)
+
+def loaded_heavy_modules():
+    """Return the heavy modules loaded by importing the tool,
+    in a fresh interpreter process."""
+    output = subprocess.check_output(
+        [sys.executable, '-c',
+         'import sys, wordpress_evernote; '
+         'print "\\n".join(name for name, module in sys.modules.items() '
+         'if module)'],
+        cwd=REPO_DIR)
+    modules = set(output.split())
+    return [name for name in HEAVY_MODULES if name in modules]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Number of runs of every command.')
+    parser.add_argument('--max_seconds', type=float, default=0.3,
+                        help='Maximal allowed median wall time of a command '
+                        '(default: %(default)s).')
+    parser.add_argument('--json', metavar='PATH',
+                        help='Write results as JSON to file.')
+    parser.add_argument('--baseline', metavar='PATH',
+                        help='Compare results with JSON results file.')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='Allowed relative regression against baseline '
+                        '(default: %(default)s).')
+    args = parser.parse_args(argv)
+    failures = list()
+    heavy = loaded_heavy_modules()
+    if heavy:
+        print 'Heavy modules loaded at import: %s' % (', '.join(heavy))
+        failures.append('import')
+    results = {'params': vars(args), 'heavy_modules': heavy,
+               'commands': dict()}
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    print '%-28s %9s %9s' % ('command', 'median(s)', 'best(s)')
+    for command in COMMANDS:
+        name = ' '.join(command)
+        times = time_command(command, args.repeat)
+        median = times[len(times) // 2]
+        results['commands'][name] = {'median': median, 'best': times[0]}
+        status = ''
+        if median > args.max_seconds:
+            status = '  TOO SLOW'
+            failures.append(name)
+        elif baseline and name in baseline['commands']:
+            ratio = median / baseline['commands'][name]['median']
+            status = ' (%+.0f%%)' % ((ratio - 1) * 100)
+            if ratio > 1 + args.tolerance:
+                status += '  REGRESSION'
+                failures.append(name)
+        print '%-28s %9.3f %9.3f%s' % (name, median, times[0], status)
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2, sort_keys=True)
+    return failures and 1 or 0
+
+if '__main__' == __name__:
+    sys.exit(main())
@@ -0,0 +1,249 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""End-to-end benchmark of the preprocess, sync and detach pipelines.
+
+Runs the pipelines over a generated note corpus, against in-process
+stand-ins for the Evernote and WordPress APIs, and reports throughput,
+API calls per note and CPU time per phase, and the peak memory of the run
+(the peak resident set size of a process is kept for its lifetime, so it
+can't be told per phase).
+
+Run from the repository root:
+
+    python -m benchmarks.bench_sync --posts 200 --json results.json
+    python -m benchmarks.bench_sync --posts 200 --baseline results.json
+
+With `--baseline`, the results are compared against a previous run,
+and the exit status is non-zero if any phase regressed beyond the
+tolerance.
+"""
+
+import sys
+import time
+import json
+import logging
+import argparse
+import resource
+
+import common
+import metrics
+from my_evernote import EvernoteApiWrapper
+from wordpress import WordPressApiWrapper
+from wordpress_evernote import EvernoteWordpressAdaptor
+
+from benchmarks import corpus as bench_corpus
+from benchmarks import stubs
+from benchmarks import servers as bench_servers
+
+PHASES = ('preprocess', 'sync', 'resync', 'detach')
+
+class ErrorCounter(logging.Handler):
+    """Logging handler counting error records (failed notes)."""
+
+    def __init__(self):
+        logging.Handler.__init__(self, logging.ERROR)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    """Return the peak resident set size in MB, over the lifetime of the
+    process (or of its terminated children)."""
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(who).ru_maxrss / 1024.0
+
+def run_phase(name, corpus, note_store, user_store, wp_site, args,
+              servers=None):
+    """Run a benchmark phase with fresh wrappers and caches,
+    and return its metrics dictionary.
+    
+    If `servers` are given as (Evernote server, WordPress server), the API
+    wrappers work with the servers over the network.
+    """
+    EvernoteApiWrapper._cache.clear()
+    if servers:
+        en_server, wp_server = servers
+        en_wrapper = EvernoteApiWrapper('bench-token',
+                                        service_host=en_server.url)
+        wp_wrapper = WordPressApiWrapper(wp_server.url, 'bench', 'bench')
+    else:
+        en_wrapper = stubs.FakeEvernoteApiWrapper(note_store, user_store)
+        wp_wrapper = stubs.FakeWordPressApiWrapper(wp_site,
+                                                   not args.no_marshal)
+    adaptor = EvernoteWordpressAdaptor(en_wrapper, wp_wrapper)
+    if 'preprocess' == name:
+        notes = corpus.count('embedded')
+        run = lambda: adaptor.preprocess('embedded',
+                                         bench_corpus.IMAGES_NOTEBOOK)
+    elif name in ('sync', 'resync'):
+        notes = corpus.count('post')
+        run = lambda: adaptor.sync('post', jobs=args.jobs)
+    elif 'detach' == name:
+        notes = corpus.count('post')
+        run = lambda: adaptor.detach('post')
+    en_calls = note_store.calls + user_store.calls
+    wp_calls = wp_site.calls.copy()
+    metrics.registry.reset()
+    errors = ErrorCounter()
+    common.logger.addHandler(errors)
+    start_wall, start_cpu = time.time(), time.clock()
+    try:
+        run()
+    finally:
+        common.logger.removeHandler(errors)
+    wall = time.time() - start_wall
+    cpu = time.clock() - start_cpu
+    en_calls = (note_store.calls + user_store.calls) - en_calls
+    wp_calls = wp_site.calls - wp_calls
+    api_calls = sum(en_calls.values()) + sum(wp_calls.values())
+    return {
+        'notes': notes,
+        'errors': errors.count,
+        'seconds': wall,
+        'cpu_seconds': cpu,
+        'notes_per_sec': notes / wall if wall else 0.0,
+        'api_calls': api_calls,
+        'api_calls_per_note': float(api_calls) / notes if notes else 0.0,
+        'evernote_calls': dict(en_calls),
+        'wordpress_calls': dict(wp_calls),
+        'wordpress_bytes': (getattr(wp_wrapper._wp, 'bytes_sent', 0) +
+                            getattr(wp_wrapper._wp, 'bytes_received', 0)),
+        'api_metrics': metrics.registry.snapshot(),
+        }
+
+def print_report(results):
+    print '%-10s %6s %6s %8s %8s %9s %10s' % (
+        'phase', 'notes', 'errors', 'wall(s)', 'cpu(s)', 'notes/s',
+        'calls/note')
+    for name in results['phase_order']:
+        m = results['phases'][name]
+        print '%-10s %6d %6d %8.2f %8.2f %9.1f %10.1f' % (
+            name, m['notes'], m['errors'], m['seconds'], m['cpu_seconds'],
+            m['notes_per_sec'], m['api_calls_per_note'])
+        calls = dict(m['evernote_calls'], **m['wordpress_calls'])
+        print '%10s %s' % ('', ', '.join('%s=%d' % (method, count) for
+                                         method, count in sorted(
+                                             calls.iteritems())))
+    print 'Peak RSS of the run: %.1f MB (parser processes: %.1f MB)' % (
+        results['peak_rss_mb'], results['children_peak_rss_mb'])
+
+def compare(results, baseline, tolerance):
+    """Print a comparison with baseline results, and return the list of
+    regressions found."""
+    regressions = list()
+    compared = [(name, results['phases'][name], baseline['phases'][name],
+                 (('notes_per_sec', True), ('api_calls_per_note', False)))
+                for name in results['phase_order']
+                if name in baseline['phases']]
+    compared.append(('run', results, baseline, (('peak_rss_mb', False),)))
+    for name, m, b, checked in compared:
+        for metric, higher_is_better in checked:
+            if not b.get(metric):
+                continue
+            ratio = m[metric] / b[metric]
+            regressed = (ratio < 1 - tolerance if higher_is_better
+                         else ratio > 1 + tolerance)
+            print '%-10s %-20s %10.2f -> %10.2f (%+.0f%%)%s' % (
+                name, metric, b[metric], m[metric], (ratio - 1) * 100,
+                regressed and '  REGRESSION' or '')
+            if regressed:
+                regressions.append((name, metric))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--posts', type=int, default=100,
+                        help='Number of post notes in the corpus.')
+    parser.add_argument('--paragraphs', type=int, default=20,
+                        help='Number of content paragraphs per post.')
+    parser.add_argument('--fanout', type=int, default=3,
+                        help='Number of links to other posts per post.')
+    parser.add_argument('--images', type=int, default=2,
+                        help='Number of linked image notes per post.')
+    parser.add_argument('--embedded', type=int, default=1,
+                        help='Number of embedded images per post.')
+    parser.add_argument('--image_size', type=int, default=20 * 1024,
+                        help='Size of every image in bytes.')
+    parser.add_argument('--projects', type=int, default=5,
+                        help='Number of project pages.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Corpus random seed.')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='Number of parser processes for sync.')
+    parser.add_argument('--phases', default=','.join(PHASES),
+                        help='Comma separated phases to run, in order '
+                        '(default: %(default)s).')
+    parser.add_argument('--no_marshal', action='store_true',
+                        help='Skip XML-RPC marshalling of WordPress calls.')
+    parser.add_argument('--network', action='store_true',
+                        help='Work with local stand-in servers over the '
+                        'network, instead of in-process stand-ins.')
+    parser.add_argument('--latency',
+                        help='Latency distribution of stand-in server calls '
+                        '(with --network, e.g. lognormal:0.05,0.5).')
+    parser.add_argument('--json', metavar='PATH',
+                        help='Write results as JSON to file.')
+    parser.add_argument('--baseline', metavar='PATH',
+                        help='Compare results with JSON results file.')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed relative regression against baseline '
+                        '(default: %(default)s).')
+    parser.add_argument('--verbose', action='store_true',
+                        help='Show tool log messages on the console.')
+    args = parser.parse_args(argv)
+    phases = [phase.strip() for phase in args.phases.split(',')]
+    for phase in phases:
+        if phase not in PHASES:
+            parser.error('Invalid phase "%s"' % (phase))
+    if not args.verbose:
+        for handler in common.logger.handlers:
+            if isinstance(handler, logging.StreamHandler) and \
+                    not isinstance(handler, logging.FileHandler):
+                handler.setLevel(logging.CRITICAL)
+
+    start = time.time()
+    corpus = bench_corpus.generate_corpus(
+        posts=args.posts, paragraphs=args.paragraphs, fanout=args.fanout,
+        images=args.images, embedded_images=args.embedded,
+        image_size=args.image_size, projects=args.projects, seed=args.seed)
+    print 'Generated %d notes (%.1f MB) in %.2f seconds' % (
+        len(corpus.notes), corpus.total_bytes / 1024.0 / 1024.0,
+        time.time() - start)
+    note_store = stubs.FakeNoteStore(corpus)
+    user_store = stubs.FakeUserStore()
+    wp_site = stubs.FakeWordPressSite()
+    servers = None
+    if args.network:
+        try:
+            en_server = bench_servers.EvernoteServer(
+                ('localhost', 0), note_store,
+                bench_servers.FaultInjector(args.latency, seed=args.seed))
+            wp_server = bench_servers.WordPressServer(
+                ('localhost', 0), wp_site,
+                bench_servers.FaultInjector(args.latency, seed=args.seed))
+        except ValueError, e:
+            parser.error(str(e))
+        user_store = en_server.user_store
+        servers = (bench_servers.start_in_thread(en_server),
+                   bench_servers.start_in_thread(wp_server))
+    results = {'params': vars(args), 'phases': dict(), 'phase_order': phases}
+    for phase in phases:
+        results['phases'][phase] = run_phase(phase, corpus, note_store,
+                                             user_store, wp_site, args,
+                                             servers)
+    results['peak_rss_mb'] = peak_rss_mb()
+    results['children_peak_rss_mb'] = peak_rss_mb(resource.RUSAGE_CHILDREN)
+    print_report(results)
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        if compare(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+if '__main__' == __name__:
+    sys.exit(main())
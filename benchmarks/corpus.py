@@ -0,0 +1,181 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Synthetic Evernote note corpus generator for benchmarks.
+
+Generates post, page and image notes in the same ENML shapes as the notes
+under `test-data/notes-content`, with configurable size, reference fan-out
+and number of (linked and embedded) images per post.
+"""
+
+import random
+import itertools
+import hashlib
+import binascii
+
+import evernote.edam.type.ttypes as Types
+
+USER_ID = 123
+SHARD_ID = 's123'
+POSTS_NOTEBOOK = 'Posts'
+IMAGES_NOTEBOOK = 'Images'
+
+# Just enough of a PNG file to be recognized as one
+PNG_HEADER = '\x89PNG\r\n\x1a\n'
+
+_WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do '
+          'eiusmod tempor incididunt ut labore et dolore magna aliqua ut '
+          'enim ad minim veniam quis nostrud exercitation ullamco laboris '
+          'nisi aliquip ex ea commodo consequat').split()
+
+def make_guid(kind, index):
+    """Return a deterministic, valid Evernote GUID for a corpus note."""
+    return '%08x-0000-4000-8000-%012x' % (kind, index)
+
+def note_url(guid):
+    """Return an evernote:/// note link URL for `guid`."""
+    return 'evernote:///view/{uid}/{sid}/{guid}/{guid}/'.format(
+        uid=USER_ID, sid=SHARD_ID, guid=guid)
+
+def note_link(guid, text):
+    return ('<a href="%s" style="color: rgb(105, 170, 53);">%s</a>' %
+            (note_url(guid), text))
+
+def note_content(metadata, content_divs):
+    """Return ENML note content from metadata lines and content divs."""
+    lines = [
+        '<?xml version="1.0" encoding="UTF-8" standalone="no"?>',
+        '<!DOCTYPE en-note SYSTEM "http://xml.evernote.com/pub/enml2.dtd">',
+        '<en-note style="word-wrap: break-word; -webkit-nbsp-mode: space; '
+        '-webkit-line-break: after-white-space;">',
+        ]
+    lines.extend('<div>%s</div>' % (line) for line in metadata)
+    lines.extend(['<div><br/></div>', '<div>', '<hr/></div>', '<br/>'])
+    lines.extend(content_divs)
+    lines.append('</en-note>')
+    return '\n'.join(lines)
+
+class Corpus(object):
+    """A generated set of notes.
+
+    `notes` is a list of (note, terms) tuples, where `terms` is the set of
+    search terms the note matches (its kind, e.g. "post", "image", "page",
+    and "embedded" for posts with embedded images).
+    `notebooks` maps notebook names to notebook GUIDs.
+    """
+
+    def __init__(self):
+        self.notes = list()
+        self.notebooks = {POSTS_NOTEBOOK: make_guid(0xb00c, 1),
+                          IMAGES_NOTEBOOK: make_guid(0xb00c, 2)}
+
+    def add(self, note, *terms):
+        self.notes.append((note, set(terms)))
+
+    def count(self, term):
+        """Return the number of notes matching search `term`."""
+        return sum(1 for _, terms in self.notes if term in terms)
+
+    @property
+    def total_bytes(self):
+        """Total size of note contents and resources."""
+        return sum(len(note.content) +
+                   sum(res.data.size for res in note.resources or [])
+                   for note, _ in self.notes)
+
+def generate_corpus(posts=100, paragraphs=20, paragraph_words=60, fanout=3,
+                    images=2, embedded_images=1, image_size=20 * 1024,
+                    projects=5, seed=0):
+    """Return a generated Corpus.
+
+    :param posts: Number of post notes.
+    :param paragraphs: Number of content paragraphs per post.
+    :param paragraph_words: Number of words per paragraph.
+    :param fanout: Number of links from every post to other posts.
+    :param images: Number of linked image notes per post.
+    :param embedded_images: Number of images embedded in every post,
+                            to be extracted by preprocessing.
+    :param image_size: Size (bytes) of every image.
+    :param projects: Number of project index pages posts belong to.
+    :param seed: Random seed, for reproducible corpora.
+    """
+    rand = random.Random(seed)
+    corpus = Corpus()
+    resource_ids = itertools.count()
+    posts_nb = corpus.notebooks[POSTS_NOTEBOOK]
+    images_nb = corpus.notebooks[IMAGES_NOTEBOOK]
+
+    def text(words):
+        return ' '.join(rand.choice(_WORDS) for _ in xrange(words))
+    def resource(name):
+        body = PNG_HEADER + ''.join(chr(rand.getrandbits(8)) for _
+                                    in xrange(image_size - len(PNG_HEADER)))
+        return Types.Resource(
+            guid=make_guid(0xda7a, next(resource_ids)),
+            mime='image/png',
+            data=Types.Data(body=body, size=len(body),
+                            bodyHash=hashlib.md5(body).digest()),
+            attributes=Types.ResourceAttributes(fileName=name))
+    def media_tag(res):
+        return ('<en-media style="height: auto;" type="%s" hash="%s"/>' %
+                (res.mime, binascii.hexlify(res.data.bodyHash)))
+    def add_note(guid, title, content, notebook, resources, *terms):
+        corpus.add(Types.Note(guid=guid, title=title, content=content,
+                              notebookGuid=notebook, resources=resources,
+                              created=0, updated=0), *terms)
+
+    post_guids = [make_guid(0x9057, i) for i in xrange(posts)]
+    project_guids = [make_guid(0x9a6e, i) for i in xrange(projects)]
+    for i, guid in enumerate(project_guids):
+        title = 'Project %d' % (i)
+        add_note(guid, title,
+                 note_content(['id=&lt;auto&gt;', 'type=page',
+                               'content_format=markdown', 'title=' + title,
+                               'slug=&lt;auto&gt;', 'thumbnail=',
+                               'link=&lt;auto&gt;'],
+                              ['<div>%s.</div>' % (text(paragraph_words))]),
+                 posts_nb, None, 'page')
+    for i, guid in enumerate(post_guids):
+        title = 'Post %d %s' % (i, text(3))
+        image_guids = [make_guid(0x1111, i * images + j)
+                       for j in xrange(images)]
+        for j, image_guid in enumerate(image_guids):
+            image_title = 'Image %d of post %d' % (j, i)
+            res = resource('image-%d-%d.png' % (i, j))
+            add_note(image_guid, res.attributes.fileName,
+                     note_content(['id=&lt;auto&gt;', 'title=' + image_title,
+                                   'link=&lt;auto&gt;',
+                                   'parent=' + note_link(guid, title),
+                                   'caption=' + text(5),
+                                   'description=' + text(8)],
+                                  [media_tag(res)]),
+                     images_nb, [res], 'image')
+        metadata = ['id=&lt;auto&gt;', 'type=post', 'content_format=markdown',
+                    'title=' + title, 'slug=&lt;auto&gt;',
+                    'categories=Bench', 'tags=bench,"Synthetic, Tag"']
+        if image_guids:
+            metadata.append('thumbnail=' +
+                            note_link(image_guids[0], 'thumbnail'))
+        if project_guids:
+            metadata.append('project=' + note_link(
+                rand.choice(project_guids), 'Project index'))
+        metadata.extend(['link=&lt;auto&gt;', 'last_modified=&lt;auto&gt;'])
+        others = [g for g in post_guids if g != guid]
+        refs = [note_link(g, 'related post') for g
+                in rand.sample(others, min(fanout, len(others)))]
+        refs.extend(note_link(g, 'image') for g in image_guids)
+        embedded = [resource('embedded-%d-%d.png' % (i, j))
+                    for j in xrange(embedded_images)]
+        refs.extend('![%s](%s &quot;%s&quot;)' %
+                    (text(6), media_tag(res), text(3)) for res in embedded)
+        content_divs = list()
+        for p in xrange(paragraphs):
+            content_divs.append('<div>%s.<br/></div>' % (text(paragraph_words)))
+            content_divs.append('<div><br/></div>')
+        # Spread references evenly across the content
+        step = max(1, len(content_divs) // (len(refs) + 1))
+        for pos, ref in reversed(list(enumerate(refs, 1))):
+            content_divs.insert(pos * step, '<div>%s<br/></div>' % (ref))
+        terms = ['post'] + (embedded and ['embedded'] or [])
+        add_note(guid, title, note_content(metadata, content_divs), posts_nb,
+                 embedded, *terms)
+    return corpus
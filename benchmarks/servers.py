@@ -0,0 +1,339 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Local stand-in Evernote and WordPress servers for load testing.
+
+Serves the fake services of `benchmarks.stubs` over the wire:
+- Evernote UserStore and NoteStore over Thrift/HTTP
+  (at /edam/user and /edam/note/<shard>).
+- WordPress XML-RPC API, including system.multicall (at /xmlrpc.php).
+
+Both servers can inject latency (sampled from a distribution, optionally
+per API method), rate limiting and transient failures.
+Rate limiting is a fixed window quota of calls, reported as an Evernote
+RATE_LIMIT_REACHED error, or as an HTTP 429 response by WordPress.
+Transient failures are HTTP 503 responses.
+
+To point the tool at the servers, in local_settings.py:
+
+    EVERNOTE_SERVICE_HOST = 'http://localhost:8880'
+    WORDPRESS = {
+        'local': WordPressCredentials('http://localhost:8881/xmlrpc.php',
+                                      'bench', 'bench'),
+        'default': 'local',
+        }
+
+Latency distributions are specified as "<name>:<params>", in seconds:
+"fixed:0.05", "uniform:0.01,0.1", "normal:0.05,0.01",
+"lognormal:0.05,0.5" (median, sigma) or "exponential:0.05" (mean).
+"""
+
+import sys
+import time
+import random
+import argparse
+import threading
+import SocketServer
+import BaseHTTPServer
+from SimpleXMLRPCServer import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+
+from thrift.transport import TTransport
+from thrift.protocol import TBinaryProtocol
+import evernote.edam.error.ttypes as Errors
+import evernote.edam.userstore.UserStore as UserStore
+import evernote.edam.notestore.NoteStore as NoteStore
+
+import common
+
+from benchmarks import corpus as bench_corpus
+from benchmarks import stubs
+
+logger = common.logger.getChild('bench-servers')
+
+def parse_latency(spec):
+    """Return a function sampling latencies (seconds) from a
+    distribution specification string (see module docs)."""
+    if not spec:
+        return lambda rand: 0.0
+    name, _, params = spec.partition(':')
+    try:
+        params = [float(param) for param in params.split(',') if param]
+    except ValueError:
+        raise ValueError('Invalid latency specification "%s"' % (spec))
+    distributions = {
+        'fixed': (1, lambda rand, value: value),
+        'uniform': (2, lambda rand, low, high: rand.uniform(low, high)),
+        'normal': (2, lambda rand, mu, sigma: rand.normalvariate(mu, sigma)),
+        'lognormal': (2, lambda rand, median, sigma:
+                      median * rand.lognormvariate(0.0, sigma)),
+        'exponential': (1, lambda rand, mean: rand.expovariate(1.0 / mean)),
+        }
+    if name not in distributions or len(params) != distributions[name][0]:
+        raise ValueError('Invalid latency specification "%s"' % (spec))
+    sample = distributions[name][1]
+    return lambda rand: max(0.0, sample(rand, *params))
+
+class FaultInjector(object):
+    """Injects latency, rate limiting and transient failures into calls.
+
+    :param latency: Latency distribution specification for all methods.
+    :param method_latency: Dictionary of latency distribution
+                           specifications by method name, overriding
+                           `latency` for these methods.
+    :param rate_limit: Maximal number of calls per `rate_limit_period`
+                       seconds, or None for no rate limit.
+    :param rate_limit_period: Rate limit window length in seconds.
+    :param failure_rate: Probability of a call failing transiently.
+    :param seed: Random seed for latencies and failures.
+    """
+
+    def __init__(self, latency=None, method_latency=None, rate_limit=None,
+                 rate_limit_period=60, failure_rate=0.0, seed=None):
+        self._latency = parse_latency(latency)
+        self._method_latency = dict(
+            (method, parse_latency(spec))
+            for method, spec in (method_latency or {}).iteritems())
+        self.rate_limit = rate_limit
+        self.rate_limit_period = rate_limit_period
+        self.failure_rate = failure_rate
+        self._rand = random.Random(seed)
+        self._lock = threading.Lock()
+        self._window_start = time.time()
+        self._window_calls = 0
+        self.rate_limited_calls = 0
+        self.failed_calls = 0
+
+    def delay(self, method):
+        """Sleep for a latency sampled for `method`."""
+        with self._lock:
+            latency = self._method_latency.get(method,
+                                               self._latency)(self._rand)
+        if latency:
+            time.sleep(latency)
+
+    def rate_limit_wait(self):
+        """Count a call, and return the number of seconds until the rate
+        limit resets if the call exceeds the rate limit, or 0 otherwise."""
+        if not self.rate_limit:
+            return 0
+        with self._lock:
+            now = time.time()
+            if now - self._window_start >= self.rate_limit_period:
+                self._window_start, self._window_calls = now, 0
+            self._window_calls += 1
+            if self._window_calls <= self.rate_limit:
+                return 0
+            self.rate_limited_calls += 1
+            return int(self._window_start + self.rate_limit_period - now) + 1
+
+    def transient_failure(self):
+        """Return True if the current call should fail transiently."""
+        with self._lock:
+            if self.failure_rate and self._rand.random() < self.failure_rate:
+                self.failed_calls += 1
+                return True
+        return False
+
+class FaultInjectingHandler(object):
+    """Thrift service handler proxy, injecting latency and rate limiting
+    into the calls to a fake Evernote service."""
+
+    def __init__(self, service, injector):
+        self._service = service
+        self._injector = injector
+
+    def __getattr__(self, name):
+        method = getattr(self._service, name)
+        def call(*args):
+            self._injector.delay(name)
+            wait = self._injector.rate_limit_wait()
+            if wait:
+                raise Errors.EDAMSystemException(
+                    errorCode=Errors.EDAMErrorCode.RATE_LIMIT_REACHED,
+                    rateLimitDuration=wait)
+            return method(*args)
+        return call
+
+class ThriftRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves Thrift binary protocol calls over HTTP POST, dispatching
+    to the server processors by request path."""
+
+    # Keep the connections of HTTP/1.1 clients open between calls
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        processor = self.server.processors.get(self.path.rstrip('/'))
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if processor is None:
+            self.send_error(404)
+            return
+        if self.server.injector.transient_failure():
+            self.send_error(503)
+            return
+        out_buffer = TTransport.TMemoryBuffer()
+        processor.process(
+            TBinaryProtocol.TBinaryProtocol(TTransport.TMemoryBuffer(body)),
+            TBinaryProtocol.TBinaryProtocol(out_buffer))
+        response = out_buffer.getvalue()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-thrift')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        logger.debug('Evernote server: ' + format, *args)
+
+class EvernoteServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Stand-in Evernote service, serving fake UserStore and NoteStore."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, note_store, injector=None):
+        BaseHTTPServer.HTTPServer.__init__(self, address,
+                                           ThriftRequestHandler)
+        self.injector = injector or FaultInjector()
+        self.note_store_path = '/edam/note/%s' % (bench_corpus.SHARD_ID)
+        self.user_store = stubs.FakeUserStore(
+            '%s%s' % (self.url, self.note_store_path))
+        self.note_store = note_store
+        self.services = [self.user_store, note_store]
+        self.processors = {
+            '/edam/user': UserStore.Processor(
+                FaultInjectingHandler(self.user_store, self.injector)),
+            self.note_store_path: NoteStore.Processor(
+                FaultInjectingHandler(note_store, self.injector)),
+            }
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address[:2]
+
+class FaultInjectingSite(object):
+    """XML-RPC server instance, injecting latency into the calls to
+    a fake WordPress site."""
+
+    def __init__(self, site, injector):
+        self._site = site
+        self._injector = injector
+
+    def _dispatch(self, method, params):
+        self._injector.delay(method)
+        return self._site._dispatch(method, params)
+
+class WordPressRequestHandler(SimpleXMLRPCRequestHandler):
+    """XML-RPC request handler, injecting rate limiting and transient
+    failures as HTTP errors."""
+
+    rpc_paths = ('/xmlrpc.php', '/')
+
+    def do_POST(self):
+        injector = self.server.injector
+        wait = injector.rate_limit_wait()
+        if wait or injector.transient_failure():
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            self.send_response(wait and 429 or 503)
+            if wait:
+                self.send_header('Retry-After', str(wait))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        SimpleXMLRPCRequestHandler.do_POST(self)
+
+    def log_message(self, format, *args):
+        logger.debug('WordPress server: ' + format, *args)
+
+class WordPressServer(SocketServer.ThreadingMixIn, SimpleXMLRPCServer):
+    """Stand-in WordPress XML-RPC service, serving a fake site."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, site, injector=None):
+        SimpleXMLRPCServer.__init__(self, address, WordPressRequestHandler,
+                                    logRequests=False, allow_none=True)
+        self.injector = injector or FaultInjector()
+        self.site = site
+        self.services = [site]
+        self.register_instance(FaultInjectingSite(site, self.injector))
+
+    @property
+    def url(self):
+        return 'http://%s:%d/xmlrpc.php' % self.server_address[:2]
+
+def start_in_thread(server):
+    """Serve requests in a daemon thread, and return the server."""
+    thread = threading.Thread(target=server.serve_forever,
+                              name=server.__class__.__name__)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', default='localhost',
+                        help='Host name or address to listen on.')
+    parser.add_argument('--evernote_port', type=int, default=8880,
+                        help='Evernote server port.')
+    parser.add_argument('--wordpress_port', type=int, default=8881,
+                        help='WordPress server port.')
+    parser.add_argument('--posts', type=int, default=100,
+                        help='Number of post notes in the generated corpus.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Corpus and fault injection random seed.')
+    parser.add_argument('--latency',
+                        help='Latency distribution for all API methods.')
+    parser.add_argument('--method_latency', action='append', default=[],
+                        metavar='METHOD=SPEC',
+                        help='Latency distribution for an API method '
+                        '(e.g. getNote=fixed:0.2). May be repeated.')
+    parser.add_argument('--rate_limit', type=int,
+                        help='Maximal API calls per rate limit period, '
+                        'for each of the servers.')
+    parser.add_argument('--rate_limit_period', type=int, default=60,
+                        help='Rate limit period in seconds.')
+    parser.add_argument('--failure_rate', type=float, default=0.0,
+                        help='Probability of transient call failure.')
+    args = parser.parse_args(argv)
+    try:
+        method_latency = dict(spec.split('=', 1)
+                              for spec in args.method_latency)
+        def make_injector():
+            return FaultInjector(args.latency, method_latency,
+                                 args.rate_limit, args.rate_limit_period,
+                                 args.failure_rate, args.seed)
+        evernote_injector, wordpress_injector = (make_injector(),
+                                                 make_injector())
+    except ValueError, e:
+        parser.error(str(e))
+    corpus = bench_corpus.generate_corpus(posts=args.posts, seed=args.seed)
+    evernote = start_in_thread(EvernoteServer(
+        (args.host, args.evernote_port), stubs.FakeNoteStore(corpus),
+        evernote_injector))
+    wordpress = start_in_thread(WordPressServer(
+        (args.host, args.wordpress_port), stubs.FakeWordPressSite(),
+        wordpress_injector))
+    print 'Serving %d notes. Settings for local_settings.py:' % (
+        len(corpus.notes))
+    print
+    print "EVERNOTE_SERVICE_HOST = '%s'" % (evernote.url)
+    print "WORDPRESS = {"
+    print "    'local': WordPressCredentials('%s', 'bench', 'bench')," % (
+        wordpress.url)
+    print "    'default': 'local',"
+    print "    }"
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    for server in (evernote, wordpress):
+        server.shutdown()
+        print '%s served %d calls (%d rate limited, %d failed)' % (
+            server.__class__.__name__,
+            sum(service.total_calls for service in server.services),
+            server.injector.rate_limited_calls, server.injector.failed_calls)
+    return 0
+
+if '__main__' == __name__:
+    sys.exit(main())
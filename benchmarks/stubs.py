@@ -0,0 +1,428 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""In-process stand-ins for the Evernote and WordPress APIs.
+
+The fake services keep their state in memory, count the API calls they
+serve, and plug into the API wrappers through the same client
+initialization hooks the unit tests mock.
+"""
+
+import copy
+import time
+import itertools
+import threading
+import datetime
+from collections import Counter
+
+import evernote.edam.type.ttypes as Types
+import evernote.edam.error.ttypes as Errors
+from evernote.edam.notestore import NoteStore
+from wordpress_xmlrpc import Client
+from wordpress_xmlrpc.compat import xmlrpc_client
+
+from my_evernote import EvernoteApiWrapper
+from wordpress import WordPressApiWrapper
+
+from benchmarks import corpus as bench_corpus
+
+def _now_ms():
+    return int(time.time() * 1000)
+
+def _utf8(s):
+    if isinstance(s, unicode):
+        return s.encode('utf-8')
+    return s
+
+def _largest_resource(note, field):
+    """Return `field` ('mime' or 'size') of the largest note resource."""
+    if not note.resources:
+        return None
+    largest = max(note.resources, key=lambda res: res.data.size)
+    return largest.mime if 'mime' == field else largest.data.size
+
+def api_method(func):
+    """Decorate a fake service API method to count and serialize calls."""
+    def method(self, *args, **kwargs):
+        with self._lock:
+            self.calls[func.__name__] += 1
+            return func(self, *args, **kwargs)
+    method.__name__ = func.__name__
+    method.__doc__ = func.__doc__
+    return method
+
+class FakeService(object):
+    """Base class for fake API services."""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        # Number of calls served, by method name
+        self.calls = Counter()
+
+    @property
+    def total_calls(self):
+        return sum(self.calls.itervalues())
+
+class FakeNoteStore(FakeService):
+    """Fake Evernote NoteStore service over a benchmark corpus.
+
+    Search queries are matched against the corpus note search terms:
+    a note matches a query if it has all the query words as terms.
+    """
+
+    def __init__(self, corpus):
+        super(FakeNoteStore, self).__init__()
+        self.notebooks = [Types.Notebook(guid=guid, name=name)
+                          for name, guid in corpus.notebooks.iteritems()]
+        self._default_notebook = corpus.notebooks[bench_corpus.POSTS_NOTEBOOK]
+        self.update_count = 0
+        self._notes = dict()
+        self._order = list()
+        self._terms = dict()
+        self._resource_data = dict()
+        self._new_ids = itertools.count()
+        for note, terms in corpus.notes:
+            self._store(copy.deepcopy(note), terms)
+
+    def _store(self, note, terms=None):
+        note.title = _utf8(note.title)
+        note.content = _utf8(note.content)
+        self.update_count += 1
+        note.updateSequenceNum = self.update_count
+        for res in note.resources or []:
+            if res.guid is None:
+                res.guid = bench_corpus.make_guid(0xda7a0000,
+                                                  next(self._new_ids))
+            res.noteGuid = note.guid
+            if res.data.body is not None:
+                self._resource_data[res.guid] = res.data.body
+        if note.guid not in self._notes:
+            self._order.append(note.guid)
+            self._terms[note.guid] = set(terms or [])
+        self._notes[note.guid] = note
+
+    def _get(self, guid):
+        if guid not in self._notes:
+            raise Errors.EDAMNotFoundException(identifier='Note.guid',
+                                               key=guid)
+        return self._notes[guid]
+
+    def _matches(self, guid, note_filter):
+        note = self._notes[guid]
+        if note_filter.notebookGuid and \
+                note.notebookGuid != note_filter.notebookGuid:
+            return False
+        words = (note_filter.words or '').split()
+        return self._terms[guid].issuperset(words)
+
+    @api_method
+    def findNotesMetadata(self, authenticationToken, filter, offset,
+                          maxNotes, resultSpec):
+        matches = [guid for guid in self._order
+                   if self._matches(guid, filter)]
+        notes = list()
+        for guid in matches[offset:offset + maxNotes]:
+            note = self._notes[guid]
+            notes.append(NoteStore.NoteMetadata(
+                guid=guid,
+                title=resultSpec.includeTitle and note.title or None,
+                updated=resultSpec.includeUpdated and note.updated or None,
+                updateSequenceNum=(resultSpec.includeUpdateSequenceNum and
+                                   note.updateSequenceNum or None),
+                contentLength=(resultSpec.includeContentLength and
+                               len(note.content) or None),
+                largestResourceMime=(resultSpec.includeLargestResourceMime
+                                     and _largest_resource(note, 'mime')
+                                     or None),
+                largestResourceSize=(resultSpec.includeLargestResourceSize
+                                     and _largest_resource(note, 'size')
+                                     or None),
+                notebookGuid=note.notebookGuid))
+        return NoteStore.NotesMetadataList(startIndex=offset,
+                                           totalNotes=len(matches),
+                                           notes=notes,
+                                           updateCount=self.update_count)
+
+    @api_method
+    def getNote(self, authenticationToken, guid, withContent,
+                withResourcesData, withResourcesRecognition,
+                withResourcesAlternateData):
+        note = copy.deepcopy(self._get(guid))
+        if not withContent:
+            note.content = None
+        for res in note.resources or []:
+            if not withResourcesData:
+                res.data.body = None
+        return note
+
+    @api_method
+    def getResourceData(self, authenticationToken, guid):
+        if guid not in self._resource_data:
+            raise Errors.EDAMNotFoundException(identifier='Resource.guid',
+                                               key=guid)
+        return self._resource_data[guid]
+
+    @api_method
+    def createNote(self, authenticationToken, note):
+        note = copy.deepcopy(note)
+        note.guid = bench_corpus.make_guid(0xc4ea7ed, next(self._new_ids))
+        note.notebookGuid = note.notebookGuid or self._default_notebook
+        note.created = note.updated = _now_ms()
+        self._store(note, ['created'])
+        return copy.deepcopy(note)
+
+    @api_method
+    def updateNote(self, authenticationToken, note):
+        stored = self._get(note.guid)
+        stored.title = note.title or stored.title
+        stored.content = note.content or stored.content
+        if note.resources is not None:
+            stored.resources = copy.deepcopy(note.resources)
+        stored.updated = _now_ms()
+        self._store(stored)
+        return copy.deepcopy(stored)
+
+    @api_method
+    def listNotebooks(self, authenticationToken=None):
+        return copy.deepcopy(self.notebooks)
+
+    @api_method
+    def getSyncState(self, authenticationToken):
+        return NoteStore.SyncState(currentTime=_now_ms(), fullSyncBefore=0,
+                                   updateCount=self.update_count)
+
+    @api_method
+    def getSyncStateWithMetrics(self, authenticationToken, clientMetrics):
+        return NoteStore.SyncState(currentTime=_now_ms(), fullSyncBefore=0,
+                                   updateCount=self.update_count)
+
+class FakeUserStore(FakeService):
+    """Fake Evernote UserStore service.
+
+    :param note_store_url: The NoteStore URL returned to clients.
+    """
+
+    def __init__(self, note_store_url=None):
+        super(FakeUserStore, self).__init__()
+        self.note_store_url = note_store_url
+
+    @api_method
+    def checkVersion(self, clientName, edamVersionMajor, edamVersionMinor):
+        return True
+
+    @api_method
+    def getNoteStoreUrl(self, authenticationToken):
+        return self.note_store_url
+
+    @api_method
+    def getUser(self, authenticationToken):
+        return Types.User(id=bench_corpus.USER_ID,
+                          shardId=bench_corpus.SHARD_ID,
+                          username='bench')
+
+class FakeEvernoteClient(object):
+    """Stand-in for `EvernoteClient`, with fake stores."""
+
+    def __init__(self, token, note_store, user_store):
+        self.token = token
+        self._note_store = note_store
+        self._user_store = user_store
+
+    def get_note_store(self):
+        return self._note_store
+
+    def get_user_store(self):
+        return self._user_store
+
+class FakeEvernoteApiWrapper(EvernoteApiWrapper):
+    """Evernote API wrapper working with fake stores."""
+
+    def __init__(self, note_store, user_store, token='bench-token'):
+        self._fake_stores = (note_store, user_store)
+        EvernoteApiWrapper.__init__(self, token)
+
+    def _init_en_client(self, token, sandbox):
+        note_store, user_store = self._fake_stores
+        self._client = FakeEvernoteClient(token, note_store, user_store)
+        self._note_store = self._client.get_note_store()
+
+class FakeWordPressSite(FakeService):
+    """Fake WordPress XML-RPC service.
+
+    Methods take and return XML-RPC structs, as the real service does.
+    Posts, pages and media attachments share a single ID space.
+    """
+
+    site_url = 'http://wordpress.bench'
+
+    def __init__(self):
+        super(FakeWordPressSite, self).__init__()
+        self.posts = dict()
+        self.terms = dict()
+        self._ids = itertools.count(1)
+        self._methods = {
+            'mt.supportedMethods': self.supportedMethods,
+            'system.multicall': self.multicall,
+            'wp.newPost': self.newPost,
+            'wp.getPost': self.getPost,
+            'wp.editPost': self.editPost,
+            'wp.getPosts': self.getPosts,
+            'wp.uploadFile': self.uploadFile,
+            'wp.getMediaLibrary': self.getMediaLibrary,
+            }
+
+    def _dispatch(self, method, params):
+        """Invoke XML-RPC `method` with `params`."""
+        if method not in self._methods:
+            raise xmlrpc_client.Fault(-32601, 'Unsupported method %s' %
+                                      (method))
+        return self._methods[method](*params)
+
+    def _get(self, post_id):
+        post_id = int(post_id)
+        if post_id not in self.posts:
+            raise xmlrpc_client.Fault(404, 'Invalid post ID.')
+        return self.posts[post_id]
+
+    def _update(self, post, struct):
+        """Update `post` from request `struct`, resolving term names."""
+        struct = dict((key, val) for key, val in struct.iteritems()
+                      if val is not None and key != 'terms')
+        terms_names = struct.pop('terms_names', None)
+        post.update(struct)
+        if terms_names:
+            post['terms'] = list()
+            for taxonomy, names in terms_names.iteritems():
+                for name in names:
+                    key = (taxonomy, name)
+                    if key not in self.terms:
+                        self.terms[key] = {'term_id': str(len(self.terms) + 1),
+                                           'taxonomy': taxonomy,
+                                           'name': name, 'slug': name}
+                    post['terms'].append(self.terms[key])
+
+    def _new(self, struct):
+        post_id = next(self._ids)
+        now = xmlrpc_client.DateTime(datetime.datetime.utcnow())
+        post = {'post_type': 'post', 'post_status': 'draft',
+                'post_title': '', 'post_content': '',
+                'post_date_gmt': now, 'post_modified_gmt': now,
+                'link': '%s/?p=%d' % (self.site_url, post_id),
+                'custom_fields': list(), 'terms': list()}
+        self._update(post, struct)
+        post['post_id'] = str(post_id)
+        self.posts[post_id] = post
+        return post
+
+    def supportedMethods(self):
+        return sorted(self._methods)
+
+    @api_method
+    def multicall(self, calls):
+        """Invoke several methods in one call, returning a list of
+        single-item lists with results, or fault structs."""
+        results = list()
+        for call in calls:
+            try:
+                results.append([self._dispatch(call['methodName'],
+                                               call['params'])])
+            except xmlrpc_client.Fault, e:
+                results.append({'faultCode': e.faultCode,
+                                'faultString': e.faultString})
+        return results
+
+    @api_method
+    def newPost(self, blog_id, username, password, content):
+        return self._new(content)['post_id']
+
+    @api_method
+    def getPost(self, blog_id, username, password, post_id, fields=None):
+        return copy.deepcopy(self._get(post_id))
+
+    @api_method
+    def editPost(self, blog_id, username, password, post_id, content):
+        post = self._get(post_id)
+        self._update(post, content)
+        post['post_id'] = str(post_id)
+        post['post_modified_gmt'] = xmlrpc_client.DateTime(
+            datetime.datetime.utcnow())
+        return True
+
+    @api_method
+    def getPosts(self, blog_id, username, password, filter=None):
+        post_type = (filter or {}).get('post_type', 'post')
+        return [copy.deepcopy(post) for _, post in sorted(self.posts.items())
+                if post['post_type'] == post_type]
+
+    @api_method
+    def uploadFile(self, blog_id, username, password, data):
+        url = '%s/uploads/%s' % (self.site_url, data['name'])
+        post = self._new({'post_type': 'attachment', 'post_status': 'inherit',
+                          'post_title': data['name'], 'link': url,
+                          'post_mime_type': data['type'],
+                          'post_parent': '0'})
+        post['size'] = len(data['bits'].data)
+        return {'id': post['post_id'], 'file': data['name'], 'url': url,
+                'type': data['type']}
+
+    @api_method
+    def getMediaLibrary(self, blog_id, username, password, filter=None):
+        parent_id = (filter or {}).get('parent_id')
+        return [{'attachment_id': post['post_id'],
+                 'parent': post.get('post_parent', '0'),
+                 'title': post['post_title'],
+                 'caption': post.get('post_excerpt', ''),
+                 'description': post['post_content'],
+                 'link': post['link'],
+                 'date_created_gmt': post['post_date_gmt'],
+                 'thumbnail': post['link'], 'metadata': {}}
+                for _, post in sorted(self.posts.items())
+                if post['post_type'] == 'attachment' and
+                parent_id in (None, '', str(post.get('post_parent')))]
+
+class FakeWordPressClient(Client):
+    """WordPress XML-RPC client calling a FakeWordPressSite in-process.
+
+    If `marshal` is set, requests and responses go through XML-RPC
+    marshalling, like they do over the wire, and their sizes are counted.
+    """
+
+    def __init__(self, site, username='bench', password='bench', blog_id=0,
+                 marshal=True):
+        self.url = site.site_url
+        self.username = username
+        self.password = password
+        self.blog_id = blog_id
+        self.site = site
+        self.marshal = marshal
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.supported_methods = site.supportedMethods()
+
+    def _roundtrip(self, params, methodresponse=None):
+        data = xmlrpc_client.dumps(params, methodresponse=methodresponse,
+                                   allow_none=True)
+        return len(data), xmlrpc_client.loads(data)[0]
+
+    def call(self, method):
+        args = tuple(method.get_args(self))
+        if self.marshal:
+            size, args = self._roundtrip(args)
+            self.bytes_sent += size
+        raw_result = self.site._dispatch(method.method_name, args)
+        if self.marshal:
+            size, (raw_result,) = self._roundtrip((raw_result,), True)
+            self.bytes_received += size
+        return method.process_result(raw_result)
+
+class FakeWordPressApiWrapper(WordPressApiWrapper):
+    """WordPress API wrapper working with a fake site."""
+
+    def __init__(self, site, marshal=True):
+        self._fake_site = site
+        self._marshal = marshal
+        super(FakeWordPressApiWrapper, self).__init__(site.site_url,
+                                                      'bench', 'bench')
+
+    def _init_wp_client(self, xmlrpc_url, username, password):
+        self._wp = FakeWordPressClient(self._fake_site, username, password,
+                                       marshal=self._marshal)
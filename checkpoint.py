@@ -0,0 +1,110 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Resumable progress checkpoints of commands over Evernote queries.
+
+A checkpoint file records the last note completed by a command (its phase,
+query, offset in the query results and GUID), and is saved after every
+note, so an interrupted run can be resumed after that note.
+The file is removed when a run completes, and kept when a run stops
+after a limited number of notes, to be continued by resuming.
+"""
+
+import os
+import json
+import time
+
+import common
+
+logger = common.logger.getChild('checkpoint')
+
+class Checkpoint(object):
+    """Progress checkpoint of a command over the notes of a query.
+
+    :param path: Checkpoint file path.
+    :param resume: Whether to resume from the checkpoint saved in the file,
+                   if it was saved by the same phase and query.
+    :param limit: Maximal number of notes to generate, or `None`.
+    """
+
+    def __init__(self, path, resume=False, limit=None):
+        self.path = path
+        self.resume = resume
+        self.limit = limit
+        self.limited = False
+        self.phase = None
+        self.query = None
+
+    def load(self):
+        """Return the saved checkpoint dictionary, or `None`."""
+        if not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path) as checkpoint_file:
+                return json.load(checkpoint_file)
+        except ValueError:
+            logger.warning('Ignoring invalid checkpoint file "%s"', self.path)
+            return None
+
+    def notes(self, phase, query, get_notes):
+        """Generate (offset, note) tuples of `phase` over `query` notes,
+        starting after the saved checkpoint note when resuming.
+
+        :param get_notes: Function of a start offset, generating
+                          (offset, note) tuples of the query notes.
+        """
+        self.phase, self.query = phase, query
+        saved = self.resume and self.load()
+        if not saved:
+            notes = get_notes(0)
+        elif (saved['phase'], saved['query']) != (phase, query):
+            logger.warning('Checkpoint is of %s "%s", starting from the '
+                           'first note', saved['phase'], saved['query'])
+            notes = get_notes(0)
+        else:
+            notes = self._resumed_notes(saved, get_notes)
+        if self.limit is not None:
+            return self._limited_notes(notes)
+        return notes
+
+    def _limited_notes(self, notes):
+        for count, offset_note in enumerate(notes, 1):
+            yield offset_note
+            if count >= self.limit:
+                self.limited = True
+                return
+
+    def _resumed_notes(self, saved, get_notes):
+        notes = get_notes(saved['offset'])
+        for offset, note in notes:
+            if note.guid == saved['guid']:
+                logger.info('Resuming %s "%s" after note %d (GUID %s)',
+                            self.phase, self.query, offset, note.guid)
+                for offset_note in notes:
+                    yield offset_note
+                return
+            break
+        # The query results changed since the checkpoint was saved
+        logger.warning('Checkpoint note (GUID %s) is no longer at offset %d, '
+                       'starting from the first note', saved['guid'],
+                       saved['offset'])
+        for offset_note in get_notes(0):
+            yield offset_note
+
+    def save(self, offset, note):
+        """Save `note` at `offset` as the last completed note."""
+        common.write_atomically(self.path, json.dumps({
+            'phase': self.phase,
+            'query': self.query,
+            'offset': offset,
+            'guid': note.guid,
+            'time': time.time(),
+            }))
+
+    def finish(self):
+        """Remove the checkpoint file, after a completed run."""
+        if self.limited:
+            logger.info('Stopped %s "%s" after %d notes, continue with '
+                        '--resume', self.phase, self.query, self.limit)
+            return
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -1,24 +1,255 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+import os
+import copy
+import json
+import atexit
+import Queue
 import logging
+import importlib
+import tempfile
+import threading
 import urllib
 import urllib2
 
+class Lazy(object):
+    """Log message argument evaluated only when the message is formatted.
+
+    For example, `logger.debug('Content: %s', Lazy(ET.tostring, e))`
+    serializes `e` only if the record is handled.
+    """
+
+    def __init__(self, func, *args, **kwargs):
+        self._func = func
+        self._args = args
+        self._kwargs = kwargs
+
+    @property
+    def value(self):
+        if self._func:
+            self._value = self._func(*self._args, **self._kwargs)
+            self._func = self._args = self._kwargs = None
+        return self._value
+
+    def __str__(self):
+        value = self.value
+        return value if isinstance(value, basestring) else str(value)
+
+    def __unicode__(self):
+        return unicode(self.value)
+
+class JsonFormatter(logging.Formatter):
+    """Formats log records as JSON objects, one per line."""
+
+    def format(self, record):
+        data = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+            }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exception'] = record.exc_text
+        return json.dumps(data, sort_keys=True)
+
+_IMMUTABLE_TYPES = (basestring, int, long, float, bool, type(None))
+
+def _is_immutable(value):
+    """Return whether `value` is a string, a number, or a tuple of them."""
+    if isinstance(value, tuple):
+        return all(_is_immutable(item) for item in value)
+    return isinstance(value, _IMMUTABLE_TYPES)
+
+class QueueHandler(logging.Handler):
+    """Handler sending log records to a queue, for a `QueueListener`
+    (backport of the Python 3 `logging.handlers.QueueHandler`).
+
+    Messages with immutable arguments (strings, numbers, and tuples of
+    them) are formatted in the listener thread. A record with a mutable
+    argument, which may be modified right after logging, is formatted
+    in the logging thread. `Lazy` arguments are evaluated in the logging
+    thread, as they may read mutable objects.
+
+    In a forked process (e.g. a parser worker), where the listener thread
+    does not run, records are handled by the listener handlers directly
+    (see `reset_handler_locks`).
+    """
+
+    def __init__(self, queue, listener=None):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.listener = listener
+        self._pid = os.getpid()
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        if isinstance(record.args, tuple):
+            record.args = tuple(arg.value if isinstance(arg, Lazy) else arg
+                                for arg in record.args)
+        if record.args and not _is_immutable(record.args):
+            record.msg = record.getMessage()
+            record.args = None
+        if record.exc_info:
+            record.exc_text = (self.formatter or logging.Formatter()
+                               ).formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            if self.listener and os.getpid() != self._pid:
+                self.listener.handle(record)
+            else:
+                self.queue.put_nowait(self.prepare(record))
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.handleError(record)
+
+class QueueListener(object):
+    """Handles log records from a queue in a background thread
+    (backport of the Python 3 `logging.handlers.QueueListener`)."""
+
+    _sentinel = None
+
+    def __init__(self, queue, *handlers):
+        self.queue = queue
+        self.handlers = handlers
+        self._thread = None
+
+    def handle(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def _monitor(self):
+        while True:
+            record = self.queue.get()
+            if record is self._sentinel:
+                break
+            self.handle(record)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._monitor,
+                                        name='log-writer')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Handle the queued records, and stop the background thread."""
+        if self._thread:
+            self.queue.put_nowait(self._sentinel)
+            self._thread.join()
+            self._thread = None
+
 ## Initialize module logging
 formatter = logging.Formatter(u'%(message)s')
+file_formatter = logging.Formatter(u'%(asctime)s\t%(levelname)s\t%(message)s')
 logger = logging.getLogger(u'tomato')
 logger.setLevel(logging.DEBUG)
+log_listener = None
 if hasattr(logger, 'handlers') and not logger.handlers:
     ch = logging.StreamHandler()
     ch.setLevel(logging.INFO)
     ch.setFormatter(logging.Formatter(u'%(message)s'))
     logger.addHandler(ch)
+    # The log file is written in a background thread
     fh = logging.FileHandler(u'tomato-cmd.log', encoding='utf-8')
     fh.setLevel(logging.DEBUG)
-    fh.setFormatter(logging.Formatter(
-                    u'%(asctime)s\t%(levelname)s\t%(message)s'))
-    logger.addHandler(fh)
+    fh.setFormatter(file_formatter)
+    log_queue = Queue.Queue()
+    log_listener = QueueListener(log_queue, fh).start()
+    qh = QueueHandler(log_queue, log_listener)
+    qh.setLevel(logging.DEBUG)
+    logger.addHandler(qh)
+    atexit.register(log_listener.stop)
+
+def reset_handler_locks(of_logger=logger):
+    """Give the handlers of a logger, and of its queue listeners, new locks.
+
+    Called in a forked process (e.g. as a `multiprocessing.Pool`
+    initializer), as a handler lock held by another thread of the parent
+    process when it forked is never released in the child.
+    """
+    for handler in of_logger.handlers:
+        handler.createLock()
+        listener = getattr(handler, 'listener', None)
+        for listener_handler in listener and listener.handlers or ():
+            listener_handler.createLock()
+
+def set_json_log_records(enabled=True):
+    """Write log file records as JSON objects, or as text lines."""
+    if log_listener:
+        for handler in log_listener.handlers:
+            handler.setFormatter(enabled and JsonFormatter() or file_formatter)
+
+def write_atomically(path, data):
+    """Write `data` to a file, replacing it atomically."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                    prefix='.%s.' % (os.path.basename(path)))
+    try:
+        with os.fdopen(fd, 'w') as tmp_file:
+            tmp_file.write(data)
+        os.chmod(tmp_path, 0644)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+class JsonFileMap(object):
+    """Map of attribute dictionaries by key, saved to a JSON file
+    on every change.
+
+    :param path: Map file path.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._items = dict()
+        self._modified = False
+        if os.path.exists(path):
+            with open(path) as map_file:
+                self._items = json.load(map_file)
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        """Return a dictionary of the attributes of `key`."""
+        with self._lock:
+            return dict(self._items.get(key, {}))
+
+    def update(self, key, attrs, save=True):
+        """Update attributes of `key`, and save the map if changed,
+        unless `save` is False (see `save()`)."""
+        with self._lock:
+            item = self._items.setdefault(key, dict())
+            if all(item.get(name) == value
+                   for name, value in attrs.iteritems()):
+                return
+            item.update(attrs)
+            logger.debug('Updating %s of "%s" in "%s"',
+                         ', '.join(sorted(attrs)), key, self.path)
+            self._modified = True
+            if save:
+                self._save()
+
+    def save(self):
+        """Save the map, if updated since last saved."""
+        with self._lock:
+            if self._modified:
+                self._save()
+
+    def _save(self):
+        write_atomically(self.path, json.dumps(self._items, indent=1,
+                                               sort_keys=True))
+        self._modified = False
 
 class UrlParser:
     
@@ -38,3 +269,19 @@ class UrlParser:
     
     def path_parts(self):
         return self.path.split('/')
+
+class LazyModule(object):
+    """Module proxy, importing the module on first attribute access.
+    
+    Used for heavy modules (e.g. the Evernote SDK), so that they are
+    loaded only by commands that use them.
+    """
+    
+    def __init__(self, name):
+        self.__name = name
+        self.__module = None
+    
+    def __getattr__(self, attr):
+        if self.__module is None:
+            self.__module = importlib.import_module(self.__name)
+        return getattr(self.__module, attr)
@@ -0,0 +1,315 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Compressed on-disk cache storage, shared by the local caches.
+
+Values are stored zlib-compressed, split into segment files of up to
+a segment size, in a cache directory. A segment file name has the hash of
+the key and of the compressed value, so a stored value never overwrites
+the segments of the value it replaces.
+
+The index of the cache entries is kept in a snapshot file, and changes
+since the snapshot are appended to a journal file, so storing a value
+doesn't rewrite the whole index. Segments are written atomically before
+their entry is appended to the journal, and the journal is replayed over
+the snapshot when the cache is opened (ignoring a last record cut short
+by a crash), so the index always refers to complete segments.
+Segment files no entry refers to (e.g. of a crashed store) are removed
+by `prune` and by `verify` with repair.
+
+The cache has a global cap of compressed bytes: after a value is stored,
+the least recently used values are evicted until the cache is within
+the cap. Values stored longer ago than the maximal age are evicted by
+`prune`.
+
+A cache directory is meant to be used by one process at a time.
+"""
+
+import os
+import json
+import time
+import zlib
+import hashlib
+import threading
+
+import common
+
+logger = common.logger.getChild('disk-cache')
+
+class DiskCache(object):
+    """Compressed cache of string values by string key, in a directory.
+
+    :param path: Cache directory path (created if missing).
+    :param max_bytes: Compressed bytes of all values, over which the least
+                      recently used values are evicted.
+    :param max_age: Seconds after which stored values are evicted by
+                    `prune`, or None.
+    :param segment_size: Maximal bytes of a segment file.
+    :param level: zlib compression level.
+    """
+
+    snapshot_name = 'index.json'
+    journal_name = 'index.log'
+    # Journal records over which the index snapshot is rewritten
+    max_journal_records = 1000
+    # Seconds after which temporary files of interrupted writes are removed
+    stale_seconds = 3600
+
+    def __init__(self, path, max_bytes, max_age=None,
+                 segment_size=1024 * 1024, level=6):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.segment_size = segment_size
+        self.level = level
+        self.bytes = 0
+        self._lock = threading.RLock()
+        self._entries = dict()
+        self._journal_records = 0
+        self._modified = False
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._load()
+
+    @property
+    def _snapshot_path(self):
+        return os.path.join(self.path, self.snapshot_name)
+
+    @property
+    def _journal_path(self):
+        return os.path.join(self.path, self.journal_name)
+
+    def _load(self):
+        if os.path.exists(self._snapshot_path):
+            try:
+                with open(self._snapshot_path) as snapshot_file:
+                    self._entries = json.load(snapshot_file)
+            except ValueError:
+                logger.warning('Ignoring corrupt cache index "%s"',
+                               self._snapshot_path)
+        if os.path.exists(self._journal_path):
+            with open(self._journal_path) as journal_file:
+                for line in journal_file:
+                    try:
+                        key, entry = json.loads(line)
+                    except ValueError:
+                        # A record cut short by a crash, rewrite the index
+                        #  so that new records aren't appended to it
+                        logger.warning('Ignoring partial cache index record '
+                                       'in "%s"', self._journal_path)
+                        self._modified = True
+                        break
+                    self._replay(key, entry)
+                    self._journal_records += 1
+        self.bytes = sum(entry['size'] for entry in self._entries.itervalues())
+        if self._modified:
+            self._save()
+
+    def _replay(self, key, entry):
+        if entry is None:
+            self._entries.pop(key, None)
+        else:
+            self._entries[key] = entry
+
+    def _journal(self, key, entry):
+        """Record a stored (or, with no entry, a deleted) key."""
+        self._replay(key, entry)
+        with open(self._journal_path, 'a') as journal_file:
+            journal_file.write(json.dumps([key, entry]) + '\n')
+        self._journal_records += 1
+        if self._journal_records > self.max_journal_records:
+            self._save()
+
+    def _save(self):
+        common.write_atomically(self._snapshot_path,
+                                json.dumps(self._entries, sort_keys=True))
+        with open(self._journal_path, 'w'):
+            pass
+        self._journal_records = 0
+        self._modified = False
+
+    def save(self):
+        """Save the index (with the access times of the values),
+        if changed since last saved."""
+        with self._lock:
+            if self._modified or self._journal_records:
+                self._save()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def _remove_files(self, names):
+        for name in names:
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+
+    def _remove_segments(self, entries):
+        for entry in entries:
+            self._remove_files(entry['segments'])
+
+    def _read(self, entry):
+        chunks = list()
+        for name in entry['segments']:
+            with open(os.path.join(self.path, name), 'rb') as segment_file:
+                chunks.append(segment_file.read())
+        data = ''.join(chunks)
+        if hashlib.sha1(data).hexdigest() != entry['digest']:
+            raise ValueError('Digest mismatch')
+        return data
+
+    def get(self, key):
+        """Return the value of `key`, or None if not cached.
+
+        The segments are read out of the lock, so a value replaced or
+        evicted while read (whose segments are removed) is a cache miss.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            entry['accessed'] = time.time()
+            self._modified = True
+        try:
+            return zlib.decompress(self._read(entry))
+        except (IOError, ValueError, zlib.error):
+            with self._lock:
+                current = self._entries.get(key)
+                if current is None or current['digest'] != entry['digest']:
+                    return None
+                logger.warning('Dropping corrupt cache value of "%s"', key)
+                self.delete(key)
+            return None
+
+    def put(self, key, value):
+        """Store the string `value` of `key`, evicting the least recently
+        used values over the byte cap."""
+        data = zlib.compress(value, self.level)
+        digest = hashlib.sha1(data).hexdigest()
+        key_hash = hashlib.sha1(isinstance(key, unicode) and
+                                key.encode('utf-8') or key).hexdigest()
+        prefix = '%s-%s' % (key_hash[:16], digest[:16])
+        names = list()
+        for num, offset in enumerate(xrange(0, len(data),
+                                            self.segment_size)):
+            names.append('%s-%d.z' % (prefix, num))
+            common.write_atomically(os.path.join(self.path, names[-1]),
+                                    data[offset:offset + self.segment_size])
+        now = time.time()
+        entry = {'segments': names, 'size': len(data),
+                 'raw_size': len(value), 'digest': digest,
+                 'stored': now, 'accessed': now}
+        with self._lock:
+            previous = self._entries.get(key)
+            self.bytes += entry['size'] - (previous and previous['size'] or 0)
+            self._journal(key, entry)
+            evicted = self._evict(self.max_bytes)
+        if previous and previous['segments'] != names:
+            self._remove_segments([previous])
+        self._remove_segments(evicted)
+
+    def delete(self, key):
+        """Remove `key` from the cache, if cached."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            self.bytes -= entry['size']
+            self._journal(key, None)
+        self._remove_segments([entry])
+
+    def _evict(self, max_bytes, max_age=None):
+        """Remove the entries stored before `max_age` seconds ago,
+        and the least recently used entries over `max_bytes`,
+        and return the removed entries (whose segments are still on disk).
+        """
+        evicted = list()
+        now = time.time()
+        by_access = sorted(self._entries.iteritems(),
+                           key=lambda item: item[1]['accessed'])
+        for key, entry in by_access:
+            if (self.bytes <= max_bytes and
+                (max_age is None or now - entry['stored'] <= max_age)):
+                continue
+            self.bytes -= entry['size']
+            self._journal(key, None)
+            evicted.append(entry)
+        if evicted:
+            logger.debug('Evicted %d values from cache "%s"',
+                         len(evicted), self.path)
+        return evicted
+
+    def _orphans(self):
+        """Return the names of the files in the cache directory that
+        no entry refers to."""
+        referred = set([self.snapshot_name, self.journal_name])
+        for entry in self._entries.itervalues():
+            referred.update(entry['segments'])
+        orphans = list()
+        now = time.time()
+        for name in os.listdir(self.path):
+            if name in referred:
+                continue
+            # Temporary files may be of writes in progress
+            if (name.startswith('.') and now - os.path.getmtime(
+                    os.path.join(self.path, name)) < self.stale_seconds):
+                continue
+            orphans.append(name)
+        return sorted(orphans)
+
+    def prune(self, max_bytes=None, max_age=None):
+        """Evict values over a byte cap and a maximal age (by default,
+        the cache's), remove orphan files, and return the number of
+        evicted values."""
+        with self._lock:
+            evicted = self._evict(
+                self.max_bytes if max_bytes is None else max_bytes,
+                self.max_age if max_age is None else max_age)
+            self._remove_segments(evicted)
+            orphans = self._orphans()
+            self._save()
+        self._remove_files(orphans)
+        return len(evicted)
+
+    def verify(self, repair=False):
+        """Check every value and the cache files, and return a list of
+        problem descriptions. With `repair`, remove the corrupt values
+        and the orphan files."""
+        problems = list()
+        with self._lock:
+            entries = sorted(self._entries.iteritems())
+            orphans = self._orphans()
+        corrupt = list()
+        for key, entry in entries:
+            try:
+                self._read(entry)
+            except (IOError, ValueError), e:
+                problems.append('Corrupt value of "%s": %s' % (key, e))
+                corrupt.append(key)
+        problems.extend('Orphan file "%s"' % (name) for name in orphans)
+        if repair:
+            for key in corrupt:
+                self.delete(key)
+            self._remove_files(orphans)
+            self.save()
+        return problems
+
+    def stats(self):
+        """Return a dictionary of cache statistics."""
+        with self._lock:
+            entries = self._entries.values()
+        return {
+            'path': self.path,
+            'values': len(entries),
+            'segments': sum(len(entry['segments']) for entry in entries),
+            'bytes': sum(entry['size'] for entry in entries),
+            'raw_bytes': sum(entry['raw_size'] for entry in entries),
+            'max_bytes': self.max_bytes,
+            'oldest_stored': min([entry['stored'] for entry in entries]
+                                 or [None]),
+            'last_accessed': max([entry['accessed'] for entry in entries]
+                                 or [None]),
+            }
@@ -0,0 +1,18 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Persistent maps of WordPress item attributes by Evernote note GUID.
+
+The WordPress ID, link and dates of the items posted from notes are kept
+in the note metadata, for the primary WordPress site only.
+Mirror sites keep these attributes in an ID map file per site instead,
+so every site has its own IDs.
+"""
+
+import common
+
+class IdMap(common.JsonFileMap):
+    """Map of WordPress item attributes by Evernote note GUID,
+    saved to a JSON file on every update.
+
+    :param path: Map file path.
+    """
@@ -0,0 +1,306 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""API call metrics.
+
+Records the number of calls, errors, bytes sent and received, and a
+latency histogram, for every instrumented API method, and exports them
+in Prometheus text format and as JSON.
+
+API wrapper methods are instrumented with `measure()` or `instrumented()`.
+Bytes are counted by the transports of the underlying API clients
+(see `count_thrift_bytes()` and `xmlrpc_transport()`), and attributed
+to the API method being measured in the same thread.
+"""
+
+import json
+import time
+import threading
+import xmlrpclib
+from contextlib import contextmanager
+from functools import wraps
+
+from thrift.transport import TTransport
+
+import common
+
+logger = common.logger.getChild('metrics')
+
+# Latency histogram bucket upper bounds, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0, float('inf'))
+
+class MethodMetrics(object):
+    """Metrics of a single API method."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.count = 0
+        self.errors = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.latency_sum = 0.0
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+
+    def observe(self, seconds, error, bytes_sent, bytes_received):
+        self.count += 1
+        if error:
+            self.errors += 1
+        self.bytes_sent += bytes_sent
+        self.bytes_received += bytes_received
+        self.latency_sum += seconds
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                self.bucket_counts[i] += 1
+                break
+
+    def cumulative_buckets(self):
+        """Generate (upper bound, cumulative count) tuples."""
+        total = 0
+        for bound, count in zip(self.buckets, self.bucket_counts):
+            total += count
+            yield bound, total
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+            'latency_sum': self.latency_sum,
+            'latency_buckets': [[_format_bound(bound), count] for bound, count
+                                in self.cumulative_buckets()],
+            }
+
+def _format_bound(bound):
+    return '+Inf' if bound == float('inf') else repr(bound)
+
+class MetricsRegistry(object):
+    """Thread-safe registry of API method metrics, by (service, method)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = dict()
+        self._local = threading.local()
+
+    def reset(self):
+        with self._lock:
+            self._metrics.clear()
+
+    def add_bytes(self, sent=0, received=0):
+        """Attribute bytes to the API call measured in this thread, if any."""
+        call_bytes = getattr(self._local, 'call_bytes', None)
+        if call_bytes is not None:
+            call_bytes[0] += sent
+            call_bytes[1] += received
+
+    @contextmanager
+    def measure(self, service, method):
+        """Context manager measuring an API call of `service` `method`.
+
+        An exception raised in the context counts as an error.
+        """
+        outer_bytes = getattr(self._local, 'call_bytes', None)
+        call_bytes = self._local.call_bytes = [0, 0]
+        error = True
+        start = time.time()
+        try:
+            yield
+            error = False
+        finally:
+            seconds = time.time() - start
+            self._local.call_bytes = outer_bytes
+            with self._lock:
+                key = (service, method)
+                if key not in self._metrics:
+                    self._metrics[key] = MethodMetrics()
+                self._metrics[key].observe(seconds, error, *call_bytes)
+
+    def snapshot(self):
+        """Return a sorted list of (service, method, metrics dictionary)."""
+        with self._lock:
+            return [(service, method, metrics.as_dict()) for
+                    (service, method), metrics in sorted(
+                        self._metrics.iteritems())]
+
+    def to_json(self):
+        return json.dumps({
+            'timestamp': time.time(),
+            'methods': [dict(metrics, service=service, method=method)
+                        for service, method, metrics in self.snapshot()],
+            }, indent=2, sort_keys=True)
+
+    def to_prometheus(self):
+        """Return the metrics in Prometheus text exposition format."""
+        snapshot = self.snapshot()
+        lines = list()
+        def family(name, metric_type, help_text, samples):
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+            for suffix, labels, value in samples:
+                lines.append('%s%s{%s} %s' % (name, suffix, ','.join(
+                    '%s="%s"' % (label, label_value)
+                    for label, label_value in labels), value))
+        def labels(service, method, *extra):
+            return (('service', service), ('method', method)) + extra
+        family('tomato_api_calls_total', 'counter', 'API calls.',
+               [('', labels(service, method), metrics['count'])
+                for service, method, metrics in snapshot])
+        family('tomato_api_errors_total', 'counter', 'Failed API calls.',
+               [('', labels(service, method), metrics['errors'])
+                for service, method, metrics in snapshot])
+        family('tomato_api_bytes_total', 'counter',
+               'Bytes sent and received in API calls.',
+               [('', labels(service, method, ('direction', direction)),
+                 metrics['bytes_' + direction])
+                for service, method, metrics in snapshot
+                for direction in ('sent', 'received')])
+        samples = list()
+        for service, method, metrics in snapshot:
+            for bound, count in metrics['latency_buckets']:
+                samples.append(('_bucket',
+                                labels(service, method, ('le', bound)),
+                                count))
+            samples.append(('_sum', labels(service, method),
+                            repr(metrics['latency_sum'])))
+            samples.append(('_count', labels(service, method),
+                            metrics['count']))
+        family('tomato_api_call_duration_seconds', 'histogram',
+               'API call latency.', samples)
+        return '\n'.join(lines) + '\n'
+
+    def write(self, prometheus_path=None, json_path=None):
+        """Write the metrics to files, replacing them atomically."""
+        for path, render in ((prometheus_path, self.to_prometheus),
+                             (json_path, self.to_json)):
+            if path:
+                common.write_atomically(path, render())
+
+# The global registry
+registry = MetricsRegistry()
+
+def measure(service, method):
+    """Context manager measuring an API call in the global registry."""
+    return registry.measure(service, method)
+
+def instrumented(service, method=None):
+    """Decorator measuring calls to the decorated API method.
+
+    :param service: Name of the API service.
+    :param method: Method name to record, defaults to the function name.
+    """
+    def decorator(func):
+        name = method or func.__name__.lstrip('_')
+        @wraps(func)
+        def runner(*args, **kwargs):
+            with registry.measure(service, name):
+                return func(*args, **kwargs)
+        return runner
+    return decorator
+
+class MetricsExporter(object):
+    """Writes the global registry metrics to files when stopped,
+    and optionally periodically in a background thread.
+
+    :param prometheus_path: Prometheus text format output file path.
+    :param json_path: JSON output file path.
+    :param interval: Seconds between periodic exports, or None to export
+                     only when stopped.
+    """
+
+    def __init__(self, prometheus_path=None, json_path=None, interval=None):
+        self.prometheus_path = prometheus_path
+        self.json_path = json_path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _export(self):
+        try:
+            registry.write(self.prometheus_path, self.json_path)
+        except Exception:
+            logger.exception('Failed exporting metrics')
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._export()
+
+    def start(self):
+        if self.interval:
+            self._thread = threading.Thread(target=self._run,
+                                            name='metrics-exporter')
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        self._export()
+
+class ThriftByteCountingTransport(TTransport.TTransportBase):
+    """Thrift transport wrapper counting bytes sent and received."""
+
+    def __init__(self, trans):
+        self._trans = trans
+
+    def isOpen(self):
+        return self._trans.isOpen()
+
+    def open(self):
+        return self._trans.open()
+
+    def close(self):
+        return self._trans.close()
+
+    def read(self, sz):
+        buf = self._trans.read(sz)
+        registry.add_bytes(received=len(buf))
+        return buf
+
+    def write(self, buf):
+        registry.add_bytes(sent=len(buf))
+        self._trans.write(buf)
+
+    def flush(self):
+        self._trans.flush()
+
+def count_thrift_bytes(store):
+    """Count the bytes of API calls made through an Evernote `Store`."""
+    client = store._client
+    trans = ThriftByteCountingTransport(client._oprot.trans)
+    client._iprot.trans = client._oprot.trans = trans
+    return store
+
+class _CountingResponse(object):
+    def __init__(self, response):
+        self._response = response
+        self.getheader = response.getheader
+
+    def read(self, *args):
+        data = self._response.read(*args)
+        registry.add_bytes(received=len(data))
+        return data
+
+class _ByteCountingMixin:
+    """XML-RPC transport mixin counting bytes sent and received."""
+
+    def send_content(self, connection, request_body):
+        registry.add_bytes(sent=len(request_body))
+        return self._base.send_content(self, connection, request_body)
+
+    def parse_response(self, response):
+        return self._base.parse_response(self, _CountingResponse(response))
+
+class XmlRpcByteCountingTransport(_ByteCountingMixin, xmlrpclib.Transport):
+    _base = xmlrpclib.Transport
+
+class XmlRpcByteCountingSafeTransport(_ByteCountingMixin,
+                                      xmlrpclib.SafeTransport):
+    _base = xmlrpclib.SafeTransport
+
+def xmlrpc_transport(url):
+    """Return an XML-RPC transport for `url`, counting bytes."""
+    if url.startswith('https:'):
+        return XmlRpcByteCountingSafeTransport(use_datetime=0)
+    return XmlRpcByteCountingTransport(use_datetime=0)
@@ -3,21 +3,25 @@
 
 import copy
 import time
+import threading
 import re
 import mimetypes
 import binascii
 import hashlib
+import struct
 from string import Template
 from collections import namedtuple
+from contextlib import contextmanager
 import cgi
 
-#Evernote API:
-from evernote.api.client import EvernoteClient
-import evernote.edam.type.ttypes as Types
-import evernote.edam.error.ttypes as Errors
-from evernote.edam.notestore import NoteStore
-
 import common
+import metrics
+
+#Evernote API (loaded on first use):
+Types = common.LazyModule('evernote.edam.type.ttypes')
+Errors = common.LazyModule('evernote.edam.error.ttypes')
+NoteStore = common.LazyModule('evernote.edam.notestore.NoteStore')
+note_store_pool = common.LazyModule('note_store_pool')
 
 logger = common.logger.getChild('my-evernote')
 
@@ -31,14 +35,88 @@ note_url_re = re.compile('https\:\/\/www\.evernote\.com\/shard\/'
                           '(?P<note_id>[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-'
                           '[0-9a-f]{4}-[0-9a-f]{12})\/?')
 
+# MIME types by magic numbers at the start of files,
+#  as (offset, magic number, MIME type) tuples
+MAGIC_NUMBERS = (
+    (0, '\x89PNG\r\n\x1a\n', 'image/png'),
+    (0, '\xff\xd8\xff', 'image/jpeg'),
+    (0, 'GIF87a', 'image/gif'),
+    (0, 'GIF89a', 'image/gif'),
+    (0, 'II*\x00', 'image/tiff'),
+    (0, 'MM\x00*', 'image/tiff'),
+    (0, '\x00\x00\x01\x00', 'image/x-icon'),
+    (8, 'WEBP', 'image/webp'),
+    (0, '%PDF-', 'application/pdf'),
+    )
+# Sizes of the DIB header following the 14 bytes BMP file header
+#  (which starts with "BM", like many text files)
+BMP_DIB_HEADER_SIZES = (12, 40, 52, 56, 64, 108, 124)
+BMP_HEADER_SIZE = 18
+# Bytes needed for detecting MIME types by magic numbers
+MAGIC_NUMBERS_SIZE = max([offset + len(magic)
+                          for offset, magic, _ in MAGIC_NUMBERS] +
+                         [BMP_HEADER_SIZE])
+
+_sniffed_mimes = dict()
+
+def _is_bmp(head):
+    """Return whether file bytes start with a BMP file header,
+    with zero reserved bytes, followed by a DIB header size."""
+    return (len(head) >= BMP_HEADER_SIZE and 'BM' == head[:2] and
+            '\x00\x00\x00\x00' == head[6:10] and
+            struct.unpack('<I', head[14:18])[0] in BMP_DIB_HEADER_SIZES)
+
+def sniff_mime(head):
+    """Return the MIME type of a file detected by its first bytes, or None.
+    
+    Results are memoized by the bytes used for detection.
+    """
+    head = head[:MAGIC_NUMBERS_SIZE]
+    if head not in _sniffed_mimes:
+        if len(_sniffed_mimes) > 1024:
+            _sniffed_mimes.clear()
+        _sniffed_mimes[head] = next(
+            (mime for offset, magic, mime in MAGIC_NUMBERS
+             if head[offset:offset + len(magic)] == magic),
+            _is_bmp(head) and 'image/bmp' or None)
+    return _sniffed_mimes[head]
+
+_client_class = None
+
+def _evernote_client(**options):
+    """Return a new Evernote client, loading the Evernote SDK on first use.
+    
+    The client also accepts a service host given as URL.
+    A service host with a scheme (e.g. "http://localhost:8880") is used
+    as is, allowing to work with a local stand-in service over plain HTTP.
+    """
+    global _client_class
+    if _client_class is None:
+        from evernote.api.client import EvernoteClient
+        class ServiceUrlEvernoteClient(EvernoteClient):
+            def _get_endpoint(self, path=None):
+                if '://' not in self.service_host:
+                    return super(ServiceUrlEvernoteClient,
+                                 self)._get_endpoint(path)
+                url = self.service_host.rstrip('/')
+                if path is not None:
+                    url += '/%s' % (path.lstrip('/'))
+                return url
+        _client_class = ServiceUrlEvernoteClient
+    return _client_class(**options)
+
 def ratelimit_wait_and_retry(func):
-    def runner(*args, **kwargs):
+    method_name = func.__name__.lstrip('_')
+    def runner(self, *args, **kwargs):
         while True:
             try:
-                return func(*args, **kwargs)
+                with self._checkout_note_store():
+                    with metrics.measure('evernote', method_name):
+                        return func(self, *args, **kwargs)
             except Errors.EDAMSystemException, e:
                 # TODO: more flexible error handling? callbacks?
                 if e.errorCode == Errors.EDAMErrorCode.RATE_LIMIT_REACHED:
+                    self._rate_limit_waits += 1
                     wait_time = e.rateLimitDuration + 5
                     logger.warn(u'Evernote rate limit reached :-( '
                                 u'Waiting %d seconds before retrying' %
@@ -47,6 +125,30 @@ def ratelimit_wait_and_retry(func):
                     logger.debug(u'Finished waiting for rate limit reset.')
     return runner
 
+class AdaptivePageSize(object):
+    """Page size of notes metadata listings, adapted to the listing calls.
+    
+    The size doubles after fast calls, making fewer listing calls,
+    and halves after slow calls, or calls that reached the rate limit.
+    """
+    
+    min_size = 10
+    # The maximal number of notes returned by findNotesMetadata
+    max_size = 250
+    fast_seconds = 1.0
+    slow_seconds = 5.0
+    
+    def __init__(self, size):
+        self.size = max(self.min_size, min(self.max_size, size))
+    
+    def observe(self, seconds, rate_limited=False):
+        """Adapt the page size after a listing call, and return it."""
+        if rate_limited or seconds > self.slow_seconds:
+            self.size = max(self.min_size, self.size // 2)
+        elif seconds < self.fast_seconds:
+            self.size = min(self.max_size, self.size * 2)
+        return self.size
+
 class EvernoteApiWrapper():
     
     _cache = dict()
@@ -75,14 +177,36 @@ class EvernoteApiWrapper():
         note.updated = updated
         return note
     
+    @staticmethod
+    def makeData(src_file, chunk_size=64 * 1024):
+        """Return a Data instance of the data read from a file handle.
+        
+        The data is read at once (so the body is held in memory once),
+        and hashed in chunks of buffers over the body, without copies.
+        """
+        body = src_file.read()
+        md5 = hashlib.md5()
+        for offset in xrange(0, len(body), chunk_size):
+            md5.update(buffer(body, offset, chunk_size))
+        return Types.Data(body=body, size=len(body), bodyHash=md5.digest())
+    
     @staticmethod
     def makeResource(src_file, filename, mime=None):
+        """Return a new Resource, and its media tag, of the data of a file
+        handle.
+        
+        The MIME type, unless given, is detected from the data,
+        or guessed from the file name.
+        """
+        data = EvernoteApiWrapper.makeData(src_file)
+        if not mime:
+            mime = sniff_mime(data.body)
         if not mime:
             mime = mimetypes.guess_type(filename)[0]
         if not mime:
             mime = u'application/octet-stream'
             logger.warning(u'Failed guessing mimetype for "%s" '
-                            '(defaulting to "%s")' % (filename, mime))
+                           '(defaulting to "%s")', filename, mime)
         # mimetype workarounds:
         if 'image/x-png' == mime:
             # seems like Evernote (Windows) will display
@@ -92,9 +216,6 @@ class EvernoteApiWrapper():
             # seems like Evernote (Windows) will display
             #  the image inline in the note only this way.
             mime = 'image/jpeg'
-        body = src_file.read()
-        data = Types.Data(body=body, size=len(body),
-                          bodyHash=hashlib.md5(body).digest())
         attr = Types.ResourceAttributes(fileName=filename.encode('utf-8'))
         resource = Types.Resource(data=data, mime=mime, attributes=attr)
         return resource, EvernoteApiWrapper.get_resource_tag(resource)
@@ -105,6 +226,17 @@ class EvernoteApiWrapper():
                 (resource.mime, binascii.hexlify(resource.data.bodyHash))
                 ).encode('utf-8')
     
+    @staticmethod
+    def index_resources_by_hash(resources):
+        """Return a dictionary of `resources` by hex-encoded body hash.
+        
+        If several resources have the same hash, the first one is indexed.
+        """
+        index = dict()
+        for res in resources or []:
+            index.setdefault(binascii.hexlify(res.data.bodyHash), res)
+        return index
+    
     @staticmethod
     def is_evernote_url(url):
         return url and ((url.startswith('evernote:///view/') or
@@ -147,21 +279,49 @@ class EvernoteApiWrapper():
             guid = cls.parseNoteLinkUrl(guid).noteGuid
         return guid
     
-    def __init__(self, token, sandbox=False):
+    def __init__(self, token, sandbox=False, service_host=None,
+                 page_sizes=None, pool_size=4, disk_cache=None):
+        """Initialize Evernote client API wrapper.
+        
+        :param token: Evernote API authentication token.
+        :param sandbox: Whether to work with the Evernote sandbox service.
+        :param service_host: Evernote service host name or URL to work with,
+                             instead of the default Evernote service.
+        :param page_sizes: Map of the listing page sizes of queries, to keep
+                           the page sizes adapted in previous runs.
+        :type page_sizes: common.JsonFileMap
+        :param pool_size: Maximal number of NoteStore clients, making
+                          API calls from different threads in parallel.
+        :param disk_cache: Cache of resource data between runs, or None.
+        :type disk_cache: disk_cache.DiskCache
+        """
+        self._service_host = service_host
+        self._pool_size = pool_size
+        # The Thrift clients can't be shared between threads, so API calls
+        #  check out a NoteStore client of the pool, or, without a pool
+        #  (a single given NoteStore client), are serialized.
+        self._api_lock = threading.RLock()
         self.cached_notebook = None
-        self._init_en_client(token, sandbox)
+        # The clients are initialized on first use
+        self._client_options = (token, sandbox)
         self._notes_metadata_page_size = 100
+        self._page_sizes = page_sizes
+        self.disk_cache = disk_cache
+        self._rate_limit_waits = 0
         self._notebook_list = None
         self._user = None
     
     @ratelimit_wait_and_retry
+    def _getUser(self):
+        return self._client.get_user_store().getUser(self._client.token)
+    
     def get_user(self):
         """Return a user instance of the authenticated user."""
         # Return from cache if available
         if self._user:
             return self._user
         # Cache for future use
-        self._user = self._client.get_user_store().getUser(self._client.token)
+        self._user = self._getUser()
         return self._user
     
     def get_evernote_url(self, note_or_guid):
@@ -181,11 +341,11 @@ class EvernoteApiWrapper():
     
     @ratelimit_wait_and_retry
     def _listNotebooks(self):
-        return self._note_store.listNotebooks()
+        return self._store().listNotebooks()
     
     @ratelimit_wait_and_retry
     def _get_resource_data(self, guid):
-        return self._note_store.getResourceData(self._client.token, guid)
+        return self._store().getResourceData(self._client.token, guid)
     
     def _get_notebook(self, notebook_name):
         if not self._notebook_list:
@@ -202,47 +362,125 @@ class EvernoteApiWrapper():
     def notes_metadata_page_size(self, value):
         self._notes_metadata_page_size = value
     
+    def __getattr__(self, name):
+        # Initialize the clients on first access
+        if name in ('_client', '_note_store', '_note_stores'):
+            with self._api_lock:
+                options = self.__dict__.get('_client_options')
+                if options:
+                    self._init_en_client(*options)
+                    del self.__dict__['_client_options']
+            if name in self.__dict__:
+                return self.__dict__[name]
+        raise AttributeError(name)
+    
     def _init_en_client(self, token, sandbox):
         # Client initialization code in dedicated function
         #  to simplify mocking for unit tests.
-        self._client = EvernoteClient(token=token, sandbox=sandbox)
-        self._note_store = self._client.get_note_store()
+        options = dict(token=token, sandbox=sandbox)
+        if self._service_host:
+            options['service_host'] = self._service_host
+        self._client = _evernote_client(**options)
+        note_store_url = self._client.get_user_store().getNoteStoreUrl()
+        def new_note_store():
+            return metrics.count_thrift_bytes(note_store_pool.PersistentStore(
+                token, NoteStore.Client, note_store_url))
+        self._note_stores = note_store_pool.NoteStorePool(new_note_store,
+                                                          self._pool_size)
+    
+    @contextmanager
+    def _checkout_note_store(self):
+        pool = getattr(self, '_note_stores', None)
+        if pool is None:
+            with self._api_lock:
+                yield
+        else:
+            with pool.checkout():
+                yield
+    
+    def _store(self):
+        """Return the NoteStore client of the calling thread."""
+        pool = getattr(self, '_note_stores', None)
+        if pool is None:
+            return self._note_store
+        return pool.current()
     
     @ratelimit_wait_and_retry
     def _findNotesMetadata(self, *args, **kwargs):
-        return self._note_store.findNotesMetadata(*args, **kwargs)
+        return self._store().findNotesMetadata(*args, **kwargs)
+    
+    @staticmethod
+    def _page_size_key(words, notebook_guid=None):
+        return '%s:%s' % (notebook_guid or '', words)
+    
+    def get_page_size(self, query, in_notebook=None):
+        """Return the listing page size of query notes in a notebook."""
+        notebook = in_notebook and self._get_notebook(in_notebook)
+        key = self._page_size_key(query.encode('utf-8'),
+                                  notebook and notebook.guid)
+        return ((self._page_sizes and
+                 self._page_sizes.get(key).get('page_size')) or
+                self.notes_metadata_page_size)
     
     def _notes_metadata_generator(self, note_filter, spec,
                                   start_offset=0, page_size=None):
         # API call wrapped in generator to simplify pagination and mocking.
         offset = start_offset
+        # Adapt the page size, unless given
+        page_sizer = None
         if not page_size:
-            page_size = self.notes_metadata_page_size
+            key = self._page_size_key(note_filter.words,
+                                      note_filter.notebookGuid)
+            page_sizer = AdaptivePageSize(
+                (self._page_sizes and
+                 self._page_sizes.get(key).get('page_size')) or
+                self.notes_metadata_page_size)
+            page_size = page_sizer.size
         while True:
+            rate_limit_waits = self._rate_limit_waits
+            start = time.time()
             notes_metadata = self._findNotesMetadata(self._client.token,
                                                      note_filter,
                                                      offset, page_size,
                                                      spec)
+            if page_sizer:
+                page_size = page_sizer.observe(
+                    time.time() - start,
+                    rate_limit_waits != self._rate_limit_waits)
+                if self._page_sizes is not None:
+                    self._page_sizes.update(key, {'page_size': page_size})
             for note_offset, note in enumerate(notes_metadata.notes,
                                                offset):
                 # yield also note offset in query,
                 #  to allow efficient re-entry in case of rate limit.
                 yield note_offset, note
-            if notes_metadata.startIndex + page_size >= \
-                    notes_metadata.totalNotes:
+            offset += len(notes_metadata.notes)
+            if not notes_metadata.notes or \
+                    offset >= notes_metadata.totalNotes:
                 break
-            offset += page_size
     
-    def get_notes_by_query(self, query, in_notebook=None, page_size=None):
-        """Generate Evernote notes matched by query in a notebook."""
+    def get_notes_by_query(self, query, in_notebook=None, page_size=None,
+                           start_offset=0):
+        """Generate Evernote notes matched by query in a notebook,
+        as (offset, note metadata) tuples.
+        
+        Notes are ordered by creation time, so offsets of matched notes
+        don't change when notes are updated.
+        
+        :param start_offset: Offset in query results of the first note.
+        """
         notebook = in_notebook and self._get_notebook(in_notebook)
         query = query.encode('utf-8')
         note_filter = NoteStore.NoteFilter(
+            order=Types.NoteSortOrder.CREATED, ascending=True,
             words=query,
             notebookGuid=notebook and notebook.guid)
-        spec = NoteStore.NotesMetadataResultSpec(includeTitle=True,
-                                                 includeUpdated=True)
+        spec = NoteStore.NotesMetadataResultSpec(
+            includeTitle=True, includeUpdated=True,
+            includeUpdateSequenceNum=True, includeContentLength=True,
+            includeLargestResourceMime=True, includeLargestResourceSize=True)
         return self._notes_metadata_generator(note_filter, spec,
+                                              start_offset=start_offset,
                                               page_size=page_size)
     
     def get_notes_by_title(self, title, in_notebook=None, page_size=None):
@@ -265,38 +503,74 @@ class EvernoteApiWrapper():
     
     @ratelimit_wait_and_retry
     def _createNote(self, note):
-        return self._note_store.createNote(self._client.token, note)
+        return self._store().createNote(self._client.token, note)
     
     def saveNoteToNotebook(self, note, in_notebook=None):
         # If no notebook specified - default notebook is used
         notebook = in_notebook and self._get_notebook(in_notebook)
         if notebook:
             note.notebookGuid = notebook.guid
-        logger.info('Saving note "%s" to Evernote' % (note.title))
+        logger.info('Saving note "%s" to Evernote', note.title)
         return self._createNote(note)
     
     @ratelimit_wait_and_retry
     def updateNote(self, note):
         """Update a note in the Evernote note store.
         
-        :param note: The note to update.
+        :param note: The note to update. Its update sequence number and
+                     updated time are set from the updated note.
         :type note: Types.Note
         """
-        self._note_store.updateNote(self._client.token, note)
+        updated = self._store().updateNote(self._client.token, note)
+        if updated:
+            note.updateSequenceNum = updated.updateSequenceNum
+            note.updated = updated.updated
+        return updated
     
-    @ratelimit_wait_and_retry
-    def get_resource_data(self, guid):
+    def get_resource_data(self, guid, body_hash=None):
         """Get Evernote resource data by GUID.
         
+        Resource data of a known hash is kept in the disk cache,
+        if the wrapper has one (the data of a resource changes with its hash).
+        
         :param guid: The requested resource GUID.
+        :param body_hash: The MD5 digest of the resource data, or None.
         """
         if guid in self._cache:
             return self._cache[guid]
-        self._cache[guid] = self._note_store.getResourceData(
-            self._client.token, guid)
-        return self._cache[guid]
+        key = None
+        if self.disk_cache is not None and body_hash:
+            key = 'resource:%s:%s' % (guid, binascii.hexlify(body_hash))
+        data = key and self.disk_cache.get(key)
+        if data is None:
+            data = self._get_resource_data(guid)
+            if key:
+                self.disk_cache.put(key, data)
+        self._cache[guid] = data
+        return data
     
     @ratelimit_wait_and_retry
+    def _getSyncState(self):
+        return self._store().getSyncState(self._client.token)
+    
+    def get_sync_state(self):
+        """Return the sync state of the user account.
+        
+        The state `updateCount` is the highest update sequence number in the
+        account, and changes whenever any note or notebook changes.
+        """
+        return self._getSyncState()
+    
+    def forget_note(self, note_guid):
+        """Remove a note from the cache, so it is fetched on next use."""
+        self._cache.pop(note_guid, None)
+    
+    @ratelimit_wait_and_retry
+    def _getNote(self, note_guid, with_content, with_resource_data):
+        return self._store().getNote(self._client.token, note_guid,
+                                        with_content, with_resource_data,
+                                        False, False)
+    
     def get_note(self, genlink, with_content=True, with_resource_data=False):
         """Get Evernote Note object by GUID or generalized link.
         
@@ -308,11 +582,7 @@ class EvernoteApiWrapper():
         note_guid = self.get_note_guid(genlink)
         if note_guid in self._cache:
             return self._cache[note_guid]
-        note = self._note_store.getNote(self._client.token,
-                                        note_guid,
-                                        with_content,
-                                        with_resource_data,
-                                        False, False)
+        note = self._getNote(note_guid, with_content, with_resource_data)
         # Decode strings so rest of program can assume Unicode.
         note.title = note.title.decode('utf-8')
         note.content = note.content.decode('utf-8')
@@ -0,0 +1,225 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Pool of Evernote NoteStore clients, for API calls from several threads.
+
+A Thrift client can't be shared between threads, so every API call
+checks out a client of the pool for its thread, and returns it when done.
+Nested calls of a thread reuse the client the thread checked out.
+
+The clients keep their HTTP connections open between calls (the Thrift
+HTTP transport of the Evernote SDK connects anew on every call).
+Health checks keep the pooled clients usable:
+- A client whose call failed on the transport is discarded.
+- The connection of a client that was idle for long is closed before
+  the client is reused, as the server may have dropped it.
+- A call failing on a reused connection before its request was sent
+  is retried once on a new connection. A call failing after its request
+  was sent is not retried, as the service may have made the call
+  (e.g. created a note).
+"""
+
+import sys
+import time
+import socket
+import httplib
+import urlparse
+import threading
+from cStringIO import StringIO
+from contextlib import contextmanager
+
+from thrift.transport import TTransport
+from thrift.protocol import TBinaryProtocol
+from evernote.api.client import Store
+
+import common
+
+logger = common.logger.getChild('note-store-pool')
+
+# Errors of calls failing on the transport (rather than in the service)
+TRANSPORT_ERRORS = (TTransport.TTransportException, socket.error,
+                    httplib.HTTPException)
+
+class PersistentHttpTransport(TTransport.TTransportBase):
+    """Thrift HTTP client transport, keeping its connection open.
+
+    :param url: Service URL.
+    :param timeout: Socket timeout in seconds, or None.
+    """
+
+    def __init__(self, url, timeout=None):
+        parsed = urlparse.urlparse(url)
+        self.scheme = parsed.scheme
+        self.host = parsed.hostname
+        self.port = parsed.port
+        self.path = parsed.path or '/'
+        if parsed.query:
+            self.path += '?' + parsed.query
+        self.timeout = timeout
+        self._headers = dict()
+        self._connection = None
+        self._wbuf = StringIO()
+        self._rbuf = StringIO()
+        # Calls made on the current connection
+        self.calls = 0
+
+    def addHeaders(self, **headers):
+        self._headers.update(headers)
+
+    def isOpen(self):
+        return self._connection is not None
+
+    def open(self):
+        if 'https' == self.scheme:
+            connection_class = httplib.HTTPSConnection
+        else:
+            connection_class = httplib.HTTPConnection
+        self._connection = connection_class(self.host, self.port,
+                                            timeout=self.timeout)
+        self.calls = 0
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def read(self, sz):
+        return self._rbuf.read(sz)
+
+    def write(self, buf):
+        self._wbuf.write(buf)
+
+    def _send(self, data):
+        headers = dict(self._headers)
+        headers['Content-Type'] = 'application/x-thrift'
+        self._connection.request('POST', self.path, data, headers)
+
+    def flush(self):
+        data = self._wbuf.getvalue()
+        self._wbuf = StringIO()
+        if not self.isOpen():
+            self.open()
+        try:
+            try:
+                self._send(data)
+            except (socket.error, httplib.HTTPException):
+                self.close()
+                if not self.calls:
+                    raise
+                # The server may have closed the kept connection before
+                #  the request was sent, retry once
+                logger.debug('Reconnecting to %s', self.host)
+                self.open()
+                self._send(data)
+            response = self._connection.getresponse()
+            body = response.read()
+        except (socket.error, httplib.HTTPException):
+            self.close()
+            raise
+        self.calls += 1
+        if response.will_close:
+            self.close()
+        if 200 != response.status:
+            raise TTransport.TTransportException(
+                message='HTTP %d %s' % (response.status, response.reason))
+        self._rbuf = StringIO(body)
+
+class PersistentStore(Store):
+    """Evernote `Store` keeping its HTTP connection open between calls."""
+
+    def _get_thrift_client(self, client_class, url):
+        transport = PersistentHttpTransport(url)
+        transport.addHeaders(**{
+            'User-Agent': '%s / %s; Python / %s;' % (
+                self._user_agent_id, self._get_sdk_version(),
+                sys.version.replace('\n', ''))})
+        return client_class(TBinaryProtocol.TBinaryProtocol(transport))
+
+    def close(self):
+        """Close the HTTP connection (reopened on the next call)."""
+        self._client._oprot.trans.close()
+
+class NoteStorePool(object):
+    """Pool of NoteStore clients, checked out by threads for API calls.
+
+    :param factory: Function returning a new NoteStore client.
+                    Clients are expected to have a `close` method,
+                    closing their connection.
+    :param max_size: Maximal number of clients. Threads checking out
+                     a client when all the clients are checked out wait
+                     for a client to be returned.
+    :param max_idle: Seconds after which the connection of an idle client
+                     is closed before the client is reused.
+    """
+
+    def __init__(self, factory, max_size=4, max_idle=60.0):
+        self.factory = factory
+        self.max_size = max(1, max_size)
+        self.max_idle = max_idle
+        self.size = 0
+        self.created = 0
+        self.discarded = 0
+        # Idle clients, as (client, time returned) tuples, last returned last
+        self._idle = list()
+        self._cond = threading.Condition()
+        self._local = threading.local()
+
+    def current(self):
+        """Return the client checked out by the calling thread, or None."""
+        return getattr(self._local, 'client', None)
+
+    def _acquire(self):
+        with self._cond:
+            while not self._idle and self.size >= self.max_size:
+                self._cond.wait()
+            if self._idle:
+                client, returned = self._idle.pop()
+                if time.time() - returned > self.max_idle:
+                    client.close()
+                return client
+            self.size += 1
+        try:
+            client = self.factory()
+        except Exception:
+            with self._cond:
+                self.size -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self.created += 1
+        return client
+
+    def _release(self, client, healthy):
+        with self._cond:
+            if healthy:
+                self._idle.append((client, time.time()))
+            else:
+                self.size -= 1
+                self.discarded += 1
+            self._cond.notify()
+        if not healthy:
+            client.close()
+
+    @contextmanager
+    def checkout(self):
+        """Context manager checking out a client for the calling thread."""
+        client = self.current()
+        if client is not None:
+            yield client
+            return
+        client = self._local.client = self._acquire()
+        healthy = True
+        try:
+            yield client
+        except TRANSPORT_ERRORS:
+            logger.debug('Discarding a NoteStore client failing on transport')
+            healthy = False
+            raise
+        finally:
+            self._local.client = None
+            self._release(client, healthy)
+
+    def close(self):
+        """Close the connections of the idle clients."""
+        with self._cond:
+            for client, _ in self._idle:
+                client.close()
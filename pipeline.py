@@ -0,0 +1,115 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Pipelines of processing stages, run by worker threads.
+
+Every stage has its own worker threads, connected to the next stage by
+a bounded queue, so that (for example) downloads and uploads overlap.
+The results of the first stage hold bytes of a byte budget until the last
+stage is done with them, so a pipeline keeps a steady memory use however
+many items it processes.
+"""
+
+import Queue
+import threading
+
+import common
+
+logger = common.logger.getChild('pipeline')
+
+class ByteBudget(object):
+    """Budget of bytes held by items in flight.
+
+    :param max_bytes: Bytes of items in flight, over which acquiring
+                      more bytes waits for bytes to be released.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.in_flight = 0
+        self.peak = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, size):
+        with self._cond:
+            # An item larger than the whole budget is let through alone
+            while self.in_flight and self.in_flight + size > self.max_bytes:
+                self._cond.wait()
+            self.in_flight += size
+            self.peak = max(self.peak, self.in_flight)
+
+    def release(self, size):
+        with self._cond:
+            self.in_flight -= size
+            self._cond.notify_all()
+
+class Pipeline(object):
+    """Pipeline of processing stages, run by worker threads.
+
+    :param stages: List of (name, function, workers) tuples.
+                   A stage function is called with the result of the previous
+                   stage (or with a source item, for the first stage),
+                   and returns the result for the next stage, or `None`
+                   to drop the item. Failed items are reported and dropped.
+    :param max_bytes: Byte budget of the first stage results.
+    :param sizeof: Function returning the bytes of a first stage result.
+    """
+
+    def __init__(self, stages, max_bytes, sizeof=len):
+        self.stages = stages
+        self.budget = ByteBudget(max_bytes)
+        self.sizeof = sizeof
+        self.done = 0
+        self._done_lock = threading.Lock()
+
+    def _work(self, index, in_queue, out_queue):
+        name, func, _ = self.stages[index]
+        while True:
+            entry = in_queue.get()
+            if entry is None:
+                break
+            item, size = entry
+            try:
+                result = func(item)
+            except Exception:
+                logger.exception('Failed %s of %s', name, item)
+                result = None
+            if result is not None and 0 == index:
+                size = self.sizeof(result)
+                self.budget.acquire(size)
+            if result is not None and out_queue is not None:
+                out_queue.put((result, size))
+                continue
+            self.budget.release(size)
+            if result is not None:
+                with self._done_lock:
+                    self.done += 1
+
+    def run(self, items):
+        """Process source `items` through all stages,
+        and return the number of items done by the last stage."""
+        queues = [Queue.Queue(workers * 2) for _, _, workers in self.stages]
+        stage_threads = list()
+        for index, (name, _, workers) in enumerate(self.stages):
+            out_queue = index + 1 < len(queues) and queues[index + 1] or None
+            threads = list()
+            for num in xrange(workers):
+                thread = threading.Thread(
+                    target=self._work, args=(index, queues[index], out_queue),
+                    name='%s-%d' % (name, num))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+            stage_threads.append(threads)
+        try:
+            for item in items:
+                queues[0].put((item, 0))
+        finally:
+            # Stop every stage after the previous one is done
+            for stage_queue, threads in zip(queues, stage_threads):
+                for _ in threads:
+                    stage_queue.put(None)
+                for thread in threads:
+                    thread.join()
+        logger.debug('Pipeline done with %d items, peak %d bytes in flight',
+                     self.done, self.budget.peak)
+        return self.done
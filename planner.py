@@ -0,0 +1,171 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Cost plans of commands over the notes of an Evernote query.
+
+A plan predicts the API calls, bytes and time of running a command,
+per note and in total, from the note metadata of the query alone,
+so it is cheap to make before a big `sync --force` or `preprocess` run.
+
+The actions of a command on a note are estimated from the note metadata:
+a note with resources is an image note when synced without preprocessing,
+and a post note with an embedded image to extract otherwise.
+Resource transfers are estimated by the size of the largest resource.
+Without `--force`, notes that were not updated are skipped by sync,
+so the plan is an upper bound.
+"""
+
+import json
+from collections import namedtuple
+
+import common
+
+logger = common.logger.getChild('planner')
+
+# Estimated API calls and resource transfers of the actions of commands,
+#  as (Evernote calls, WordPress calls, resource transfers)
+ACTION_COSTS = {
+    # Get the note
+    'fetch': (1, 0, 0),
+    # Post a new stub, get, edit and get the post, update the note metadata
+    'post': (1, 4, 0),
+    # Fetch and upload the image, get and edit it, update the note metadata
+    'post_image': (2, 3, 2),
+    # Fetch the embedded image, create an image note, update the post note
+    'extract_image': (3, 0, 2),
+    }
+
+# Mean API call latencies in seconds, without metrics of a previous run
+DEFAULT_LATENCIES = {'evernote': 0.3, 'wordpress': 0.5}
+
+NoteCost = namedtuple('NoteCost', ['offset', 'guid', 'title', 'actions',
+                                   'evernote_calls', 'wordpress_calls',
+                                   'bytes'])
+
+def note_actions(phase, note, preprocess=False):
+    """Return the list of actions of `phase` command on a note."""
+    has_resources = bool(note.largestResourceSize)
+    actions = ['fetch']
+    if has_resources and (preprocess or 'preprocess' == phase):
+        actions.append('extract_image')
+        if 'sync' == phase:
+            # Post the extracted image note, referenced by the post
+            actions.extend(['fetch', 'post_image'])
+    if 'sync' == phase:
+        if has_resources and not preprocess:
+            actions.append('post_image')
+        else:
+            actions.append('post')
+    return actions
+
+def note_cost(phase, offset, note, preprocess=False):
+    """Return the estimated NoteCost of `phase` command on a note."""
+    actions = note_actions(phase, note, preprocess)
+    evernote_calls = sum(ACTION_COSTS[action][0] for action in actions)
+    wordpress_calls = sum(ACTION_COSTS[action][1] for action in actions)
+    transfers = sum(ACTION_COSTS[action][2] for action in actions)
+    size = ((note.contentLength or 0) +
+            transfers * (note.largestResourceSize or 0))
+    return NoteCost(offset, note.guid, note.title, actions, evernote_calls,
+                    wordpress_calls, size)
+
+def load_latencies(metrics_json_path):
+    """Return mean API call latencies by service, from a metrics JSON file
+    of a previous run (see `--metrics_json`), and defaults otherwise."""
+    latencies = dict(DEFAULT_LATENCIES)
+    with open(metrics_json_path) as metrics_file:
+        methods = json.load(metrics_file)['methods']
+    for service in latencies:
+        calls = [method for method in methods
+                 if service == method['service']]
+        count = sum(method['count'] for method in calls)
+        if count:
+            latencies[service] = (sum(method['latency_sum']
+                                      for method in calls) / count)
+    logger.debug('Mean API call latencies: %s', latencies)
+    return latencies
+
+class Plan(object):
+    """Cost plan of a command over the notes of a query.
+
+    :param phase: Command to plan ('sync' or 'preprocess').
+    :param query: Evernote query of the notes.
+    :param page_size: Notes per listing call.
+    :param preprocess: Whether sync preprocesses notes too.
+    """
+
+    def __init__(self, phase, query, page_size=100, preprocess=False):
+        self.phase = phase
+        self.query = query
+        self.page_size = page_size
+        self.preprocess = preprocess
+        self.notes = list()
+
+    def add_notes(self, notes):
+        """Add the costs of notes, given as (offset, note metadata) tuples."""
+        for offset, note in notes:
+            self.notes.append(note_cost(self.phase, offset, note,
+                                        self.preprocess))
+        return self
+
+    @property
+    def listing_calls(self):
+        return max(1, -(-len(self.notes) // self.page_size))
+
+    @property
+    def evernote_calls(self):
+        return self.listing_calls + sum(cost.evernote_calls
+                                        for cost in self.notes)
+
+    @property
+    def wordpress_calls(self):
+        return sum(cost.wordpress_calls for cost in self.notes)
+
+    @property
+    def bytes(self):
+        return sum(cost.bytes for cost in self.notes)
+
+    def runs(self, budget, quota):
+        """Return the number of notes of every run of a split plan,
+        where the first run is within the Evernote calls `budget`
+        left in the current hour, and the next ones within the hourly
+        `quota`."""
+        runs = list()
+        calls, count, limit = 0, 0, budget
+        for index, cost in enumerate(self.notes):
+            note_calls = cost.evernote_calls
+            if 0 == index % self.page_size:
+                note_calls += 1
+            if count and calls + note_calls > limit:
+                runs.append(count)
+                calls, count, limit = 0, 0, quota
+            calls += note_calls
+            count += 1
+        if count or not runs:
+            runs.append(count)
+        return runs
+
+    def seconds(self, budget, quota, latencies=None):
+        """Return the expected run time in seconds, including waiting
+        for the hourly quota when the budget is exceeded."""
+        latencies = latencies or DEFAULT_LATENCIES
+        seconds = (self.evernote_calls * latencies['evernote'] +
+                   self.wordpress_calls * latencies['wordpress'])
+        return seconds + 3600 * (len(self.runs(budget, quota)) - 1)
+
+    def report(self, budget, quota, latencies=None):
+        """Return a list of report lines, of every note and in total."""
+        lines = ['Plan of %s "%s": %d notes' % (self.phase, self.query,
+                                               len(self.notes)),
+                 '%6s %8s %9s %10s  %s' % ('offset', 'evernote',
+                                          'wordpress', 'bytes', 'title')]
+        for cost in self.notes:
+            lines.append('%6d %8d %9d %10d  %s' % (
+                cost.offset, cost.evernote_calls, cost.wordpress_calls,
+                cost.bytes, cost.title))
+        lines.append(
+            'Total: %d Evernote calls (%d listing), %d WordPress calls, '
+            '%.1f KB, about %.1f minutes' % (
+                self.evernote_calls, self.listing_calls,
+                self.wordpress_calls, self.bytes / 1024.0,
+                self.seconds(budget, quota, latencies) / 60))
+        return lines
@@ -0,0 +1,198 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Profiling of tool commands.
+
+Runs a command under cProfile, or under a sampling profiler, and writes:
+- `<prefix>.pstats` - cProfile statistics (cProfile mode only),
+  for use with `pstats` or tools like snakeviz.
+- `<prefix>.collapsed` - sampled stacks in collapsed format
+  ("frame;frame;frame count" lines), for use with flamegraph.pl
+  or speedscope.
+
+Both modes sample stacks, since cProfile profiles only the calling thread,
+and the sampler sees all threads (e.g. concurrent note fetching).
+
+After the run, a short summary is logged, separating wall time spent
+in network calls (per API method, from the metrics registry, and by
+profiled function) from CPU time spent in parsing, rendering and the
+rest of the program.
+"""
+
+import os
+import sys
+import time
+import pstats
+import cProfile
+import threading
+from collections import Counter
+
+import common
+import metrics
+
+logger = common.logger.getChild('profiling')
+
+# Modules and builtins whose time is spent waiting for the network
+_NETWORK_MODULES = ('socket.py', 'ssl.py', 'httplib.py')
+_NETWORK_BUILTINS = ('_socket', '_ssl', 'select', 'time.sleep')
+
+def _is_network_function(filename, funcname):
+    if os.path.basename(filename) in _NETWORK_MODULES:
+        return True
+    return '~' == filename and any(name in funcname
+                                   for name in _NETWORK_BUILTINS)
+
+class StackSampler(object):
+    """Samples the stacks of all threads (except itself) periodically.
+
+    :param interval: Seconds between samples.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def _frame_label(frame):
+        code = frame.f_code
+        return '%s (%s:%d)' % (code.co_name,
+                               os.path.basename(code.co_filename),
+                               code.co_firstlineno)
+
+    def _sample(self):
+        thread_names = dict((thread.ident, thread.name)
+                            for thread in threading.enumerate())
+        for ident, frame in sys._current_frames().iteritems():
+            if ident == self._thread.ident:
+                continue
+            stack = list()
+            while frame is not None:
+                stack.append(self._frame_label(frame))
+                frame = frame.f_back
+            stack.append(thread_names.get(ident, 'thread-%d' % (ident)))
+            self.stacks[';'.join(reversed(stack))] += 1
+        self.samples += 1
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run,
+                                        name='stack-sampler')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def write_collapsed(self, path):
+        with open(path, 'w') as collapsed_file:
+            for stack, count in sorted(self.stacks.iteritems()):
+                collapsed_file.write('%s %d\n' % (stack, count))
+
+    def leaf_counts(self):
+        """Return (network, cpu) Counters of samples by leaf frame,
+        excluding idle threads waiting in the thread pool or the sampler.
+        """
+        network, cpu = Counter(), Counter()
+        for stack, count in self.stacks.iteritems():
+            leaf = stack.rsplit(';', 1)[-1]
+            name, _, location = leaf.partition(' (')
+            filename = location.split(':')[0]
+            if 'threading.py' == filename or 'Queue.py' == filename:
+                continue
+            if filename in _NETWORK_MODULES:
+                network[leaf] += count
+            else:
+                cpu[leaf] += count
+        return network, cpu
+
+def _format_top(title, items, total, unit):
+    lines = ['%s:' % (title)]
+    for name, value in items:
+        lines.append('  %8.2f%s %5.1f%%  %s' % (
+            value, unit, total and 100.0 * value / total or 0.0, name))
+    return lines
+
+def _summary(mode, wall, cpu, sampler, profiler, top):
+    lines = ['Profile summary (%s): %.2fs wall time, %.2fs CPU time' %
+             (mode, wall, cpu)]
+    api_metrics = metrics.registry.snapshot()
+    api_wall = sum(data['latency_sum'] for _, _, data in api_metrics)
+    lines.append('API calls: %.2fs wall time in %d calls' % (
+        api_wall, sum(data['count'] for _, _, data in api_metrics)))
+    for service, method, data in sorted(
+            api_metrics, key=lambda entry: -entry[2]['latency_sum'])[:top]:
+        lines.append('  %8.2fs %6d calls  %s.%s' % (
+            data['latency_sum'], data['count'], service, method))
+    if profiler:
+        stats = pstats.Stats(profiler)
+        network, other = list(), list()
+        for (filename, lineno, funcname), stat in stats.stats.iteritems():
+            tottime = stat[2]
+            name = '%s (%s:%d)' % (funcname, os.path.basename(filename),
+                                   lineno)
+            if _is_network_function(filename, funcname):
+                network.append((name, tottime))
+            else:
+                other.append((name, tottime))
+        network_time = sum(t for _, t in network)
+        lines.extend(_format_top(
+            'Network wait (main thread): %.2fs, by function' % (network_time),
+            sorted(network, key=lambda entry: -entry[1])[:top],
+            wall, 's'))
+        lines.extend(_format_top(
+            'CPU (main thread): %.2fs, top functions by own time' %
+            (sum(t for _, t in other)),
+            sorted(other, key=lambda entry: -entry[1])[:top], wall, 's'))
+    network, cpu = sampler.leaf_counts()
+    total = sum(network.values()) + sum(cpu.values())
+    lines.extend(_format_top(
+        'Sampled network wait (all threads): %d of %d samples' %
+        (sum(network.values()), total), network.most_common(top),
+        total, ' '))
+    lines.extend(_format_top(
+        'Sampled CPU (all threads): %d of %d samples' %
+        (sum(cpu.values()), total), cpu.most_common(top), total, ' '))
+    return lines
+
+def run(func, mode='cprofile', prefix='tomato-profile', top=15,
+        interval=0.005):
+    """Run `func` under a profiler, write profile files and log a summary.
+
+    :param func: Callable to run, with no arguments.
+    :param mode: 'cprofile' (deterministic, with stack sampling),
+                 or 'sample' (stack sampling only).
+    :param prefix: Path prefix for the profile output files.
+    :param top: Number of entries in each summary list.
+    :param interval: Seconds between stack samples.
+    :return: The return value of `func`.
+    """
+    if mode not in ('cprofile', 'sample'):
+        raise ValueError('Invalid profiler mode "%s"' % (mode))
+    profiler = 'cprofile' == mode and cProfile.Profile() or None
+    sampler = StackSampler(interval).start()
+    start_wall, start_times = time.time(), os.times()
+    try:
+        if profiler:
+            return profiler.runcall(func)
+        return func()
+    finally:
+        wall = time.time() - start_wall
+        end_times = os.times()
+        cpu = sum(end_times[:2]) - sum(start_times[:2])
+        sampler.stop()
+        outputs = list()
+        if profiler:
+            profiler.dump_stats(prefix + '.pstats')
+            outputs.append(prefix + '.pstats')
+        sampler.write_collapsed(prefix + '.collapsed')
+        outputs.append(prefix + '.collapsed')
+        for line in _summary(mode, wall, cpu, sampler, profiler, top):
+            logger.info(line)
+        logger.info('Profile written to %s', ', '.join(outputs))
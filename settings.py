@@ -17,6 +17,51 @@ WORDPRESS = {
     'default': 'my-wp-site',
     }
 
+# ID map file of every mirror WordPress site (`sync --mirror SITE`),
+# keeping the IDs of the items posted to it, by site name
+WORDPRESS_ID_MAP_PATH = 'tomato-ids-%s.json'
+
+# Evernote service host name or URL, or None for the Evernote service
+# (e.g. 'http://localhost:8880' for a local stand-in service started with
+#  `python -m benchmarks.servers`)
+EVERNOTE_SERVICE_HOST = None
+
+# Evernote API calls allowed per hour, for plans (`plan`, `sync --plan`).
+# Evernote doesn't publish its rate limits, so this is an estimate.
+EVERNOTE_HOURLY_QUOTA = 1000
+
+# Maximal number of Evernote NoteStore clients (and connections), for API
+# calls from several threads in parallel
+EVERNOTE_POOL_SIZE = 4
+
+# Listing page sizes of queries, adapted to the listing calls of every run
+EVERNOTE_PAGE_SIZES_PATH = 'tomato-page-sizes.json'
+
+# Update sequence numbers of detached notes, to skip them in later detaches
+DETACHED_NOTES_PATH = 'tomato-detached.json'
+
+# References between posted notes, to republish the notes referring to a note
+# posted with a new ID or link
+BACKLINKS_PATH = 'tomato-backlinks.json'
+
+# Fingerprints of the items published from notes, to skip publishing notes
+# whose items would not change
+FINGERPRINTS_PATH = 'tomato-fingerprints.json'
+
+# Directory of the local caches, with the compressed bytes of all the cached
+# values over which the least recently used values are evicted, and the days
+# after which cached values are evicted (`cache prune`)
+CACHE_PATH = 'tomato-cache'
+CACHE_MAX_MB = 1024
+CACHE_MAX_AGE_DAYS = 30
+
+# Write log file (tomato-cmd.log) records as JSON objects, one per line
+LOG_JSON = False
+
+# XML parsing backend for note content ('lxml' or 'stdlib'),
+# or None to use the best available backend
+XML_BACKEND = None
+
 try:
     from local_settings import *
 except ImportError:
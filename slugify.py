@@ -36,7 +36,7 @@ source: https://github.com/un33k/python-slugify
 
 __version__ = '0.0.7'
 
-__all__ = ['slugify']
+__all__ = ['slugify', 'slugify_many']
 
 import re
 import unicodedata
@@ -45,8 +45,8 @@ import sys
 from htmlentitydefs import name2codepoint
 from unidecode import unidecode
 
-# character entity reference
-CHAR_ENTITY_REXP = re.compile('&(%s);' % '|'.join(name2codepoint))
+# character entity reference, decoded by name2codepoint lookup
+CHAR_ENTITY_REXP = re.compile(r'&(\w+);')
 
 # decimal character reference
 DECIMAL_REXP = re.compile('&#(\d+);')
@@ -58,6 +58,10 @@ REPLACE1_REXP = re.compile(r'[\']+')
 REPLACE2_REXP = re.compile(r'[^-a-z0-9]+')
 REMOVE_REXP = re.compile('-{2,}')
 
+# memoized slugs by (text, options), cleared when full
+_slugs = {}
+_SLUGS_MAX = 4096
+
 def smart_truncate(string, max_length=0, word_boundaries=False, separator=' '):
     """ Truncate a string """
 
@@ -86,8 +90,43 @@ def smart_truncate(string, max_length=0, word_boundaries=False, separator=' '):
     return truncated.strip(separator)
 
 
+def _decode_entity(match):
+    """ Decode a character entity reference, leaving unknown names as is """
+    codepoint = name2codepoint.get(match.group(1))
+    if codepoint is None:
+        return match.group(0)
+    return unichr(codepoint)
+
+
 def slugify(text, entities=True, decimal=True, hexadecimal=True, max_length=0,
             word_boundary=False, separator='-'):
+    """ Make a slug from the given text (memoized) """
+
+    key = (text, entities, decimal, hexadecimal, max_length, word_boundary,
+           separator)
+    slug = _slugs.get(key)
+    if slug is None:
+        if len(_slugs) >= _SLUGS_MAX:
+            _slugs.clear()
+        slug = _slugs[key] = _slugify(text, entities, decimal, hexadecimal,
+                                      max_length, word_boundary, separator)
+    return slug
+
+
+def slugify_many(texts, **options):
+    """ Make a list of slugs from the given texts, slugifying every
+    distinct text once """
+
+    texts = list(texts)
+    slugs = {}
+    for text in texts:
+        if text not in slugs:
+            slugs[text] = slugify(text, **options)
+    return [slugs[text] for text in texts]
+
+
+def _slugify(text, entities, decimal, hexadecimal, max_length, word_boundary,
+             separator):
     """ Make a slug from the given text """
 
     # text to unicode
@@ -103,8 +142,7 @@ def slugify(text, entities=True, decimal=True, hexadecimal=True, max_length=0,
 
     # character entity reference
     if entities:
-        text = CHAR_ENTITY_REXP.sub(lambda m:
-                                    unichr(name2codepoint[m.group(1)]), text)
+        text = CHAR_ENTITY_REXP.sub(_decode_entity, text)
 
     # decimal character reference
     if decimal:
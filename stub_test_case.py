@@ -0,0 +1,71 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Base test case of tests working with the in-process stand-ins for the
+Evernote and WordPress APIs, over a generated note corpus."""
+
+import unittest
+
+from mock import patch
+
+import planner
+import pipeline
+import wordpress
+import checkpoint
+import my_evernote
+import wordpress_evernote
+from my_evernote import EvernoteApiWrapper
+from wordpress_evernote import EvernoteWordpressAdaptor
+from benchmarks import stubs
+from benchmarks.corpus import generate_corpus
+
+class StubServicesTestCase(unittest.TestCase):
+    """Test case with fake Evernote and WordPress services.
+
+    The notes cached by the Evernote API wrapper (in a class attribute) are
+    cleared before and after every test, and the module loggers are mocked.
+    """
+
+    # Modules whose loggers are mocked
+    logged_modules = (checkpoint, my_evernote, pipeline, planner, wordpress,
+                      wordpress_evernote)
+
+    # Corpus parameters (see `generate_corpus`) of a small corpus
+    corpus_params = dict(paragraphs=1, fanout=0, images=0, embedded_images=0,
+                         projects=0)
+
+    def setUp(self):
+        EvernoteApiWrapper._cache.clear()
+        self.addCleanup(EvernoteApiWrapper._cache.clear)
+        for module in self.logged_modules:
+            patcher = patch.object(module, 'logger')
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def make_corpus(self, **params):
+        """Generate a corpus (by default, a small one), and return it.
+
+        The fake services, working with the corpus notes, are set as
+        `note_store`, `user_store` and `wp_site`.
+        """
+        self.corpus = generate_corpus(**dict(self.corpus_params, **params))
+        self.note_store = stubs.FakeNoteStore(self.corpus)
+        self.user_store = stubs.FakeUserStore()
+        self.wp_site = stubs.FakeWordPressSite()
+        return self.corpus
+
+    def evernote_wrapper(self):
+        """Return a new Evernote API wrapper working with `note_store`."""
+        return stubs.FakeEvernoteApiWrapper(self.note_store, self.user_store)
+
+    def wordpress_wrapper(self, site=None):
+        """Return a new WordPress API wrapper working with a fake site
+        (by default, `wp_site`)."""
+        return stubs.FakeWordPressApiWrapper(
+            self.wp_site if site is None else site)
+
+    def make_adaptor(self, with_wordpress=True, **kwargs):
+        """Return a new adaptor working with the fake services,
+        or (unless `with_wordpress`) with the Evernote service only."""
+        return EvernoteWordpressAdaptor(
+            self.evernote_wrapper(),
+            self.wordpress_wrapper() if with_wordpress else None, **kwargs)
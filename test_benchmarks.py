@@ -0,0 +1,174 @@
+import unittest
+import argparse
+import random
+import xmlrpclib
+from StringIO import StringIO
+from multiprocessing.pool import ThreadPool
+from mock import patch
+
+import evernote.edam.error.ttypes as Errors
+from wordpress_xmlrpc import WordPressPost as XmlRpcPost
+
+import my_evernote
+from my_evernote import EvernoteApiWrapper
+from wordpress import WordPressApiWrapper
+from benchmarks import bench_sync, bench_startup, stubs, servers
+from stub_test_case import StubServicesTestCase
+
+class TestSyncBenchmark(StubServicesTestCase):
+
+    # The benchmark counts the errors logged by the adaptor
+    logged_modules = (my_evernote,)
+
+    def setUp(self):
+        StubServicesTestCase.setUp(self)
+        self.make_corpus(posts=4, paragraphs=3, fanout=2, images=1,
+                         embedded_images=1, image_size=64, projects=1)
+        self.args = argparse.Namespace(jobs=1, no_marshal=False)
+
+    def run_phase(self, name):
+        return bench_sync.run_phase(name, self.corpus, self.note_store,
+                                    self.user_store, self.wp_site, self.args)
+
+    def test_corpus(self):
+        self.assertEqual(4, self.corpus.count('post'))
+        self.assertEqual(4, self.corpus.count('embedded'))
+        self.assertEqual(4, self.corpus.count('image'))
+        self.assertEqual(1, self.corpus.count('page'))
+
+    def test_phases(self):
+        preprocess = self.run_phase('preprocess')
+        self.assertEqual(0, preprocess['errors'])
+        self.assertEqual(4, preprocess['evernote_calls']['createNote'])
+        sync = self.run_phase('sync')
+        self.assertEqual(0, sync['errors'])
+        # 4 posts, 1 page, 4 linked and 4 extracted images
+        self.assertEqual(13, len(self.wp_site.posts))
+        self.assertEqual(8, sync['wordpress_calls']['uploadFile'])
+        self.assertLess(0, sync['wordpress_bytes'])
+        detach = self.run_phase('detach')
+        self.assertEqual(0, detach['errors'])
+        self.assertEqual(4, detach['evernote_calls']['updateNote'])
+
+    def test_compare_run_peak_rss(self):
+        def results(notes_per_sec, peak_rss_mb):
+            return {'phase_order': ['sync'], 'peak_rss_mb': peak_rss_mb,
+                    'phases': {'sync': {'notes_per_sec': notes_per_sec,
+                                        'api_calls_per_note': 10.0}}}
+        with patch('sys.stdout', new_callable=StringIO):
+            self.assertListEqual([('run', 'peak_rss_mb')], bench_sync.compare(
+                results(100.0, 130.0), results(100.0, 100.0), 0.2))
+            self.assertListEqual([('sync', 'notes_per_sec')],
+                                 bench_sync.compare(results(70.0, 100.0),
+                                                    results(100.0, 100.0),
+                                                    0.2))
+
+class TestStartupBenchmark(unittest.TestCase):
+
+    def test_no_heavy_modules_at_import(self):
+        self.assertListEqual([], bench_startup.loaded_heavy_modules())
+
+class TestStandInServers(StubServicesTestCase):
+
+    def setUp(self):
+        StubServicesTestCase.setUp(self)
+        self.make_corpus(posts=2, fanout=1, images=1, image_size=64,
+                         projects=1)
+        self.servers = list()
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+    def start(self, server):
+        self.servers.append(servers.start_in_thread(server))
+        return server
+
+    def evernote_server(self, injector=None):
+        return self.start(servers.EvernoteServer(
+            ('localhost', 0), stubs.FakeNoteStore(self.corpus), injector))
+
+    def wordpress_server(self, injector=None):
+        return self.start(servers.WordPressServer(
+            ('localhost', 0), stubs.FakeWordPressSite(), injector))
+
+    def test_parse_latency(self):
+        rand = random.Random(0)
+        self.assertEqual(0.25, servers.parse_latency('fixed:0.25')(rand))
+        self.assertEqual(0.0, servers.parse_latency(None)(rand))
+        sample = servers.parse_latency('uniform:0.1,0.2')
+        for _ in xrange(10):
+            self.assertTrue(0.1 <= sample(rand) <= 0.2)
+        for spec in ('fixed', 'fixed:a', 'uniform:1', 'zipf:1'):
+            self.assertRaises(ValueError, servers.parse_latency, spec)
+
+    def test_rate_limit(self):
+        injector = servers.FaultInjector(rate_limit=2, rate_limit_period=60)
+        self.assertEqual(0, injector.rate_limit_wait())
+        self.assertEqual(0, injector.rate_limit_wait())
+        self.assertLess(0, injector.rate_limit_wait())
+        self.assertEqual(1, injector.rate_limited_calls)
+
+    def test_evernote_server(self):
+        server = self.evernote_server()
+        en_wrapper = EvernoteApiWrapper('token', service_host=server.url)
+        note, _ = self.corpus.notes[0]
+        fetched = en_wrapper.get_note(note.guid)
+        self.assertEqual(note.content, fetched.content.encode('utf-8'))
+        self.assertEqual(1, server.note_store.calls['getNote'])
+        self.assertEqual(1, server.user_store.calls['getNoteStoreUrl'])
+
+    def test_evernote_server_rate_limit(self):
+        server = self.evernote_server(servers.FaultInjector(rate_limit=1))
+        en_wrapper = EvernoteApiWrapper('token', service_host=server.url)
+        note, _ = self.corpus.notes[0]
+        pool = en_wrapper._note_stores
+        with self.assertRaises(Errors.EDAMSystemException) as cm:
+            with pool.checkout() as note_store:
+                note_store.getNote(note.guid, True, False, False, False)
+        self.assertEqual(Errors.EDAMErrorCode.RATE_LIMIT_REACHED,
+                         cm.exception.errorCode)
+        self.assertLess(0, cm.exception.rateLimitDuration)
+        # Service errors don't discard the client
+        self.assertEqual((1, 0), (pool.size, pool.discarded))
+
+    def test_evernote_server_parallel_calls(self):
+        server = self.evernote_server(servers.FaultInjector(
+            latency='fixed:0.02'))
+        en_wrapper = EvernoteApiWrapper('token', service_host=server.url,
+                                        pool_size=3)
+        guids = [note.guid for note, _ in self.corpus.notes]
+        workers = ThreadPool(4)
+        try:
+            notes = workers.map(en_wrapper.get_note, guids)
+        finally:
+            workers.close()
+        self.assertListEqual(guids, [note.guid for note in notes])
+        pool = en_wrapper._note_stores
+        self.assertLessEqual(pool.created, 3)
+        # Every call was made on a kept connection of a pooled client
+        self.assertEqual(len(guids),
+                         sum(note_store._client._oprot.trans._trans.calls
+                             for note_store, _ in pool._idle))
+
+    def test_wordpress_server(self):
+        server = self.wordpress_server()
+        wp_wrapper = WordPressApiWrapper(server.url, 'user', 'password')
+        post = XmlRpcPost()
+        post.title = 'Stand-in post'
+        post_id = int(wp_wrapper.new_post(post))
+        self.assertEqual('Stand-in post', wp_wrapper.get_post(post_id).title)
+        multicall = xmlrpclib.MultiCall(xmlrpclib.ServerProxy(server.url))
+        multicall.wp.getPost(0, 'user', 'password', post_id)
+        multicall.wp.getPost(0, 'user', 'password', post_id + 1)
+        results = multicall()
+        self.assertEqual(str(post_id), results[0]['post_id'])
+        self.assertRaises(xmlrpclib.Fault, lambda: results[1])
+
+    def test_wordpress_server_failure(self):
+        server = self.wordpress_server(servers.FaultInjector(failure_rate=1))
+        proxy = xmlrpclib.ServerProxy(server.url)
+        with self.assertRaises(xmlrpclib.ProtocolError) as cm:
+            proxy.mt.supportedMethods()
+        self.assertEqual(503, cm.exception.errcode)
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+import argparse
+from StringIO import StringIO
+from mock import patch
+
+import disk_cache
+import wordpress_evernote
+
+class TestDiskCache(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch('disk_cache.logger')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def open(self, max_bytes=1024 * 1024, **kwargs):
+        return disk_cache.DiskCache(self.path, max_bytes, **kwargs)
+
+    def files(self):
+        return sorted(name for name in os.listdir(self.path)
+                      if name.endswith('.z'))
+
+    def test_segmented_values(self):
+        cache = self.open(segment_size=64)
+        value = os.urandom(200)
+        cache.put('media', value)
+        cache.put(u'note-א', 'content ' * 100)
+        self.assertEqual(value, cache.get('media'))
+        self.assertEqual('content ' * 100, cache.get(u'note-א'))
+        self.assertIsNone(cache.get('missing'))
+        stats = cache.stats()
+        self.assertEqual(2, stats['values'])
+        self.assertEqual(len(self.files()), stats['segments'])
+        self.assertLess(4, stats['segments'])
+        # Compressible values are stored compressed
+        self.assertLess(stats['bytes'], stats['raw_bytes'])
+        # Replaced values leave no segments behind
+        cache.put('media', 'small')
+        self.assertEqual('small', cache.get('media'))
+        self.assertEqual(cache.stats()['segments'], len(self.files()))
+
+    def test_index_survives_reopen(self):
+        cache = self.open()
+        cache.put('kept', 'kept value')
+        cache.put('deleted', 'deleted value')
+        cache.delete('deleted')
+        # A journal record cut short by a crash is ignored
+        with open(os.path.join(self.path, 'index.log'), 'a') as journal:
+            journal.write('["partial", {"segm')
+        reopened = self.open()
+        self.assertEqual(1, len(reopened))
+        self.assertEqual('kept value', reopened.get('kept'))
+        self.assertNotIn('deleted', reopened)
+        # New records are appended after the index is rewritten
+        reopened.put('added', 'added value')
+        self.assertEqual('added value', self.open().get('added'))
+        reopened.save()
+        self.assertEqual(0, os.path.getsize(
+            os.path.join(self.path, 'index.log')))
+        self.assertEqual('kept value', self.open().get('kept'))
+
+    def test_evict_least_recently_used(self):
+        cache = self.open(max_bytes=2500)
+        values = dict((key, os.urandom(1000)) for key in 'abc')
+        with patch('time.time', return_value=100.0):
+            cache.put('a', values['a'])
+            cache.put('b', values['b'])
+        with patch('time.time', return_value=200.0):
+            cache.get('a')
+            cache.put('c', values['c'])
+        self.assertNotIn('b', cache)
+        self.assertEqual(values['a'], cache.get('a'))
+        self.assertLessEqual(cache.bytes, 2500)
+        self.assertEqual(2, len(self.files()))
+
+    def test_prune(self):
+        cache = self.open(max_age=3600)
+        with patch('time.time', return_value=1000.0):
+            cache.put('old', 'old value')
+        cache.put('new', 'new value')
+        open(os.path.join(self.path, 'orphan-0.z'), 'w').close()
+        self.assertEqual(1, cache.prune())
+        self.assertEqual(['new'], list(self.open()._entries))
+        self.assertEqual(1, len(self.files()))
+        self.assertEqual(1, cache.prune(max_bytes=0))
+        self.assertEqual(0, len(self.open()))
+
+    def test_verify(self):
+        cache = self.open()
+        cache.put('good', 'good value')
+        cache.put('bad', 'bad value')
+        bad_segment = cache._entries['bad']['segments'][0]
+        with open(os.path.join(self.path, bad_segment), 'wb') as segment:
+            segment.write('garbage')
+        open(os.path.join(self.path, 'orphan-0.z'), 'w').close()
+        problems = cache.verify()
+        self.assertEqual(2, len(problems))
+        self.assertIn('"bad"', problems[0])
+        self.assertEqual(2, len(cache.verify(repair=True)))
+        self.assertListEqual([], cache.verify())
+        self.assertEqual('good value', cache.get('good'))
+        self.assertNotIn('bad', cache)
+
+    def test_corrupt_value_dropped(self):
+        cache = self.open()
+        cache.put('key', 'value')
+        os.remove(os.path.join(self.path, self.files()[0]))
+        self.assertIsNone(cache.get('key'))
+        self.assertNotIn('key', self.open())
+
+    def test_value_replaced_while_read(self):
+        cache = self.open()
+        cache.put('key', 'old value')
+        read = cache._read
+        def replace_and_read(entry):
+            # Another thread stores a new value, removing the segments
+            cache.put('key', 'new value')
+            return read(entry)
+        with patch.object(cache, '_read', side_effect=replace_and_read):
+            self.assertIsNone(cache.get('key'))
+        self.assertEqual('new value', cache.get('key'))
+        self.assertEqual('new value', self.open().get('key'))
+
+    def test_cache_command(self):
+        cache = self.open()
+        cache.put('key', 'value')
+        with patch.object(wordpress_evernote, '_get_disk_cache',
+                          return_value=cache), \
+                patch('sys.stdout', new_callable=StringIO) as stdout:
+            for action in ('stats', 'verify'):
+                wordpress_evernote.cache(None, argparse.Namespace(
+                    action=action, repair=False))
+            wordpress_evernote.cache(None, argparse.Namespace(
+                action='prune', max_mb=0, max_age_days=None))
+        self.assertIn('1 values in 1 segments', stdout.getvalue())
+        self.assertIn('0 problems', stdout.getvalue())
+        self.assertIn('Evicted 1 values', stdout.getvalue())
+        self.assertEqual(0, len(cache))
+
+if __name__ == '__main__':
+    unittest.main()
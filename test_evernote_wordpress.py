@@ -1,18 +1,35 @@
 import unittest
 from mock import patch, Mock, MagicMock, call
 import os
+import json
+import shutil
+import tempfile
+import threading
+import time
+from xml.etree import ElementTree as ET
 from datetime import datetime
 import codecs
 
 import wordpress
 import wordpress_evernote
+import xml_backend
 from wordpress import WordPressPost, WordPressImageAttachment
 from wordpress import WordPressApiWrapper
 from my_evernote import EvernoteApiWrapper
 from wordpress_evernote import EvernoteWordpressAdaptor
+from wordpress_evernote import MirrorAdaptor, MultiSitePublisher
+from wordpress_evernote import NoteUpdateSession, NoteUpdateError
+from id_map import IdMap
+from backlinks import BacklinkIndex
+import common
+from checkpoint import Checkpoint
+from benchmarks import stubs
+from stub_test_case import StubServicesTestCase
 
 from collections import namedtuple
 
+import evernote.edam.error.ttypes as Errors
+
 EvernoteNotebook = namedtuple('EvernoteNotebook', ['guid', 'name'])
 
 class EvernoteNote(object):
@@ -146,6 +163,45 @@ class TestEvernoteWordPressParser(ElementTreeEqualExtension):
             expected_note.content)
         self.assertElementTreeEqual(expected_tree, normalized_tree)
     
+    def test_evernote_metadata_only_normalize(self):
+        for name, note in test_notes.iteritems():
+            full_tree = self.adaptor._parse_note_xml(note.content)
+            meta_tree = self.adaptor._parse_note_xml(note.content,
+                                                     metadata_only=True)
+            self.assertElementTreeEqual(
+                full_tree.find(".//div[@id='metadata']"),
+                meta_tree.find(".//div[@id='metadata']"), name)
+            self.assertEqual(0, len(meta_tree.find(".//div[@id='content']")))
+    
+    def test_concurrent_parses(self):
+        contents = [note.content for note in test_notes.itervalues()]
+        expected = [ET.tostring(self.adaptor._parse_note_xml(content))
+                    for content in contents]
+        results = list()
+        def parse_all():
+            for _ in xrange(10):
+                results.append([ET.tostring(self.adaptor._parse_note_xml(
+                    content)) for content in contents])
+        threads = [threading.Thread(target=parse_all) for _ in xrange(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(40, len(results))
+        for parsed in results:
+            self.assertListEqual(expected, parsed)
+    
+    def test_lazy_content_parse(self):
+        note = test_notes['project-page-with-id-nothumb']
+        fromstring = xml_backend.XmlBackend.fromstring
+        with patch.object(xml_backend.XmlBackend, 'fromstring', autospec=True,
+                          side_effect=fromstring) as mock_fromstring:
+            wp_post = self.adaptor.wp_item_from_note(note.guid)
+            self.assertEqual(583, wp_post.id)
+            self.assertFalse(mock_fromstring.called)
+            self.assertEqual('Nothing to see here.', wp_post.content)
+            self.assertEqual(1, mock_fromstring.call_count)
+    
     def test_evernote_image_parser(self):
         note = test_notes['image-with-id']
         wp_image = self.adaptor.wp_item_from_note(note.guid)
@@ -332,6 +388,115 @@ class TestEvernoteWordPressParser(ElementTreeEqualExtension):
         self.assertListEqual(expected_content_lines,
                              wp_post.content.split('\n'))
 
+class TestNoteParserWorker(unittest.TestCase):
+    @patch('my_evernote.EvernoteApiWrapper._init_en_client')
+    def setUp(self, mock_init_en_client):
+        wordpress.logger = Mock()
+        wordpress_evernote.logger = Mock()
+        self.evernote = EvernoteApiWrapper(token='123')
+        self.evernote.get_note = MagicMock(side_effect=mocked_get_note)
+        self.adaptor = EvernoteWordpressAdaptor(self.evernote, None)
+    
+    def test_preparsed_post_note(self):
+        note = test_notes['note-with-id-thumbnail-attached-image-body-link']
+        parsed = wordpress_evernote._parse_note_worker(note.content)
+        self.assertEqual(3, len(parsed.links))
+        self.adaptor._parsed_notes[note.guid] = (note.content, parsed)
+        wp_post = self.adaptor.wp_item_from_note(note.guid)
+        self.assertDictEqual(dict(), self.adaptor._parsed_notes)
+        self.assertIsInstance(wp_post, WordPressPost)
+        self.assertEqual(544, wp_post.id)
+        self.assertListEqual(['Multiword, Tag','test-tag'], wp_post.tags)
+        self.assertIsInstance(wp_post.thumbnail, WordPressImageAttachment)
+        with open('test-data/post-content/post-note-1.md', 'r') as content_f:
+            expected_content = content_f.read()
+        self.assertListEqual(expected_content.split('\n'),
+                             wp_post.content.split('\n'))
+        self.assertEqual(2, len(wp_post._ref_wp_items))
+    
+    def test_stale_preparsed_note_ignored(self):
+        note = test_notes['project-page-with-id-nothumb']
+        parsed = wordpress_evernote._parse_note_worker(note.content)
+        self.adaptor._parsed_notes[note.guid] = ('<en-note/>', parsed)
+        wp_post = self.adaptor.wp_item_from_note(note.guid)
+        self.assertEqual('Nothing to see here.', wp_post.content)
+    
+    def test_preparse_notes_in_pool(self):
+        notes = [(offset, note) for offset, note in enumerate(
+            test_notes[key] for key in ('project-page-with-id-nothumb',
+                                        'project-note-with-id-nothumb',
+                                        'project-note-noid'))]
+        self.assertListEqual(notes,
+                             list(self.adaptor._preparse_notes(notes, 2)))
+        self.assertSetEqual(set(note.guid for _, note in notes),
+                            set(self.adaptor._parsed_notes))
+
+class TestReferenceGraph(StubServicesTestCase):
+    @patch('my_evernote.EvernoteApiWrapper._init_en_client')
+    def setUp(self, mock_init_en_client):
+        StubServicesTestCase.setUp(self)
+        self.evernote = EvernoteApiWrapper(token='123')
+        self.evernote.get_note = MagicMock(side_effect=mocked_get_note)
+        self.adaptor = EvernoteWordpressAdaptor(self.evernote, None)
+    
+    def test_reference_graph_levels_and_cycle(self):
+        post_guid = 'abcd1234-5678-abcd-7890-abcd1234abcd'
+        image_guid = 'abcd1234-1234-abcd-1234-abcd1234abcd'
+        project_note_guid = 'abcd1234-5678-0000-7890-abcd1234abcd'
+        project_page_guid = 'abcd1234-aaaa-0000-ffff-abcd1234abcd'
+        graph = self.adaptor.load_reference_graph(post_guid)
+        self.assertListEqual([[post_guid],
+                              [image_guid, project_note_guid],
+                              [project_page_guid]], graph.levels)
+        self.assertListEqual([image_guid, project_note_guid],
+                             graph.edges[post_guid])
+        self.assertListEqual([[post_guid, image_guid]], graph.find_cycles())
+        self.assertEqual(4, self.evernote.get_note.call_count)
+        # Parsed notes are reused when building the referenced items
+        self.assertIn(project_page_guid, self.adaptor._parsed_notes)
+        wp_page = self.adaptor.wp_item_from_note(project_page_guid)
+        self.assertNotIn(project_page_guid, self.adaptor._parsed_notes)
+        self.assertEqual('Nothing to see here.', wp_page.content)
+    
+    def test_reference_graph_max_depth(self):
+        post_guid = 'abcd1234-5678-abcd-7890-abcd1234abcd'
+        graph = self.adaptor.load_reference_graph(post_guid, max_depth=1)
+        self.assertListEqual([[post_guid],
+                              ['abcd1234-1234-abcd-1234-abcd1234abcd',
+                               'abcd1234-5678-0000-7890-abcd1234abcd']],
+                             graph.levels)
+        self.assertEqual(3, self.evernote.get_note.call_count)
+    
+    def test_publish_parses_note_once(self):
+        self.make_corpus(posts=1, paragraphs=2)
+        adaptor = self.make_adaptor()
+        backend = xml_backend.XmlBackend
+        with patch.object(backend, 'fromstring', autospec=True,
+                          side_effect=backend.fromstring) as fromstring, \
+                patch.object(backend, 'parse_until', autospec=True,
+                             side_effect=backend.parse_until) as parse_until:
+            adaptor.post_to_wordpress_from_note(self.note_store._order[0])
+        # The item is built from the note parsed by the reference graph
+        #  (and the note is parsed again to write its metadata)
+        self.assertEqual(2, fromstring.call_count)
+        self.assertFalse(parse_until.called)
+    
+    def test_sync_shares_reference_pool(self):
+        self.make_corpus(posts=3, fanout=2, projects=1)
+        adaptor = self.make_adaptor()
+        with patch('wordpress_evernote.ThreadPool',
+                   wraps=wordpress_evernote.ThreadPool) as thread_pool:
+            adaptor.sync('post')
+        thread_pool.assert_called_once_with(4)
+        self.assertIsNone(adaptor._reference_pool)
+    
+    def test_reference_graph_invalid_link(self):
+        graph = self.adaptor.load_reference_graph(
+            'aaff0101-4343-abac-9898-aaaaeeeecccc')
+        self.assertListEqual([['aaff0101-4343-abac-9898-aaaaeeeecccc']],
+                             graph.levels)
+        self.assertListEqual([], graph.find_cycles())
+
 class TestEvernoteWordPressPublisher(ElementTreeEqualExtension):
     
     @patch('my_evernote.EvernoteApiWrapper._init_en_client')
@@ -377,9 +542,8 @@ class TestEvernoteWordPressPublisher(ElementTreeEqualExtension):
             notebookGuid='abcd1234-5678-1928-7890-abcd1234abcd',
             content='published-project-note.xml')
         self.assertETfromStrEqual(expected_note.content, note.content)
-        self.evernote.updateNote.assert_has_calls(
-            [call(note),    # once for the stub creation
-             call(note)])   # once for metadata update
+        # Once for the stub creation and the metadata update
+        self.evernote.updateNote.assert_called_once_with(note)
         self.assertTrue(self.wordpress.edit_post.called)
     
     def test_upload_new_image_existing_parent(self):
@@ -506,3 +670,447 @@ class TestImageShortcodePostProcess(unittest.TestCase):
                      'columns="2" link="Lightbox" order="custom"]    ']
         wordpress_evernote.WpEnContent.post_process_content_lines(test_lines)
         self.assertListEqual(exp_lines, test_lines)
+
+class TestWatch(StubServicesTestCase):
+    
+    def setUp(self):
+        StubServicesTestCase.setUp(self)
+        corpus = self.make_corpus(posts=3, fanout=1, projects=1)
+        self.adaptor = self.make_adaptor()
+        self.edited_note, _ = corpus.notes[-1]
+    
+    def edit_note(self, unused_seconds):
+        if self.note_store.calls['getSyncState'] == 1:
+            note = self.note_store._notes[self.edited_note.guid]
+            note.content = note.content.replace(
+                '</en-note>', '<div>Edited paragraph</div></en-note>')
+            note.updated += 3600 * 1000
+            self.note_store._store(note)
+    
+    @patch('wordpress_evernote.time')
+    def test_watch(self, mock_time):
+        mock_time.sleep.side_effect = self.edit_note
+        self.adaptor.watch('post', min_interval=10, max_interval=15,
+                           rounds=4)
+        # Posted all notes, then the edited note (and notes updated by
+        #  posting) after a change, and backed off when nothing changed.
+        self.assertListEqual([call(10), call(10), call(15)],
+                             mock_time.sleep.call_args_list)
+        self.assertEqual(4, self.note_store.calls['getSyncState'])
+        self.assertEqual(2, self.note_store.calls['findNotesMetadata'])
+        self.assertTrue(any('Edited paragraph' in post['post_content']
+                            for post in self.wp_site.posts.itervalues()))
+
+class TestCheckpoint(StubServicesTestCase):
+    
+    def setUp(self):
+        StubServicesTestCase.setUp(self)
+        corpus = self.make_corpus(posts=5, projects=1)
+        self.note_guids = [note.guid for note, terms in corpus.notes
+                           if 'post' in terms]
+        self.adaptor = self.make_adaptor(with_wordpress=False)
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'checkpoint.json')
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+    
+    def detach(self, resume, query='post', side_effect=None, limit=None):
+        with patch.object(self.adaptor, 'update_note_metdata',
+                          side_effect=side_effect) as update:
+            self.adaptor.detach(query, Checkpoint(self.path, resume, limit))
+        return [args[0].guid for args, _ in update.call_args_list]
+    
+    def interrupt_after(self, count):
+        calls = [None] * count + [KeyboardInterrupt()]
+        self.assertRaises(KeyboardInterrupt, self.detach, False,
+                          side_effect=calls)
+        with open(self.path) as checkpoint_file:
+            saved = json.load(checkpoint_file)
+        self.assertEqual(('detach', 'post', count - 1),
+                         (saved['phase'], saved['query'], saved['offset']))
+    
+    def test_resume(self):
+        self.interrupt_after(2)
+        self.assertListEqual(self.note_guids[2:], self.detach(True))
+        self.assertFalse(os.path.exists(self.path))
+    
+    def test_resume_other_query(self):
+        self.interrupt_after(2)
+        self.assertListEqual(self.note_guids,
+                             self.detach(True, query='post post'))
+        self.assertFalse(os.path.exists(self.path))
+    
+    def test_resume_changed_results(self):
+        self.interrupt_after(2)
+        with open(self.path) as checkpoint_file:
+            saved = json.load(checkpoint_file)
+        saved['guid'] = self.note_guids[0]
+        with open(self.path, 'w') as checkpoint_file:
+            json.dump(saved, checkpoint_file)
+        self.assertListEqual(self.note_guids, self.detach(True))
+    
+    def test_no_resume(self):
+        self.interrupt_after(3)
+        self.assertListEqual(self.note_guids, self.detach(False))
+    
+    def test_limit(self):
+        self.assertListEqual(self.note_guids[:2], self.detach(False, limit=2))
+        self.assertTrue(os.path.exists(self.path))
+        self.assertListEqual(self.note_guids[2:4],
+                             self.detach(True, limit=2))
+        self.assertListEqual(self.note_guids[4:], self.detach(True, limit=2))
+        self.assertFalse(os.path.exists(self.path))
+
+class TestMultiSitePublisher(StubServicesTestCase):
+    
+    def setUp(self):
+        StubServicesTestCase.setUp(self)
+        corpus = self.make_corpus(posts=4, fanout=1, projects=1)
+        self.note_guids = [note.guid for note, terms in corpus.notes
+                           if 'post' in terms]
+        self.note_contents = [note.content for note, terms in corpus.notes
+                              if 'post' in terms]
+        en_wrapper = self.evernote_wrapper()
+        self.sites = [self.wp_site, stubs.FakeWordPressSite()]
+        # Advance the IDs of the mirror site
+        self.sites[1]._ids.next()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'ids.json')
+        shared_parses = dict()
+        self.publisher = MultiSitePublisher([
+            EvernoteWordpressAdaptor(
+                en_wrapper, self.wordpress_wrapper(), shared_parses),
+            MirrorAdaptor(
+                en_wrapper, self.wordpress_wrapper(self.sites[1]),
+                IdMap(self.path), shared_parses),
+            ], backlog=1)
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+    
+    @patch('wordpress_evernote._parse_note',
+           side_effect=wordpress_evernote._parse_note)
+    def test_sync(self, mock_parse):
+        self.publisher.sync('post')
+        primary_titles, mirror_titles = [
+            sorted(post['post_title'] for post in site.posts.itervalues())
+            for site in self.sites]
+        self.assertLess(len(self.note_guids), len(primary_titles))
+        self.assertListEqual(primary_titles, mirror_titles)
+        # Every note was parsed once, for both sites
+        parsed_contents = [args[0] for args, _ in mock_parse.call_args_list]
+        for content in self.note_contents:
+            self.assertEqual(1, parsed_contents.count(content))
+        # Mirror IDs are kept in the map, and primary IDs in the notes
+        with open(self.path) as map_file:
+            site_ids = json.load(map_file)
+        self.assertTrue(set(self.note_guids).issubset(site_ids))
+        primary = self.publisher.primary
+        for guid in self.note_guids:
+            mirror_id = site_ids[guid]['id']
+            self.assertIn(int(mirror_id), self.sites[1].posts)
+            primary_item = primary.wp_item_from_note(
+                primary.evernote.get_note(guid))
+            self.assertIn(primary_item.id, self.sites[0].posts)
+            self.assertNotEqual(int(mirror_id), primary_item.id)
+    
+    def test_failed_note_write(self):
+        patcher, failed = fail_first_update(
+            self.publisher.primary.evernote._note_store)
+        with patcher:
+            sync = threading.Thread(target=self.publisher.sync,
+                                    args=('post',))
+            sync.daemon = True
+            sync.start()
+            sync.join(30)
+        self.assertFalse(sync.is_alive())
+        self.assertEqual(1, len(failed))
+        self.assertListEqual([len(site.posts) for site in self.sites],
+                             [len(self.sites[0].posts)] * 2)
+    
+    def test_notes_written_once(self):
+        primary, mirror = self.publisher.adaptors
+        self.publisher.backlog = 4
+        post = mirror.post_to_wordpress_from_note
+        def slow_post(*args):
+            # The primary site works ahead of the mirror site
+            time.sleep(0.05)
+            return post(*args)
+        update_from_post = primary.update_note_metadata_from_wordpress_post
+        def slow_update(*args):
+            # The primary site is between the updates of a note when
+            #  the mirror site completes an earlier note
+            time.sleep(0.03)
+            return update_from_post(*args)
+        note_store = primary.evernote._note_store
+        with patch.object(mirror, 'post_to_wordpress_from_note',
+                          side_effect=slow_post), \
+                patch.object(primary,
+                             'update_note_metadata_from_wordpress_post',
+                             side_effect=slow_update), \
+                patch.object(note_store, 'updateNote',
+                             wraps=note_store.updateNote) as update:
+            self.publisher.sync('post')
+        written = [args[1].guid for args, _ in update.call_args_list]
+        self.assertTrue(set(self.note_guids).issubset(written))
+        self.assertEqual(len(set(written)), len(written))
+    
+    def test_resync_updates_same_posts(self):
+        self.publisher.sync('post')
+        post_counts = [len(site.posts) for site in self.sites]
+        EvernoteApiWrapper._cache.clear()
+        for adaptor in self.publisher.adaptors:
+            adaptor.cache.clear()
+        self.publisher.sync('post', force=True)
+        self.assertListEqual(post_counts,
+                             [len(site.posts) for site in self.sites])
+
+class TestBulkDetach(StubServicesTestCase):
+    
+    def setUp(self):
+        StubServicesTestCase.setUp(self)
+        self.make_corpus(posts=6)
+        for guid in self.note_store._order[:4]:
+            note = self.note_store._notes[guid]
+            note.content = note.content.replace('id=&lt;auto&gt;', 'id=17')
+        self.adaptor = self.make_adaptor(with_wordpress=False)
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'detached.json')
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+    
+    def detach(self, workers=3, force=False):
+        self.note_store.calls.clear()
+        self.adaptor.detach('post', workers=workers,
+                            detached=common.JsonFileMap(self.path),
+                            force=force)
+        return (self.note_store.calls['getNote'],
+                self.note_store.calls['updateNote'])
+    
+    def test_skips_detached_notes(self):
+        self.assertEqual((6, 4), self.detach())
+        self.assertFalse(any('id=17' in note.content for note
+                             in self.note_store._notes.itervalues()))
+        EvernoteApiWrapper._cache.clear()
+        self.assertEqual((0, 0), self.detach())
+        # Updated notes are detached again
+        note = self.note_store._notes.values()[0]
+        note.content = note.content.replace('id=&lt;auto&gt;', 'id=18')
+        self.note_store._store(note)
+        self.assertEqual((1, 1), self.detach())
+        EvernoteApiWrapper._cache.clear()
+        self.assertEqual((6, 0), self.detach(force=True))
+    
+    @patch('wordpress_evernote.time')
+    def test_retries_failures(self, mock_time):
+        with patch.object(self.adaptor, 'update_note_metdata',
+                          side_effect=[RuntimeError('failure')] * 4 +
+                          [True] * 5) as update:
+            self.detach(workers=1, force=True)
+        self.assertEqual(9, update.call_count)
+        self.assertListEqual([call(1), call(2), call(1)],
+                             mock_time.sleep.call_args_list)
+
+class TestBacklinks(StubServicesTestCase):
+    
+    def setUp(self):
+        StubServicesTestCase.setUp(self)
+        corpus = self.make_corpus(posts=4, fanout=1, images=1, projects=2)
+        self.notes = dict((note.guid, (note, terms))
+                          for note, terms in corpus.notes)
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'backlinks.json')
+        self.adaptor = self.make_adaptor(
+            backlink_index=BacklinkIndex(self.path))
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+    
+    def referring_posts(self, guid):
+        return sorted(note.guid for note, terms in self.notes.itervalues()
+                      if 'post' in terms and guid in note.content)
+    
+    def test_index(self):
+        index = BacklinkIndex(self.path)
+        index.set_refs('a', ['b', 'c', 'b'])
+        index.set_refs('d', ['c'])
+        self.assertListEqual(['a', 'd'], index.referrers('c'))
+        index.set_refs('a', ['b'])
+        self.assertListEqual(['a'], BacklinkIndex(self.path).referrers('b'))
+        self.assertListEqual(['d'], BacklinkIndex(self.path).referrers('c'))
+        self.assertFalse(index.set_published('a', '7', None))
+        self.assertFalse(index.set_published('a', '7', '/?p=7'))
+        self.assertTrue(index.set_published('a', '7', '/a'))
+        self.assertTrue(index.set_published('a', '8', '/a'))
+    
+    def test_republishes_referrers_of_new_id(self):
+        self.adaptor.sync('post')
+        page_guid = [guid for guid, (_, terms) in self.notes.iteritems()
+                     if 'page' in terms and self.referring_posts(guid)][0]
+        image_guid = [guid for guid, (_, terms) in self.notes.iteritems()
+                      if 'image' in terms][0]
+        self.assertListEqual(self.referring_posts(page_guid),
+                             self.adaptor.backlinks.referrers(page_guid))
+        self.assertListEqual(self.referring_posts(image_guid),
+                             self.adaptor.backlinks.referrers(image_guid))
+        # Posting a referenced note with the same ID republishes nothing
+        self.adaptor.cache.clear()
+        with patch.object(self.adaptor, 'post_to_wordpress_from_note',
+                          wraps=self.adaptor.post_to_wordpress_from_note
+                          ) as post:
+            post(page_guid, force=True)
+        self.assertEqual(1, post.call_count)
+        # Posting it with a new ID republishes only the referring posts
+        self.adaptor.update_note_metdata(
+            self.adaptor.evernote.get_note(page_guid),
+            {'id': '<auto>', 'link': '<auto>'})
+        self.adaptor.cache.clear()
+        with patch.object(self.adaptor, 'post_to_wordpress_from_note',
+                          wraps=self.adaptor.post_to_wordpress_from_note
+                          ) as post:
+            post(page_guid, force=True)
+        self.assertListEqual(
+            [call(page_guid, force=True)] +
+            [call(guid, force=True)
+             for guid in self.referring_posts(page_guid)],
+            post.call_args_list)
+
+class TestFingerprints(StubServicesTestCase):
+    
+    def setUp(self):
+        StubServicesTestCase.setUp(self)
+        self.make_corpus(posts=3, fanout=1, images=1, projects=1)
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'fingerprints.json')
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+    
+    def sync(self, fingerprints=True, force=False):
+        EvernoteApiWrapper._cache.clear()
+        adaptor = self.make_adaptor(fingerprints=(
+            common.JsonFileMap(self.path) if fingerprints else None))
+        self.wp_site.calls.clear()
+        adaptor.sync('post', force=force)
+        return self.wp_site.calls['editPost']
+    
+    def touch_notes(self):
+        # As if the note metadata writes updated the notes after publishing
+        for note in self.note_store._notes.itervalues():
+            note.updated += 3600 * 1000
+    
+    def test_skips_unchanged_items(self):
+        self.assertEqual(6, self.sync())
+        self.assertEqual(3, len(common.JsonFileMap(self.path)))
+        self.touch_notes()
+        self.assertEqual(3, self.sync(fingerprints=False))
+        self.touch_notes()
+        self.assertEqual(0, self.sync())
+        # Notes not changed since published, by their update sequence
+        #  numbers recorded after the notes were written, are skipped
+        #  before fetching them
+        self.note_store.calls.clear()
+        self.assertEqual(0, self.sync())
+        self.assertEqual(0, self.note_store.calls['getNote'])
+        self.assertEqual(3, self.sync(force=True))
+        # Changed notes are published
+        note = [note for note in self.note_store._notes.itervalues()
+                if note.title.startswith('Post 1 ')][0]
+        note.content = note.content.replace('title=Post 1 ', 'title=Post one ')
+        self.note_store._store(note)
+        self.touch_notes()
+        self.assertEqual(1, self.sync())
+    
+    def test_fingerprint(self):
+        post = wordpress.WordPressItem()
+        post.__class__ = WordPressPost
+        post.post_type = 'post'
+        post.title = 'Title'
+        post.content = 'Content'
+        post.tags = ['tag']
+        fingerprint = post.fingerprint()
+        post.id = 7
+        self.assertNotEqual(fingerprint, post.fingerprint())
+        fingerprint = post.fingerprint()
+        post.id = '7'
+        self.assertEqual(fingerprint, post.fingerprint())
+        post.tags = ['other']
+        self.assertNotEqual(fingerprint, post.fingerprint())
+
+def fail_first_update(note_store):
+    """Patch a fake note store to fail the first note update,
+    and return the patcher and the list of the GUID of the failed note."""
+    update_note = note_store.updateNote
+    failed = list()
+    def fail_once(token, note):
+        if not failed:
+            failed.append(note.guid)
+            raise Errors.EDAMUserException(
+                errorCode=Errors.EDAMErrorCode.DATA_CONFLICT)
+        return update_note(token, note)
+    patcher = patch.object(note_store, 'updateNote', side_effect=fail_once)
+    return patcher, failed
+
+class TestNoteUpdateSession(StubServicesTestCase):
+    
+    def setUp(self):
+        StubServicesTestCase.setUp(self)
+        self.make_corpus(posts=2, images=1, embedded_images=1)
+        self.adaptor = self.make_adaptor()
+    
+    def test_flush_keeps_failed_notes(self):
+        notes = [self.adaptor.evernote.get_note(guid)
+                 for guid in self.note_store._order[:2]]
+        session = NoteUpdateSession(self.adaptor.evernote)
+        for note in notes:
+            session.update_metadata(note, {'id': '7'})
+        patcher, failed = fail_first_update(self.note_store)
+        with patcher:
+            with self.assertRaises(NoteUpdateError) as cm:
+                session.flush()
+        self.assertListEqual(failed, cm.exception.guids)
+        # The other note was written, and the failed note is kept
+        self.assertEqual(1, len(session))
+        self.assertEqual(1, session.flush())
+        session.update_metadata(notes[0], {'id': '8'})
+        session.discard([notes[0].guid])
+        self.assertEqual(0, session.flush())
+    
+    def test_sync_goes_on_after_failed_write(self):
+        patcher, failed = fail_first_update(self.note_store)
+        with patcher:
+            self.adaptor.sync('post')
+        self.assertEqual(1, len(failed))
+        self.assertEqual(2, sum(1 for post in self.wp_site.posts.itervalues()
+                                if 'post' == post['post_type']))
+        self.assertIsNone(self.adaptor.session)
+    
+    def test_coalesces_note_updates(self):
+        note = self.adaptor.evernote.get_note(self.note_store._order[0])
+        session = NoteUpdateSession(self.adaptor.evernote)
+        with patch.object(EvernoteWordpressAdaptor, '_parse_xml_from_string',
+                          wraps=EvernoteWordpressAdaptor._parse_xml_from_string
+                          ) as parse:
+            self.assertTrue(session.update_metadata(note, {'id': '7'}))
+            self.assertFalse(session.update_metadata(note, {'id': '7'}))
+            self.assertTrue(session.update_metadata(note, {'link': '/a'}))
+        self.assertEqual(1, parse.call_count)
+        self.assertEqual(0, self.note_store.calls['updateNote'])
+        self.assertEqual(1, session.flush())
+        self.assertEqual(0, session.flush())
+        self.assertEqual(1, self.note_store.calls['updateNote'])
+        stored = self.note_store._notes[note.guid]
+        self.assertIn('id=7', stored.content)
+        self.assertIn('link=/a', stored.content)
+    
+    def test_sync_writes_notes_once(self):
+        self.adaptor.sync('post', preprocess=True)
+        # Every post note was preprocessed, and got an ID and a link,
+        #  and every image note got an ID (as a stub of a post)
+        self.assertEqual(2, self.note_store.calls['createNote'])
+        self.assertEqual(6, self.note_store.calls['updateNote'])
+        self.assertFalse(any('id=&lt;auto&gt;' in note.content for note
+                             in self.note_store._notes.itervalues()))
+        self.assertIsNone(self.adaptor.session)
@@ -1,8 +1,22 @@
+import os
+import shutil
+import tempfile
 import unittest
+import hashlib
+import socket
+import threading
+from StringIO import StringIO
+from mock import Mock, patch
 
+import common
+import disk_cache
+import my_evernote
+from my_evernote import AdaptivePageSize
+from note_store_pool import NoteStorePool, PersistentHttpTransport
 from wordpress_evernote import EvernoteApiWrapper
+from stub_test_case import StubServicesTestCase
 
-class TestEvernoteApiWrapper(unittest.TestCase):
+class TestEvernoteApiWrapper(StubServicesTestCase):
     
     def test_evernote_link(self):
         link = EvernoteApiWrapper.parseNoteLinkUrl('evernote:///view/123/s123/'
@@ -19,3 +33,237 @@ class TestEvernoteApiWrapper(unittest.TestCase):
         self.assertEqual('112233', link.user_id)
         self.assertEqual('s123', link.shard_id)
         self.assertEqual('abcd1234-1234-abcd-1234-abcd1234abcd', link.noteGuid)
+    
+    def test_index_resources_by_hash(self):
+        resources = [Mock(), Mock(), Mock()]
+        for res, body in zip(resources, ['image-1', 'image-2', 'image-1']):
+            res.data.bodyHash = hashlib.md5(body).digest()
+        index = EvernoteApiWrapper.index_resources_by_hash(resources)
+        self.assertEqual(2, len(index))
+        self.assertIs(resources[0], index[hashlib.md5('image-1').hexdigest()])
+        self.assertIs(resources[1], index[hashlib.md5('image-2').hexdigest()])
+        self.assertDictEqual(dict(),
+                             EvernoteApiWrapper.index_resources_by_hash(None))
+    
+    def test_make_data(self):
+        body = ''.join(chr(i % 256) for i in xrange(1000))
+        data = EvernoteApiWrapper.makeData(StringIO(body), chunk_size=64)
+        self.assertEqual(body, data.body)
+        self.assertEqual(1000, data.size)
+        self.assertEqual(hashlib.md5(body).digest(), data.bodyHash)
+        self.assertEqual('', EvernoteApiWrapper.makeData(StringIO('')).body)
+    
+    def test_make_resource_mime(self):
+        def resource_mime(body, filename, mime=None):
+            resource, tag = EvernoteApiWrapper.makeResource(
+                StringIO(body), filename, mime)
+            self.assertIn('type="%s"' % (resource.mime), tag)
+            return resource.mime
+        png = '\x89PNG\r\n\x1a\n' + 'x' * 100
+        self.assertEqual('image/png', resource_mime(png, u'image.jpg'))
+        self.assertEqual('image/jpeg',
+                         resource_mime('\xff\xd8\xff\xe0data', u'image'))
+        self.assertEqual('image/webp',
+                         resource_mime('RIFF\x00\x01\x00\x00WEBPVP8 ',
+                                       u'image'))
+        self.assertEqual('image/gif', resource_mime('text', u'image.gif'))
+        bmp = 'BM\x46\x00\x00\x00\x00\x00\x00\x00\x36\x00\x00\x00\x28\x00'
+        self.assertEqual('image/bmp', resource_mime(bmp + '\x00' * 52,
+                                                    u'image'))
+        self.assertEqual('text/csv', resource_mime('BMI,Weight\n21,70\n',
+                                                   u'bmi.csv'))
+        self.assertEqual('image/png', resource_mime('text', u'image',
+                                                    'image/x-png'))
+        self.assertEqual('application/octet-stream',
+                         resource_mime('text', u'image'))
+    
+    def test_sniff_mime_memoized(self):
+        head = '\x89PNG\r\n\x1a\n'
+        self.assertEqual('image/png', my_evernote.sniff_mime(head + 'data'))
+        self.assertIn(head + 'data', my_evernote._sniffed_mimes)
+        self.assertIsNone(my_evernote.sniff_mime('plain text file'))
+    
+    def test_client_initialized_on_first_use(self):
+        def init_en_client(wrapper, token, sandbox):
+            wrapper._client = Mock(token=token)
+            wrapper._note_store = Mock()
+        with patch.object(EvernoteApiWrapper, '_init_en_client',
+                          autospec=True,
+                          side_effect=init_en_client) as init:
+            wrapper = EvernoteApiWrapper('token')
+            self.assertFalse(init.called)
+            self.assertEqual('token', wrapper._client.token)
+            self.assertIsNotNone(wrapper._note_store)
+            init.assert_called_once_with(wrapper, 'token', False)
+        self.assertRaises(AttributeError, getattr, wrapper, '_user_store')
+    
+    def test_resource_data_disk_cache(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.make_corpus(posts=1)
+        note_store = self.note_store
+        note_store._resource_data['res-guid'] = 'image data'
+        body_hash = hashlib.md5('image data').digest()
+        def get_resource_data(guid, body_hash):
+            wrapper = self.evernote_wrapper()
+            wrapper._cache = dict()
+            wrapper.disk_cache = disk_cache.DiskCache(tmp_dir, 1024 * 1024)
+            return wrapper.get_resource_data(guid, body_hash)
+        for _ in xrange(2):
+            self.assertEqual('image data',
+                             get_resource_data('res-guid', body_hash))
+        # Fetched once, and loaded from the disk cache in the next run
+        self.assertEqual(1, note_store.calls['getResourceData'])
+        # Data of an unknown hash isn't cached
+        self.assertEqual('image data', get_resource_data('res-guid', None))
+        self.assertEqual(2, note_store.calls['getResourceData'])
+
+class TestNoteStorePool(StubServicesTestCase):
+    
+    def setUp(self):
+        StubServicesTestCase.setUp(self)
+        self.pool = NoteStorePool(Mock, max_size=2, max_idle=60.0)
+    
+    def test_checkout_per_thread(self):
+        with self.pool.checkout() as client:
+            with self.pool.checkout() as nested:
+                self.assertIs(client, nested)
+            self.assertIs(client, self.pool.current())
+            clients = list()
+            thread = threading.Thread(target=lambda: clients.append(
+                self.pool.checkout().__enter__()))
+            thread.start()
+            thread.join()
+            self.assertIsNot(client, clients[0])
+        self.assertIsNone(self.pool.current())
+        with self.pool.checkout() as reused:
+            self.assertIs(client, reused)
+        self.assertEqual(2, self.pool.created)
+    
+    def test_checkout_waits_for_client(self):
+        checked_out = threading.Event()
+        release = threading.Event()
+        def hold_client():
+            with self.pool.checkout():
+                checked_out.set()
+                release.wait()
+        threads = [threading.Thread(target=hold_client) for _ in xrange(2)]
+        for thread in threads:
+            thread.start()
+        checked_out.wait()
+        clients = list()
+        waiter = threading.Thread(target=lambda: clients.append(
+            self.pool.checkout().__enter__()))
+        waiter.start()
+        waiter.join(0.1)
+        self.assertFalse(clients)
+        release.set()
+        waiter.join()
+        self.assertEqual(1, len(clients))
+        self.assertEqual(2, self.pool.created)
+    
+    def test_discard_failed_transport(self):
+        with self.assertRaises(socket.error):
+            with self.pool.checkout() as client:
+                raise socket.error('Connection reset')
+        client.close.assert_called_once_with()
+        self.assertEqual((0, 1), (self.pool.size, self.pool.discarded))
+        with self.assertRaises(ValueError):
+            with self.pool.checkout() as other:
+                raise ValueError()
+        self.assertIsNot(client, other)
+        self.assertEqual((1, 1), (self.pool.size, self.pool.discarded))
+    
+    def test_close_idle_connection(self):
+        with self.pool.checkout() as client:
+            pass
+        with patch('time.time', return_value=self.pool._idle[0][1] + 61):
+            with self.pool.checkout() as reused:
+                self.assertIs(client, reused)
+        client.close.assert_called_once_with()
+    
+    def transport_call(self, connections):
+        transport = PersistentHttpTransport('http://localhost:8880/edam/note')
+        # A call made on the kept connection
+        transport.calls = 1
+        transport._connection = connections[0]
+        with patch('httplib.HTTPConnection', side_effect=connections[1:]):
+            transport.write('call')
+            transport.flush()
+        return transport
+    
+    def test_transport_retries_unsent_call(self):
+        stale, fresh = Mock(), Mock()
+        stale.request.side_effect = socket.error('Broken pipe')
+        fresh.getresponse.return_value = Mock(status=200, will_close=False,
+                                              read=Mock(return_value='reply'))
+        transport = self.transport_call([stale, fresh])
+        self.assertEqual('reply', transport.read(5))
+        fresh.request.assert_called_once_with(
+            'POST', '/edam/note', 'call',
+            {'Content-Type': 'application/x-thrift'})
+        self.assertEqual(1, transport.calls)
+    
+    def test_transport_doesnt_retry_sent_call(self):
+        kept, fresh = Mock(), Mock()
+        kept.getresponse.side_effect = socket.timeout('timed out')
+        with self.assertRaises(socket.timeout):
+            self.transport_call([kept, fresh])
+        kept.request.assert_called_once_with(
+            'POST', '/edam/note', 'call',
+            {'Content-Type': 'application/x-thrift'})
+        kept.close.assert_called_once_with()
+        self.assertFalse(fresh.request.called)
+    
+    def test_wrapper_without_pool(self):
+        self.make_corpus(posts=1)
+        note_store = self.note_store
+        wrapper = self.evernote_wrapper()
+        # A single given NoteStore client is used under the API lock
+        with patch.object(wrapper, '_api_lock') as api_lock:
+            wrapper.get_sync_state()
+        self.assertTrue(api_lock.__enter__.called)
+        self.assertIs(note_store, wrapper._store())
+        self.assertEqual(1, note_store.calls['getSyncState'])
+
+class TestAdaptivePageSize(StubServicesTestCase):
+    
+    def setUp(self):
+        StubServicesTestCase.setUp(self)
+        self.make_corpus(posts=60)
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'page-sizes.json')
+        common.JsonFileMap(self.path).update(':post', {'page_size': 10})
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+    
+    def list_notes(self):
+        self.note_store.calls.clear()
+        wrapper = self.evernote_wrapper()
+        wrapper._page_sizes = common.JsonFileMap(self.path)
+        offsets = [offset for offset, _
+                   in wrapper.get_notes_by_query('post')]
+        self.assertListEqual(range(60), offsets)
+        return (self.note_store.calls['findNotesMetadata'],
+                wrapper.get_page_size('post'))
+    
+    def test_observe(self):
+        page_size = AdaptivePageSize(100)
+        self.assertEqual(200, page_size.observe(0.1))
+        self.assertEqual(250, page_size.observe(0.1))
+        self.assertEqual(250, page_size.observe(2.0))
+        self.assertEqual(125, page_size.observe(6.0))
+        self.assertEqual(62, page_size.observe(0.1, rate_limited=True))
+        self.assertEqual(10, AdaptivePageSize(1).size)
+    
+    def test_grows_on_fast_calls(self):
+        # 10 + 20 + 30 notes, and settled on 80 notes
+        self.assertEqual((3, 80), self.list_notes())
+        self.assertEqual((1, 160), self.list_notes())
+    
+    @patch('my_evernote.time')
+    def test_shrinks_on_slow_calls(self, mock_time):
+        mock_time.time.side_effect = [float(i * 10) for i in xrange(20)]
+        # 10 + 10 + 10 ... notes
+        self.assertEqual((6, 10), self.list_notes())
@@ -0,0 +1,103 @@
+import json
+import Queue
+import logging
+import unittest
+import threading
+import multiprocessing
+
+from mock import MagicMock
+
+import common
+
+class RecordingHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = list()
+
+    def emit(self, record):
+        self.records.append(record)
+
+def log_from_worker(logger_name):
+    logging.getLogger(logger_name).warning('Logged in a worker')
+    return True
+
+class TestQueueLogging(unittest.TestCase):
+
+    def setUp(self):
+        self.handler = RecordingHandler()
+        self.listener = common.QueueListener(Queue.Queue(), self.handler)
+        self.logger = logging.getLogger('test-queue-logging')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        self.queue_handler = common.QueueHandler(self.listener.queue,
+                                                 self.listener)
+        self.logger.addHandler(self.queue_handler)
+        self.listener.start()
+
+    def tearDown(self):
+        self.listener.stop()
+        self.logger.removeHandler(self.queue_handler)
+
+    def test_lazy_argument(self):
+        func = MagicMock(return_value='value')
+        self.logger.debug('Debug %s', common.Lazy(func))
+        self.assertFalse(func.called)
+        self.logger.info('Info %s', common.Lazy(func, 1, key=2))
+        func.assert_called_once_with(1, key=2)
+        self.listener.stop()
+        self.assertListEqual(['Info value'], [record.getMessage() for record
+                                              in self.handler.records])
+
+    def test_immutable_arguments(self):
+        self.logger.info('Note %s of %d (%s)', u'title', 2, ('a', 1))
+        self.listener.stop()
+        record = self.handler.records[0]
+        # Formatted in the listener thread
+        self.assertEqual((u'title', 2, ('a', 1)), record.args)
+        self.assertEqual("Note title of 2 (('a', 1))", record.getMessage())
+
+    def test_mutable_argument(self):
+        items = ['before']
+        self.logger.info('Items %s', items)
+        items[0] = 'after'
+        self.listener.stop()
+        self.assertEqual("Items ['before']",
+                         self.handler.records[0].getMessage())
+        self.assertIsNone(self.handler.records[0].args)
+
+    def test_worker_with_handler_lock_held(self):
+        # Another thread holds the handler lock when the pool forks
+        locked, release = threading.Event(), threading.Event()
+        def hold_lock():
+            with self.handler.lock:
+                locked.set()
+                release.wait()
+        holder = threading.Thread(target=hold_lock)
+        holder.start()
+        locked.wait()
+        pool = multiprocessing.Pool(1, common.reset_handler_locks,
+                                    (self.logger,))
+        try:
+            result = pool.apply_async(log_from_worker, (self.logger.name,))
+            self.assertTrue(result.get(10))
+        finally:
+            release.set()
+            holder.join()
+            pool.terminate()
+            pool.join()
+
+    def test_json_records(self):
+        self.handler.setFormatter(common.JsonFormatter())
+        try:
+            raise ValueError('failure')
+        except ValueError:
+            self.logger.exception('Failed %s', 'note')
+        self.listener.stop()
+        data = json.loads(self.handler.format(self.handler.records[0]))
+        self.assertEqual('Failed note', data['message'])
+        self.assertEqual('ERROR', data['level'])
+        self.assertIn('ValueError: failure', data['exception'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from wordpress_xmlrpc import WordPressPost as XmlRpcPost
+
+import metrics
+from my_evernote import EvernoteApiWrapper
+from wordpress import WordPressApiWrapper
+from benchmarks import servers
+from stub_test_case import StubServicesTestCase
+
+class TestMetricsRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = metrics.MetricsRegistry()
+
+    def test_measure(self):
+        with self.registry.measure('evernote', 'getNote'):
+            self.registry.add_bytes(sent=10)
+            self.registry.add_bytes(received=100)
+        with self.assertRaises(ValueError):
+            with self.registry.measure('evernote', 'getNote'):
+                raise ValueError()
+        # Bytes outside measured calls are ignored
+        self.registry.add_bytes(sent=1000)
+        [(service, method, data)] = self.registry.snapshot()
+        self.assertEqual(('evernote', 'getNote'), (service, method))
+        self.assertEqual(2, data['count'])
+        self.assertEqual(1, data['errors'])
+        self.assertEqual(10, data['bytes_sent'])
+        self.assertEqual(100, data['bytes_received'])
+        self.assertEqual(['+Inf', 2], data['latency_buckets'][-1])
+
+    def test_prometheus(self):
+        with self.registry.measure('wordpress', 'get_post'):
+            pass
+        text = self.registry.to_prometheus()
+        self.assertIn('# TYPE tomato_api_calls_total counter\n'
+                      'tomato_api_calls_total{service="wordpress",'
+                      'method="get_post"} 1\n', text)
+        self.assertIn('tomato_api_bytes_total{service="wordpress",'
+                      'method="get_post",direction="sent"} 0\n', text)
+        self.assertIn('tomato_api_call_duration_seconds_bucket{'
+                      'service="wordpress",method="get_post",le="0.005"} 1\n',
+                      text)
+        self.assertIn('tomato_api_call_duration_seconds_count{'
+                      'service="wordpress",method="get_post"} 1\n', text)
+
+class TestMetricsExport(StubServicesTestCase):
+
+    def setUp(self):
+        StubServicesTestCase.setUp(self)
+        metrics.registry.reset()
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_exporter(self):
+        prom_path = os.path.join(self.tmp_dir, 'tomato.prom')
+        json_path = os.path.join(self.tmp_dir, 'tomato.json')
+        @metrics.instrumented('test')
+        def _api_method():
+            pass
+        exporter = metrics.MetricsExporter(prom_path, json_path).start()
+        _api_method()
+        exporter.stop()
+        with open(json_path) as json_file:
+            exported = json.load(json_file)
+        self.assertEqual('api_method', exported['methods'][0]['method'])
+        self.assertEqual(1, exported['methods'][0]['count'])
+        with open(prom_path) as prom_file:
+            self.assertIn('method="api_method"', prom_file.read())
+        self.assertEqual(['tomato.json', 'tomato.prom'],
+                         sorted(os.listdir(self.tmp_dir)))
+
+    def test_api_wrappers(self):
+        corpus = self.make_corpus(posts=1, images=1, image_size=64)
+        en_server = servers.start_in_thread(servers.EvernoteServer(
+            ('localhost', 0), self.note_store))
+        wp_server = servers.start_in_thread(servers.WordPressServer(
+            ('localhost', 0), self.wp_site))
+        try:
+            en_wrapper = EvernoteApiWrapper('token',
+                                            service_host=en_server.url)
+            note, _ = corpus.notes[0]
+            en_wrapper.get_note(note.guid)
+            wp_wrapper = WordPressApiWrapper(wp_server.url, 'user', 'pass')
+            post = XmlRpcPost()
+            post.title = 'Measured post'
+            wp_wrapper.get_post(wp_wrapper.new_post(post))
+        finally:
+            for server in (en_server, wp_server):
+                server.shutdown()
+                server.server_close()
+        snapshot = dict(((service, method), data) for service, method, data
+                        in metrics.registry.snapshot())
+        for key in (('evernote', 'getNote'), ('wordpress', 'new_post'),
+                    ('wordpress', 'get_post')):
+            self.assertEqual(1, snapshot[key]['count'])
+            self.assertLess(0, snapshot[key]['bytes_sent'])
+            self.assertLess(0, snapshot[key]['bytes_received'])
+        self.assertLess(len(note.content),
+                        snapshot['evernote', 'getNote']['bytes_received'])
@@ -0,0 +1,67 @@
+import time
+import threading
+import unittest
+from StringIO import StringIO
+
+from mock import Mock, patch
+
+import pipeline
+from wordpress_evernote import EvernoteWordpressAdaptor
+from stub_test_case import StubServicesTestCase
+
+class TestPipeline(unittest.TestCase):
+
+    @patch('pipeline.logger')
+    def test_run(self, mock_logger):
+        stored = list()
+        lock = threading.Lock()
+        def fetch(num):
+            if 3 == num:
+                raise IOError('failure')
+            return 'x' * num
+        def store(data):
+            time.sleep(0.001)
+            with lock:
+                stored.append(len(data))
+        runner = pipeline.Pipeline([('fetch', fetch, 3),
+                                    ('store', store, 2)], 20)
+        self.assertEqual(0, runner.run(xrange(10)))
+        self.assertListEqual([0, 1, 2, 4, 5, 6, 7, 8, 9], sorted(stored))
+        self.assertLessEqual(runner.budget.peak, 20)
+        self.assertEqual(0, runner.budget.in_flight)
+
+    def test_byte_backpressure(self):
+        def create(data):
+            time.sleep(0.001)
+            return len(data)
+        runner = pipeline.Pipeline([('download', lambda size: 'x' * size, 4),
+                                    ('create', create, 1)], 100)
+        self.assertEqual(50, runner.run([30] * 50))
+        self.assertLessEqual(runner.budget.peak, 90)
+        # An item larger than the budget goes through alone
+        runner = pipeline.Pipeline([('download', lambda size: 'x' * size, 2),
+                                    ('create', len, 1)], 100)
+        self.assertEqual(3, runner.run([10, 500, 10]))
+
+class TestImportImages(StubServicesTestCase):
+
+    def test_import_images(self):
+        self.make_corpus(posts=1)
+        adaptor = EvernoteWordpressAdaptor(self.evernote_wrapper(), Mock())
+        images = list()
+        for i in xrange(12):
+            image = Mock(id=i, title='Image %d' % (i), link='link',
+                         caption='', description='',
+                         filename='image-%d.png' % (i),
+                         image_data=StringIO('image %d' % (i)))
+            image.parent = 7
+            images.append(image)
+        adaptor.wordpress.media_item_generator.return_value = iter(images)
+        self.assertEqual(12, adaptor.import_images_to_evernote(
+            7, None, download_workers=3, max_bytes=20))
+        self.assertEqual(12, self.note_store.calls['createNote'])
+        titles = [note.title for note in self.note_store._notes.itervalues()]
+        self.assertIn('image-11.png', titles)
+
+if __name__ == '__main__':
+    unittest.main()
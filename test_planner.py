@@ -0,0 +1,75 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import Mock
+
+import metrics
+import planner
+from stub_test_case import StubServicesTestCase
+
+def note_metadata(index, resource_size=None):
+    return Mock(guid='guid-%d' % (index), title='Note %d' % (index),
+                contentLength=1000, largestResourceSize=resource_size)
+
+class TestPlan(StubServicesTestCase):
+
+    def test_note_costs(self):
+        plan = planner.Plan('sync', 'post', preprocess=True)
+        plan.add_notes(enumerate([note_metadata(0), note_metadata(1, 500)]))
+        self.assertListEqual([(2, 4, 1000), (8, 7, 3000)],
+                             [(cost.evernote_calls, cost.wordpress_calls,
+                               cost.bytes) for cost in plan.notes])
+        self.assertEqual(1 + 2 + 8, plan.evernote_calls)
+        self.assertEqual(11, plan.wordpress_calls)
+        self.assertEqual(4000, plan.bytes)
+
+    def test_runs(self):
+        plan = planner.Plan('preprocess', 'post', page_size=4)
+        plan.add_notes(enumerate(note_metadata(i, 500) for i in xrange(10)))
+        # 4 calls per note, and a listing call every 4 notes
+        self.assertEqual(3 + 40, plan.evernote_calls)
+        self.assertListEqual([10], plan.runs(43, 43))
+        self.assertListEqual([2, 4, 4], plan.runs(9, 17))
+        self.assertListEqual([1, 9], plan.runs(0, 100))
+        latencies = {'evernote': 1.0, 'wordpress': 2.0}
+        self.assertEqual(43.0, plan.seconds(43, 43, latencies))
+        self.assertEqual(7243.0, plan.seconds(9, 17, latencies))
+
+    def test_preprocess_plan_matches_calls(self):
+        self.make_corpus(posts=3, embedded_images=1, image_size=1024)
+        note_store = self.note_store
+        adaptor = self.make_adaptor(with_wordpress=False)
+        plan = planner.Plan('preprocess', 'post')
+        plan.add_notes(adaptor._query_notes('preprocess', 'post'))
+        self.assertTrue(all(cost.bytes > 2 * 1024 for cost in plan.notes))
+        note_store.calls.clear()
+        adaptor.preprocess('post', None)
+        self.assertEqual(plan.evernote_calls, sum(
+            note_store.calls[method] for method in (
+                'findNotesMetadata', 'getNote', 'getResourceData',
+                'createNote', 'updateNote')))
+
+class TestLatencies(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'metrics.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_load_latencies(self):
+        registry = metrics.MetricsRegistry()
+        registry._metrics[('evernote', 'getNote')] = metrics.MethodMetrics()
+        registry._metrics[('evernote', 'getNote')].observe(0.2, False, 0, 0)
+        registry._metrics[('evernote', 'getNote')].observe(0.4, False, 0, 0)
+        registry.write(json_path=self.path)
+        latencies = planner.load_latencies(self.path)
+        self.assertAlmostEqual(0.3, latencies['evernote'])
+        self.assertEqual(planner.DEFAULT_LATENCIES['wordpress'],
+                         latencies['wordpress'])
+
+if __name__ == '__main__':
+    unittest.main()
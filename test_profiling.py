@@ -0,0 +1,58 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+
+import profiling
+
+def busy_work():
+    return sum(i * i for i in xrange(200000))
+
+class TestProfiling(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch('profiling.logger')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.tmp_dir = tempfile.mkdtemp()
+        self.prefix = os.path.join(self.tmp_dir, 'profile')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_cprofile(self):
+        result = profiling.run(busy_work, 'cprofile', self.prefix,
+                               interval=0.001)
+        self.assertEqual(busy_work(), result)
+        self.assertTrue(os.path.isfile(self.prefix + '.pstats'))
+        self.assertTrue(os.path.isfile(self.prefix + '.collapsed'))
+
+    def test_sample(self):
+        profiling.run(busy_work, 'sample', self.prefix, interval=0.001)
+        self.assertFalse(os.path.exists(self.prefix + '.pstats'))
+        with open(self.prefix + '.collapsed') as collapsed_file:
+            lines = collapsed_file.read().splitlines()
+        self.assertTrue(lines)
+        for line in lines:
+            stack, count = line.rsplit(' ', 1)
+            self.assertLess(0, int(count))
+
+    def test_invalid_mode(self):
+        self.assertRaises(ValueError, profiling.run, busy_work, 'trace',
+                          self.prefix)
+
+    def test_leaf_counts(self):
+        sampler = profiling.StackSampler()
+        sampler.stacks.update({
+            'MainThread;main (x.py:1);readline (socket.py:10)': 3,
+            'MainThread;main (x.py:1);parse (xml_backend.py:20)': 2,
+            'Thread-1;run (threading.py:5);wait (threading.py:6)': 7,
+            })
+        network, cpu = sampler.leaf_counts()
+        self.assertEqual({'readline (socket.py:10)': 3}, dict(network))
+        self.assertEqual({'parse (xml_backend.py:20)': 2}, dict(cpu))
+
+if __name__ == '__main__':
+    unittest.main()
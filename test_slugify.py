@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+import unittest
+from StringIO import StringIO
+
+from mock import Mock, patch
+
+import slugify
+from wordpress import WordPressAttribute
+from benchmarks import bench_slugify
+
+class TestSlugify(unittest.TestCase):
+
+    def setUp(self):
+        slugify._slugs.clear()
+
+    def test_entities(self):
+        self.assertEqual('fish-chips',
+                         slugify.slugify(u'Fish &amp; Chips'))
+        self.assertEqual('cafe-its', slugify.slugify(u'caf&eacute; it&#39;s'))
+        # Unknown entity names are left as is
+        self.assertEqual('a-bogus-b', slugify.slugify(u'a &bogus; b'))
+        self.assertEqual('a-amp-b',
+                         slugify.slugify(u'a &amp; b', entities=False))
+
+    def test_memoized(self):
+        with patch('slugify._slugify', return_value='slug') as mock_slugify:
+            self.assertEqual('slug', slugify.slugify(u'Title'))
+            self.assertEqual('slug', slugify.slugify(u'Title'))
+            slugify.slugify(u'Title', max_length=3)
+        self.assertEqual(2, mock_slugify.call_count)
+
+    def test_slugify_many(self):
+        titles = [u'Привет мир', u'Straße über', u'Привет мир']
+        self.assertListEqual(['privet-mir', 'strasse-uber', 'privet-mir'],
+                             slugify.slugify_many(iter(titles)))
+        self.assertListEqual([slugify.slugify(title, separator='_')
+                              for title in titles],
+                             slugify.slugify_many(titles, separator='_'))
+
+    def test_auto_slug_per_title(self):
+        item = Mock(title=u'First title')
+        slug = WordPressAttribute.create('slug', '<auto>', item)
+        with patch('slugify.slugify', wraps=slugify.slugify) as mock_slugify:
+            self.assertEqual('first-title', slug.fget())
+            self.assertEqual('first-title', slug.fget())
+            item.title = u'Second title'
+            self.assertEqual('second-title', slug.fget())
+        self.assertEqual(2, mock_slugify.call_count)
+
+    def test_benchmark(self):
+        titles = bench_slugify.generate_titles(10, 4)
+        self.assertEqual(4, len(set(titles)))
+        with patch('sys.stdout', new_callable=StringIO) as stdout:
+            self.assertEqual(0, bench_slugify.main(
+                ['--titles', '20', '--unique', '5', '--repeat', '1']))
+        self.assertIn('slugify_many', stdout.getvalue())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import unittest
+import os
+import codecs
+
+import xml_backend
+
+try:
+    import lxml
+except ImportError:
+    lxml = None
+
+NOTES_CONTENT_DIR = os.path.join('test-data', 'notes-content')
+
+@unittest.skipUnless(lxml, 'lxml not installed')
+class TestXmlBackendConformance(unittest.TestCase):
+
+    def setUp(self):
+        self.stdlib = xml_backend.get_backend('stdlib')
+        self.lxml = xml_backend.get_backend('lxml')
+
+    def assertElementTreeIdentical(self, root1, root2, msg=None):
+        """Compare ElementTree objects, including whitespace."""
+        self.assertEqual(root1.tag, root2.tag, msg)
+        self.assertEqual(root1.text, root2.text, msg)
+        self.assertEqual(root1.tail, root2.tail, msg)
+        self.assertDictEqual(root1.attrib, root2.attrib, msg)
+        self.assertEqual(len(root1), len(root2), msg)
+        for e1, e2 in zip(root1, root2):
+            self.assertElementTreeIdentical(e1, e2, msg)
+
+    def assertBackendsConform(self, xml_string, msg=None):
+        self.assertElementTreeIdentical(self.stdlib.fromstring(xml_string),
+                                        self.lxml.fromstring(xml_string), msg)
+
+    def test_notes_content(self):
+        for fname in os.listdir(NOTES_CONTENT_DIR):
+            fpath = os.path.join(NOTES_CONTENT_DIR, fname)
+            with codecs.open(fpath, 'r', encoding='utf-8') as note_file:
+                content = note_file.read()
+            self.assertBackendsConform(content, fname)
+            self.assertBackendsConform(content.encode('utf-8'), fname)
+
+    def test_entities_and_nbsp(self):
+        self.assertBackendsConform(
+            '<?xml version="1.0" encoding="UTF-8" standalone="no"?>\n'
+            '<!DOCTYPE en-note SYSTEM "http://xml.evernote.com/pub/enml2.dtd">'
+            '\n<en-note>a&nbsp;b&mdash;&amp;<div title="x\xc2\xa0y">'
+            '\xc2\xa0&eacute;</div>tail</en-note>')
+
+    def test_fragment(self):
+        self.assertBackendsConform('<en-media type="image/png" '
+                                   'hash="0123456789abcdef" />')
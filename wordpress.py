@@ -3,27 +3,40 @@
 
 import urllib2
 import re
+import json
+import hashlib
 import datetime
 
-# WordPress API:
-#import wordpress_xmlrpc
-from wordpress_xmlrpc import Client #, WordPressPost
-from wordpress_xmlrpc import WordPressPost as XmlRpcPost
-from wordpress_xmlrpc import WordPressPage as XmlRpcPage
-from wordpress_xmlrpc import WordPressMedia as XmlRpcMedia
-#from wordpress_xmlrpc import WordPressPage as XmlRpcPage
-from wordpress_xmlrpc.compat import xmlrpc_client
-#from wordpress_xmlrpc.methods.posts import GetPosts, NewPost
-#from wordpress_xmlrpc.methods.users import GetUserInfo
-from wordpress_xmlrpc.methods import media, posts
+import threading
+import xmlrpclib
 
 import slugify
 
 import common
+import metrics
 from common import UrlParser
 
+# WordPress API (loaded on first use):
+wordpress_xmlrpc = common.LazyModule('wordpress_xmlrpc')
+media = common.LazyModule('wordpress_xmlrpc.methods.media')
+posts = common.LazyModule('wordpress_xmlrpc.methods.posts')
+
 logger = common.logger.getChild('wordpress')
 
+def _normalize_payload(value):
+    """Return `value` with strings as unicode and other scalars (IDs, dates)
+    as their unicode representation, so equal payloads serialize equally."""
+    if isinstance(value, dict):
+        return dict((key, _normalize_payload(val))
+                    for key, val in value.iteritems())
+    if isinstance(value, (list, tuple)):
+        return [_normalize_payload(val) for val in value]
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    if value is None or isinstance(value, (unicode, bool)):
+        return value
+    return unicode(value)
+
 class WordPressAttribute(object):
     """WordPress item attribute."""
     
@@ -74,14 +87,23 @@ class WordPressAttribute(object):
 class WordPressSlugAttribute(WordPressAttribute):
     """WordPress item slug attribute."""
     
+    # Title of the last auto slug, and the slug
+    _slug_title = None
+    _slug = None
+    
     def fget(self):
         """Return slug string for item.
         
-        If set to auto, and underlying item has title, then slugify the title.
+        If set to auto, and underlying item has title, then slugify the title
+        (once per title, as the slug is read on every publish).
         Otherwise return the string value for this attribute.
         """
-        if self._auto and self._wp_item.title:
-            return slugify.slugify(self._wp_item.title)
+        title = self._wp_item.title
+        if self._auto and title:
+            if title != self._slug_title:
+                self._slug = slugify.slugify(title)
+                self._slug_title = title
+            return self._slug
         else:
             return self._value
 
@@ -214,6 +236,10 @@ class WordPressItem(object):
         # This allows late-loading items that may not be needed.
         # The key is not important - just used to avoid duplicate items.
         self._ref_wp_items = dict()
+        # Callables that add items to `_ref_wp_items`, called once before
+        #  the referenced items are first needed.
+        # This allows late-parsing attributes that refer to other items.
+        self._ref_wp_items_loaders = list()
     
     @property
     def ref_items(self):
@@ -223,6 +249,8 @@ class WordPressItem(object):
                 yield item
         # Then yield items referenced in the content, potentially late-loading
         #  them for the first time (and caching the results ofcourse).
+        while self._ref_wp_items_loaders:
+            self._ref_wp_items_loaders.pop(0)()
         for k in self._ref_wp_items:
             item = self._ref_wp_items[k]
             if not isinstance(item, WordPressItem):
@@ -231,6 +259,16 @@ class WordPressItem(object):
                 self._ref_wp_items[k] = item
             yield item
     
+    def payload(self):
+        """Return a dictionary of the fields published for this item."""
+        raise NotImplementedError()
+    
+    def fingerprint(self):
+        """Return a hex digest of the fields published for this item,
+        to tell whether publishing it again would change anything."""
+        return hashlib.sha1(json.dumps(_normalize_payload(self.payload()),
+                                       sort_keys=True)).hexdigest()
+    
     def post_stub(self, wp_wrapper):
         """Post this WordPress item as a stub item, and update the ID.
         
@@ -247,7 +285,7 @@ class WordPressItem(object):
         
         :type wp_wrapper: WordPressApiWrapper
         :param xml_post: An up-to-date XML-RPC post object to update from.
-        :type xml_post: XmlRpcPost
+        :type xml_post: wordpress_xmlrpc.WordPressPost
         """
         # TODO: use attributes dictionary to do this automatically
         self.last_modified = xml_post.date_modified
@@ -263,7 +301,7 @@ class WordPressImageAttachment(WordPressItem):
     def fromWpMediaItem(cls, wp_media_item):
         """Build a new ImageAttachment instance based on a XmlRpc Media object.
         
-        :type wp_media_item: XmlRpcMedia
+        :type wp_media_item: wordpress_xmlrpc.WordPressMedia
         """
         new_object = cls()
         mapping = [
@@ -292,6 +330,13 @@ class WordPressImageAttachment(WordPressItem):
 #                        '[/caption]' % (self.id, imtag, self.caption)
 #             return imtag
     
+    def payload(self):
+        # The image itself is uploaded only with the stub
+        return {'title': self.title,
+                'description': self.description,
+                'caption': self.caption,
+                'parent_id': getattr(self.parent, 'id', None)}
+    
     @property
     def image_data(self):
         """Image attachment binary data."""
@@ -323,7 +368,7 @@ class WordPressImageAttachment(WordPressItem):
         data = {
             'name': self.filename,
             'type': self.mimetype,
-            'bits': xmlrpc_client.Binary(self.image_data),
+            'bits': xmlrpclib.Binary(self.image_data),
             }
         response = wp_wrapper.upload_file(data)
         self.id = int(response.get('id'))
@@ -363,6 +408,11 @@ class WordPressImageAttachment(WordPressItem):
         self.update_auto_attributes(wp_wrapper, as_post)
 
 class WordPressPost(WordPressItem):
+    
+    # Fields of the XML-RPC object published for a post
+    payload_fields = ('id', 'title', 'content', 'slug', 'post_status',
+                      'thumbnail', 'terms_names', 'parent_id', 'date',
+                      'custom_fields')
 
     @classmethod
     def fromWpPost(cls, wp_post):
@@ -423,7 +473,7 @@ class WordPressPost(WordPressItem):
         with fields populated from the WP attributes of this instance.
         
         :param orig_post: Existing WordPress post for this instance.
-        :type orig_post: XmlRpcPost
+        :type orig_post: wordpress_xmlrpc.WordPressPost
         """
         if orig_post:
             post = orig_post
@@ -493,12 +543,17 @@ class WordPressPost(WordPressItem):
                              ','.join(self.seo_keywords))
         return post
     
+    def payload(self):
+        post = self.as_xml_rpc_obj()
+        return dict((name, getattr(post, name, None))
+                    for name in self.payload_fields)
+    
     def xml_rpc_object(self):
         """Return a new XML-RPC object for this instance type."""
         if self.post_type in ('post',):
-            return XmlRpcPost()
+            return wordpress_xmlrpc.WordPressPost()
         elif self.post_type in ('page',):
-            return XmlRpcPage()
+            return wordpress_xmlrpc.WordPressPage()
         raise ValueError('Invalid post type "%s"', self.post_type)
     
     def upload_new_stub(self, wp_wrapper):
@@ -541,36 +596,66 @@ class WordPressApiWrapper(object):
         :param username: Username to login to Wordpress site with API rights.
         :param password: Password to Wordpress account for user.
         """
-        self._init_wp_client(xmlrpc_url, username, password)
+        # The client is initialized on first use
+        self._init_lock = threading.Lock()
+        self._client_options = (xmlrpc_url, username, password)
+    
+    def __getattr__(self, name):
+        # Initialize the client on first access
+        if '_wp' == name and '_init_lock' in self.__dict__:
+            with self._init_lock:
+                options = self.__dict__.get('_client_options')
+                if options:
+                    self._init_wp_client(*options)
+                    del self.__dict__['_client_options']
+            if name in self.__dict__:
+                return self.__dict__[name]
+        raise AttributeError(name)
     
     def _init_wp_client(self, xmlrpc_url, username, password):
-        self._wp = Client(xmlrpc_url, username, password)
+        self._wp = wordpress_xmlrpc.Client(
+            xmlrpc_url, username, password,
+            transport=metrics.xmlrpc_transport(xmlrpc_url))
+    
+    @metrics.instrumented('wordpress')
+    def get_media_library(self, parent_id=None):
+        """Wrapper for invoking the GetMediaLibrary method."""
+        return self._wp.call(media.GetMediaLibrary(
+                            {'parent_id': parent_id and str(parent_id)}))
     
     def media_item_generator(self, parent_id=None):
         """Generates WordPress attachment objects."""
-        for media_item in self._wp.call(media.GetMediaLibrary(
-                            {'parent_id': parent_id and str(parent_id)})):
+        for media_item in self.get_media_library(parent_id):
             wp_image = WordPressImageAttachment.fromWpMediaItem(media_item)
             logger.debug(u'Yielding WordPress media item %s', wp_image)
             yield wp_image
     
+    @metrics.instrumented('wordpress')
+    def get_posts(self):
+        """Wrapper for invoking the GetPosts method."""
+        return self._wp.call(posts.GetPosts())
+    
     def post_generator(self):
         """Generate WordPress post objects."""
-        for post in self._wp.call(posts.GetPosts()):
+        for post in self.get_posts():
             yield post
     
+    @metrics.instrumented('wordpress')
     def new_post(self, xmlrpc_post):
         """Wrapper for invoking the NewPost method."""
         return self._wp.call(posts.NewPost(xmlrpc_post))
     
+    @metrics.instrumented('wordpress')
     def get_post(self, post_id):
         """Wrapper for invoking the GetPost method."""
         return self._wp.call(posts.GetPost(post_id))
     
+    @metrics.instrumented('wordpress')
     def edit_post(self, xmlrpc_post):
         """Wrapper for invoking the EditPost method."""
         return self._wp.call(posts.EditPost(xmlrpc_post.id, xmlrpc_post))
     
+    @metrics.instrumented('wordpress')
     def upload_file(self, data):
         """Wrapper for invoking the upload file to the blog method."""
         return self._wp.call(media.UploadFile(data))
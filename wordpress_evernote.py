@@ -1,14 +1,33 @@
 #!/usr/bin/python2.7
 # -*- coding: utf-8 -*-
 import re
+import sys
+import time
 import argparse
 from xml.etree import ElementTree as ET
 import cgi
 import csv
+import Queue
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from collections import namedtuple
+from contextlib import contextmanager
 from datetime import datetime
+# Imported before worker threads parse dates (avoiding a Python 2 race)
+import _strptime
 
 import settings
 import common
+import metrics
+import backlinks
+import checkpoint
+import disk_cache
+import id_map
+import planner
+import pipeline
+import profiling
+import xml_backend
 from wordpress import WordPressApiWrapper, WordPressPost, WordPressAttribute
 from wordpress import WordPressItem, WordPressImageAttachment
 from my_evernote import EvernoteApiWrapper
@@ -19,15 +38,62 @@ wp_en_parser = argparse.ArgumentParser(
 wp_en_parser.add_argument('--wordpress',
                           #default='default',
                           help='WordPress account name to use from settings.')
+wp_en_parser.add_argument('--metrics_prom', metavar='PATH',
+                          help='Write API call metrics to file, in '
+                          'Prometheus text format.')
+wp_en_parser.add_argument('--metrics_json', metavar='PATH',
+                          help='Write API call metrics to file, as JSON.')
+wp_en_parser.add_argument('--metrics_interval', type=float, metavar='SECONDS',
+                          help='Write metrics periodically, and not only '
+                          'at the end of the run.')
+wp_en_parser.add_argument('--checkpoint', metavar='PATH',
+                          default='tomato-checkpoint.json',
+                          help='Progress checkpoint file of sync, preprocess '
+                          'and detach (default: %(default)s).')
+wp_en_parser.add_argument('--limit', type=int, metavar='N',
+                          help='Stop sync, preprocess or detach after N notes, '
+                          'keeping the checkpoint to continue with --resume.')
+wp_en_parser.add_argument('--evernote_budget', type=int, metavar='CALLS',
+                          help='Evernote API calls left in the current hour, '
+                          'for plans (default: the hourly quota in settings).')
+wp_en_parser.add_argument('--profile', nargs='?', const='cprofile',
+                          choices=('cprofile', 'sample'),
+                          help='Run the command under a profiler '
+                          '(default: cprofile), and write profile files.')
+wp_en_parser.add_argument('--profile_output', metavar='PREFIX',
+                          default='tomato-profile',
+                          help='Path prefix of profile output files '
+                          '(default: %(default)s).')
+wp_en_parser.add_argument('--profile_top', type=int, default=15, metavar='N',
+                          help='Number of entries in profile summary lists.')
 subparsers = wp_en_parser.add_subparsers()
 
 logger = common.logger.getChild('wordpress-evernote')
 
+# Placeholder for Evernote link in content lines rendered by a parser worker.
+ref_placeholder_re = re.compile('\x00(?P<index>\d+)\x00')
+
 ###############################################################################
 
 class NoteParserError(Exception):
     pass
 
+class NoteUpdateError(Exception):
+    """Failed writing notes of a note update session."""
+    
+    def __init__(self, guids):
+        super(NoteUpdateError, self).__init__(
+            'Failed writing notes %s' % (', '.join(guids)))
+        self.guids = guids
+
+# Result of parsing and rendering a note in a parser worker process.
+# `metadata` is the serialized normalized metadata div,
+# `content_lines` are the rendered Markdown content lines, with placeholders
+#  for Evernote links, that are listed in `content_refs` as (href, text),
+# `links` lists all Evernote links referenced by the note.
+ParsedNote = namedtuple('ParsedNote', ['metadata', 'content_lines',
+                                       'content_refs', 'links'])
+
 class WpEnAttribute(WordPressAttribute):
     """WordPress attribute from Evernote note."""
     
@@ -127,25 +193,50 @@ class WpEnLinkAttribute(WpEnAttribute):
 class WpEnContent(WpEnAttribute):
     """WordPress content attribute from Evernote note."""
     
-    def __init__(self, node, wp_item, adaptor):
+    def __init__(self, node, wp_item, adaptor, prerendered=None,
+                 node_loader=None):
         """Initialize WordPress content attribute from Evernoten note.
         
         Do not render the content on initialization, only on read.
         Do scan the a-tags in the content and update the underlying item
          ref-items list.
+        If the content node is not parsed yet (given as `node_loader`),
+         scan the a-tags only when the item ref-items are needed.
         
         :type node: xml.etree.ElementTree.Element
         :type wp_item: wordpress.WordPressItem
         :type adaptor: EvernoteApiWrapper
+        :param prerendered: Optional `(content_lines, content_refs)` tuple,
+                            as returned by `render_content_lines()`, to use
+                            instead of rendering `node`.
+        :param node_loader: Callable that returns the content node, to use
+                            when `node` is None.
         """
         super(WpEnContent, self).__init__('', wp_item, adaptor)
         self._cached_rendered_content = None
         self._content_node = node
-        self._find_ref_items()
+        self._node_loader = node_loader
+        self._prerendered = prerendered
+        if node is None and prerendered is None:
+            wp_item._ref_wp_items_loaders.append(lambda: self.content_node)
+        else:
+            self._find_ref_items()
+    
+    @property
+    def content_node(self):
+        """The content node, parsed on first access if needed."""
+        if self._content_node is None:
+            self._content_node = self._node_loader()
+            self._find_ref_items()
+        return self._content_node
     
     def _find_ref_items(self):
-        for a_tag in self._content_node.findall('.//a'):
-            href = a_tag.get('href', '')
+        if self._prerendered is not None:
+            hrefs = [href for href, _ in self._prerendered[1]]
+        else:
+            hrefs = [a_tag.get('href', '')
+                     for a_tag in self.content_node.findall('.//a')]
+        for href in hrefs:
             if EvernoteApiWrapper.is_evernote_url(href):
                 # Add a late-loading function in case this will never be needed
                 def load_item(link):
@@ -180,18 +271,22 @@ class WpEnContent(WpEnAttribute):
                                                                  d['hanchor'],
                                                                  d['htext'])
     
-    def _render_node_as_markdown(self):
-        if self._cached_rendered_content:
-            return self._cached_rendered_content
+    @staticmethod
+    def render_content_lines(content_node):
+        """Return `(content_lines, content_refs)` rendered from content node.
         
-        def render_line_element(e, line_so_far):
+        Evernote links are rendered as placeholders, because rendering them
+        requires the referenced items. `content_refs` lists the (href, text)
+        of these links, by placeholder index.
+        """
+        content_refs = list()
+        def render_line_element(e):
             tag = e.tag.lower()
             if 'a' == tag:
                 href = e.get('href', '')
-                text = e.text
                 if EvernoteApiWrapper.is_evernote_url(href):
-                    ref_item = self._adaptor.wp_item_from_note(href)
-                    return ref_item.markdown_ref(text)
+                    content_refs.append((href, e.text))
+                    return '\x00%d\x00' % (len(content_refs) - 1)
                 else:
                     return href
             elif 'span' == tag:
@@ -200,22 +295,36 @@ class WpEnContent(WpEnAttribute):
                 return '&#x2751;'
             elif 'en-media' == tag:
                 logger.warn('Unexpected en-media element in content: %s',
-                            ET.tostring(e))
+                            common.Lazy(ET.tostring, e))
                 return ''
             else:
                 raise NoteParserError('Invalid tag "%s" in content paragraph' %
                                       (ET.tostring(e)))
         content_lines = list()
         # Render content using DFS iteration of node
-        for p in self._content_node:
+        for p in content_node:
             # Content node is expected to contain only p-tags, one per line.
             assert('p' == p.tag.lower())
             assert(p.tail is None)
             line = p.text or ''
             for e in p:
-                line += render_line_element(e, line) or ''
+                line += render_line_element(e) or ''
                 line += e.tail or ''
             content_lines.append(line)
+        return content_lines, content_refs
+    
+    def _render_node_as_markdown(self):
+        if self._cached_rendered_content:
+            return self._cached_rendered_content
+        if self._prerendered is None:
+            self._prerendered = self.render_content_lines(self.content_node)
+        content_lines, content_refs = self._prerendered
+        def render_ref(m):
+            href, text = content_refs[int(m.group('index'))]
+            ref_item = self._adaptor.wp_item_from_note(href)
+            return ref_item.markdown_ref(text) or ''
+        content_lines = [ref_placeholder_re.sub(render_ref, line)
+                         for line in content_lines]
         self.post_process_content_lines(content_lines)
         self._cached_rendered_content = '\n'.join(content_lines)
         return self._cached_rendered_content
@@ -226,9 +335,187 @@ class WpEnContent(WpEnAttribute):
         assert('markdown' == self._wp_item.content_format)
         return self._render_node_as_markdown()
 
+class ReferenceGraph(object):
+    """Graph of Evernote notes referenced (transitively) by a root note."""
+    
+    def __init__(self, root_guid):
+        self.root_guid = root_guid
+        # Referenced note GUIDs, by referring note GUID
+        self.edges = dict()
+        # Note GUIDs, by breadth-first level
+        self.levels = list()
+        # Note titles, by GUID (missing for notes that failed loading)
+        self.titles = dict()
+    
+    def find_cycles(self):
+        """Return a list of reference cycles, as lists of note GUIDs.
+        
+        Every cycle is reported once, starting from the note first reached
+        from the root note.
+        """
+        cycles = list()
+        # Iterative DFS, keeping the current path to report cycles
+        path, path_index, done = list(), dict(), set()
+        stack = [(self.root_guid, iter(self.edges.get(self.root_guid, [])))]
+        path.append(self.root_guid)
+        path_index[self.root_guid] = 0
+        while stack:
+            guid, refs = stack[-1]
+            for ref_guid in refs:
+                if ref_guid in path_index:
+                    # Back edge - a cycle
+                    cycles.append(path[path_index[ref_guid]:])
+                elif ref_guid not in done:
+                    path_index[ref_guid] = len(path)
+                    path.append(ref_guid)
+                    stack.append(
+                        (ref_guid, iter(self.edges.get(ref_guid, []))))
+                    break
+            else:
+                stack.pop()
+                path.pop()
+                del path_index[guid]
+                done.add(guid)
+        return cycles
+    
+    def _name(self, guid):
+        return u'"%s" (%s)' % (self.titles.get(guid, '?'), guid)
+    
+    def report(self):
+        """Log the graph (at debug level), and warn about reference
+        cycles."""
+        logger.debug('Reference graph of note %s: %d notes in %d levels',
+                     self._name(self.root_guid), len(self.edges),
+                     len(self.levels))
+        for depth, level in enumerate(self.levels):
+            for guid in level:
+                logger.debug('  [%d] %s -> %s', depth, self._name(guid),
+                             ', '.join(self._name(ref_guid) for ref_guid
+                                       in self.edges.get(guid, [])) or '-')
+        for cycle in self.find_cycles():
+            logger.warn('Reference cycle: %s',
+                        ' -> '.join(self._name(guid)
+                                    for guid in cycle + cycle[:1]))
+        return self
+
+class NoteUpdateSession(object):
+    """Pending updates of notes, written once per note when flushed.
+    
+    Posting a note can update its metadata twice (the ID and link of a new
+    stub, and the attributes of the published item), after preprocessing
+    already changed its content. The updates of a note are applied to its
+    content as they are made, to one parsed document, and the note is
+    written to Evernote once, when the session is flushed.
+    """
+    
+    def __init__(self, en_wrapper, on_written=None):
+        """Initialize session.
+        
+        :type en_wrapper: my_evernote.EvernoteApiWrapper
+        :param on_written: Optional function called with every written note.
+        """
+        self.evernote = en_wrapper
+        self.on_written = on_written
+        self._lock = threading.RLock()
+        # Notes to write, by GUID
+        self._pending = dict()
+        # Parsed documents by note GUID, as (note content, root element)
+        self._parsed = dict()
+    
+    def __len__(self):
+        return len(self._pending)
+    
+    def __contains__(self, guid):
+        with self._lock:
+            return guid in self._pending
+    
+    def add(self, note):
+        """Add a note with changed content, to write when flushed."""
+        with self._lock:
+            self._pending[note.guid] = note
+    
+    def update_metadata(self, note, attrs_to_update):
+        """Update metadata attributes of a note, and return whether the note
+        was modified (see `EvernoteWordpressAdaptor.update_note_metdata()`).
+        """
+        with self._lock:
+            content, root = self._parsed.get(note.guid, (None, None))
+            if content is not note.content:
+                # Not parsed yet, or the content was changed since
+                root = EvernoteWordpressAdaptor._parse_xml_from_string(
+                    note.content)
+            if not EvernoteWordpressAdaptor._update_metadata_nodes(
+                    root, attrs_to_update):
+                logger.info('No changes to note content')
+                return False
+            # Replacing pairs of spaces with '\xa0 ' or ' \xa0' in order to
+            #  have all whitespace displayed as expected in Evernote editor.
+            note.content = EvernoteWordpressAdaptor.evernote_encode(
+                '\n'.join([
+                    '<?xml version="1.0" encoding="UTF-8" standalone="no"?>',
+                    '<!DOCTYPE en-note SYSTEM '
+                    '"http://xml.evernote.com/pub/enml2.dtd">',
+                    ET.tostring(root)]))
+            self._parsed[note.guid] = (note.content, root)
+            self._pending[note.guid] = note
+            return True
+    
+    def flush(self, guids=None):
+        """Write the pending notes (or the pending notes of `guids`),
+        and return the number of notes written.
+        
+        Every pending note is tried, and removed from the session once
+        written. Notes that failed to be written are kept (to be written
+        by a later flush, or discarded), and reported by a NoteUpdateError
+        after all the notes were tried.
+        
+        Notes are written out of the session lock, so that other threads
+        can update notes meanwhile. A note updated while it was written
+        is kept, to be written again.
+        """
+        with self._lock:
+            if guids is None:
+                guids = self._pending.keys()
+            to_write = [(guid, self._pending[guid],
+                         self._pending[guid].content)
+                        for guid in guids if guid in self._pending]
+        written = 0
+        failed = list()
+        for guid, note, content in to_write:
+            logger.info('Writing modified content back to note')
+            try:
+                self.evernote.updateNote(note)
+            except Exception, e:
+                logger.warning('Failed writing note "%s" (GUID %s): %s',
+                               note.title, guid, e)
+                failed.append(guid)
+                continue
+            with self._lock:
+                if self._pending.get(guid) is note and \
+                        note.content is content:
+                    del self._pending[guid]
+                    self._parsed.pop(guid, None)
+            written += 1
+            if self.on_written:
+                self.on_written(note)
+        if failed:
+            raise NoteUpdateError(failed)
+        return written
+    
+    def discard(self, guids):
+        """Drop the pending updates of notes by GUID."""
+        with self._lock:
+            for guid in guids:
+                self._pending.pop(guid, None)
+                self._parsed.pop(guid, None)
+
 class EvernoteWordpressAdaptor(object):
     """Evernote-Wordpress Adaptor class."""
     
+    # Serializes parsing notes into shared parses, so every note is parsed
+    #  once by the adaptors sharing them
+    _shared_parses_lock = threading.Lock()
+    
     @staticmethod
     def norm_enc(in_str):
         return in_str.replace(u'\xa0', u' ').encode('utf-8')
@@ -243,24 +530,15 @@ class EvernoteWordpressAdaptor(object):
     @staticmethod
     def _parse_xml_from_string(xml_string):
         """Return parsed ElementTree from xml_string."""
-        parser = ET.XMLParser()
-        # Default XMLParser is not full XHTML, so it doesn't know about all
-        # valid XHTML entities (such as &nbsp;), so the following code is
-        # needed in order to allow these entities.
-        # (see: http://stackoverflow.com/questions/7237466 and
-        #       http://stackoverflow.com/questions/14744945 )
-        # Valid XML entities: quot, amp, apos, lt and gt.
-        parser.parser.UseForeignDTD(True)
-        parser.entity['nbsp'] = ' '
-        if isinstance(xml_string, str):
-            xml_string = xml_string.decode('utf-8')
-        return ET.fromstring(EvernoteWordpressAdaptor.norm_enc(xml_string),
-                             parser=parser)
+        return xml_backend.get_backend().fromstring(xml_string)
     
     @staticmethod
-    def _parse_note_xml(note_content):
+    def _parse_note_xml(note_content, metadata_only=False):
         """Return a normalized Element tree root from note content XML string.
         
+        If `metadata_only` is set, stop parsing at the `<hr/>` that ends the
+        metadata section, leaving the content `div` empty.
+        
         A normalized WordPress item note is as follows:
         1. Root `en-note` element.
         1.1. `div` node with id `metadata`
@@ -271,21 +549,25 @@ class EvernoteWordpressAdaptor(object):
         1.2.1. `p` node for every content paragraph, containing text and/or
                `a` nodes.
         """
-        root = EvernoteWordpressAdaptor._parse_xml_from_string(note_content)
+        if metadata_only:
+            root = xml_backend.get_backend().parse_until(note_content, 'hr')
+        else:
+            root = EvernoteWordpressAdaptor._parse_xml_from_string(
+                note_content)
         norm_root = ET.Element('en-note')
         norm_meta = ET.SubElement(norm_root, 'div', id='metadata')
         norm_content = ET.SubElement(norm_root, 'div', id='content')
-        global stage
-        stage = 'meta'
+        # Set by parse_node (in a list, as closures can't rebind)
+        stage = ['meta']
         def fix_text(text):
             return text and text.strip('\n\r') or ''
         def get_active_node():
-            if 'meta' == stage:
+            if 'meta' == stage[0]:
                 return norm_meta
-            elif 'content' == stage:
+            elif 'content' == stage[0]:
                 return norm_content
             else:
-                raise NoteParserError('Invalid stage "%s"' % (stage))
+                raise NoteParserError('Invalid stage "%s"' % (stage[0]))
         def append_tail(text):
             if text:
                 p = ET.SubElement(get_active_node(), 'p')
@@ -298,11 +580,10 @@ class EvernoteWordpressAdaptor(object):
             if tag in ('hr', ):
                 # End of metadata section
                 assert(not root.text and (0 == len(root)))
-                global stage
-                if 'meta' == stage:
-                    stage = 'content'
+                if 'meta' == stage[0]:
+                    stage[0] = 'content'
                 else:
-                    raise NoteParserError('Invalid stage "%s"' % (stage))
+                    raise NoteParserError('Invalid stage "%s"' % (stage[0]))
                 p = ET.SubElement(get_active_node(), 'p')
                 tail_p = append_tail(tail)
                 return tail_p if tail_p is not None else p
@@ -358,7 +639,8 @@ class EvernoteWordpressAdaptor(object):
         # Cleanup DOM (regression of rogue <br /> in a-element)
         for bad_a in root.findall('.//a/br/..'):
             logger.warn('Removing rogue a-node with br-child (%s), '
-                        'and inserting br-node instead', ET.tostring(bad_a))
+                        'and inserting br-node instead',
+                        common.Lazy(ET.tostring, bad_a))
             tail = bad_a.tail
             bad_a.clear()
             bad_a.tag = 'br'
@@ -396,17 +678,47 @@ class EvernoteWordpressAdaptor(object):
                 top_level_div.remove(p)
         return norm_root
     
-    def __init__(self, en_wrapper, wp_wrapper):
+    def __init__(self, en_wrapper, wp_wrapper, shared_parses=None,
+                 backlink_index=None, fingerprints=None):
         """Initialize Adaptor instance with API wrapper objects.
         
         :param en_wrapper: Initialized Evernote API wrapper instance.
         :type en_wrapper: my_evernote.EvernoteApiWrapper
         :param wp_wrapper: Initialized Wordpress API wrapper instance.
         :type wp_wrapper: wordpress.WordPressApiWrapper
+        :param shared_parses: Optional dictionary of parsed notes, shared
+                              by adaptors publishing the same notes to
+                              different sites, so every note is parsed once.
+        :param backlink_index: Optional index of the references between
+                               posted notes, to republish the notes referring
+                               to a note posted with a new ID or link.
+        :type backlink_index: backlinks.BacklinkIndex
+        :param fingerprints: Optional map of the fingerprints of the items
+                             last published from notes, to skip publishing
+                             items that would not change.
+        :type fingerprints: common.JsonFileMap
         """
         self.evernote = en_wrapper
         self.wordpress = wp_wrapper
+        self.backlinks = backlink_index
+        self.fingerprints = fingerprints
+        # Session of note updates, written when flushed, or `None` to write
+        #  every update
+        self.session = None
+        # GUIDs of published notes with pending updates, whose update
+        #  sequence numbers are recorded when written
+        self._unwritten_usns = set()
+        # Thread pool fetching referenced notes, or `None` out of a context
+        #  of `reference_pool()`
+        self._reference_pool = None
         self.cache = dict()
+        # GUIDs of notes being republished for a referenced note
+        self._republishing = set()
+        # Notes parsed by a parser worker process, by note GUID,
+        #  as (parsed note content, ParsedNote) tuples.
+        self._parsed_notes = dict()
+        # Same, but kept for other adaptors too
+        self._shared_parses = shared_parses
     
     def wp_item_from_note(self, note_link):
         """Factory builder of WordPressItem from Evernote note.
@@ -427,14 +739,26 @@ class EvernoteWordpressAdaptor(object):
         wp_item = WordPressItem()
         wp_item._underlying_en_note = note
         self.cache[guid] = wp_item
-        item_dom = self._parse_note_xml(note.content)
+        prerendered = None
+        def load_content_node():
+            item_dom = self._parse_note_xml(note.content)
+            return item_dom.find(".//div[@id='content']")
+        parsed_content, parsed = self._pop_parsed_note(guid)
+        if parsed and self._is_parse_current(parsed_content, note):
+            metadata_node = ET.fromstring(parsed.metadata)
+            if parsed.content_lines is not None:
+                prerendered = (parsed.content_lines, parsed.content_refs)
+        else:
+            # Parse only the metadata now, and the content when needed
+            item_dom = self._parse_note_xml(note.content, metadata_only=True)
+            metadata_node = item_dom.find(".//div[@id='metadata']")
         # Copy metadata fields to wp_item internal fields
         # Convert from Evernote attribute name to internal name if needed
         name_mappings = {
             'type': 'post_type',
             'hemingwayapp-grade': 'hemingway_grade',
         }
-        for metadata in item_dom.findall(".//div[@id='metadata']/p"):
+        for metadata in metadata_node.findall('p'):
             if metadata.text is None:
                 continue
             if metadata.text.startswith('#'):
@@ -451,8 +775,8 @@ class EvernoteWordpressAdaptor(object):
             # Initialize as WordPress post, and set content
             wp_item.__class__ = WordPressPost
             wp_item.set_wp_attribute(
-                'content', WpEnContent(item_dom.find(".//div[@id='content']"),
-                                       wp_item, self))
+                'content', WpEnContent(None, wp_item, self, prerendered,
+                                       load_content_node))
         else:
             # Initialize as WordPress image attachment, and fetch image
             wp_item.__class__ = WordPressImageAttachment
@@ -465,15 +789,131 @@ class EvernoteWordpressAdaptor(object):
                 logger.warning('Note has too many attached resources (%d). '
                                'Choosing the first one, arbitrarily.',
                                len(note.resources))
-            def fetch_bits(guid, name):
+            def fetch_bits(guid, body_hash, name):
                 def fetch():
                     logger.debug('Fetching image %s', name)
-                    return self.evernote.get_resource_data(guid)
+                    return self.evernote.get_resource_data(guid, body_hash)
                 return fetch
-            wp_item._get_image_data = fetch_bits(resource.guid, note.title)
+            wp_item._get_image_data = fetch_bits(
+                resource.guid, resource.data and resource.data.bodyHash,
+                note.title)
             wp_item._image_mime = resource.mime
         return wp_item
     
+    def _pop_parsed_note(self, guid):
+        """Return the (note content, ParsedNote) tuple parsed earlier for
+        a note, or (None, None)."""
+        parsed = self._parsed_notes.pop(guid, None)
+        if parsed is None and self._shared_parses is not None:
+            parsed = self._shared_parses.get(guid)
+        return parsed or (None, None)
+    
+    def _is_parse_current(self, parsed_content, note):
+        """Return whether note content parsed earlier is the current."""
+        return parsed_content == note.content
+    
+    def parse_note(self, note):
+        """Return the ParsedNote of `note`, parsing it once if parses are
+        shared with other adaptors."""
+        if self._shared_parses is None:
+            return _parse_note(note.content)
+        with self._shared_parses_lock:
+            content, parsed = self._shared_parses.get(note.guid,
+                                                      (None, None))
+            if parsed is None or not self._is_parse_current(content, note):
+                parsed = _parse_note(note.content)
+                self._shared_parses[note.guid] = (note.content, parsed)
+            return parsed
+    
+    @contextmanager
+    def reference_pool(self, workers=4):
+        """Context of a thread pool fetching referenced notes, shared by
+        the reference graphs loaded in it.
+        
+        Nested contexts share the pool of the outer context.
+        """
+        if self._reference_pool is not None:
+            yield self._reference_pool
+            return
+        pool = self._reference_pool = ThreadPool(workers)
+        try:
+            yield pool
+        finally:
+            self._reference_pool = None
+            pool.close()
+            pool.join()
+    
+    def load_reference_graph(self, note_link, workers=4, max_depth=None):
+        """Return the ReferenceGraph of notes referenced by a note.
+        
+        The graph is expanded one breadth-first level at a time, fetching
+        the notes of each level concurrently.
+        Fetched notes are parsed once, and the parsed notes are kept for
+        building their WordPress items later.
+        
+        :param note_link: Evernote note link string, GUID, or note object.
+        :param workers: Maximal number of concurrent note fetches
+                        (unless in a context of `reference_pool()`).
+        :param max_depth: Maximal number of reference levels to expand,
+                          or `None` to expand all the referenced notes.
+        """
+        if hasattr(note_link, 'guid'):
+            root_guid = note_link.guid
+        else:
+            root_guid = EvernoteApiWrapper.get_note_guid(note_link)
+        graph = ReferenceGraph(root_guid)
+        def fetch(guid):
+            try:
+                return self.evernote.get_note(guid)
+            except Exception:
+                logger.exception('Failed fetching referenced note %s', guid)
+        with self.reference_pool(workers) as pool:
+            level = [root_guid]
+            while level:
+                graph.levels.append(level)
+                next_level = list()
+                for guid, note in zip(level, pool.map(fetch, level)):
+                    refs = list()
+                    if note is not None:
+                        graph.titles[guid] = note.title
+                        for ref_guid in self._note_ref_guids(note):
+                            if ref_guid not in refs:
+                                refs.append(ref_guid)
+                    graph.edges[guid] = refs
+                    for ref_guid in refs:
+                        if ref_guid not in graph.edges and \
+                                ref_guid not in next_level:
+                            next_level.append(ref_guid)
+                if max_depth is not None and len(graph.levels) > max_depth:
+                    break
+                level = next_level
+        return graph
+    
+    def _note_ref_guids(self, note):
+        """Generate GUIDs of notes referenced by `note`.
+        
+        The parsed note is kept for building its WordPress item later,
+        unless the item was already built. A note parsed earlier (e.g. by
+        a parser worker) isn't parsed again.
+        """
+        parsed_content, parsed = self._parsed_notes.get(note.guid,
+                                                        (None, None))
+        if parsed is None or not self._is_parse_current(parsed_content, note):
+            try:
+                parsed = self.parse_note(note)
+            except Exception:
+                logger.exception('Failed parsing note "%s" references',
+                                 note.title)
+                return
+            if note.guid not in self.cache and self._shared_parses is None:
+                self._parsed_notes[note.guid] = (note.content, parsed)
+        for link in parsed.links:
+            try:
+                yield EvernoteApiWrapper.get_note_guid(link)
+            except Exception:
+                logger.warn('Invalid note link "%s" in note "%s"',
+                            link, note.title)
+    
     def create_wordpress_stub_from_note(self, wp_item, en_note):
         """Create WordPress item stub from item with no ID.
         
@@ -508,15 +948,59 @@ class EvernoteWordpressAdaptor(object):
         
         :param note_link: Evernote note link string for
                             note with item to publish.
-        :param force: Whether to update based on last modified timestamp,
-                      or always (if set to True).
+        :param force: Whether to update based on last modified timestamp
+                      and the fingerprint of the item, or always
+                      (if set to True).
+        """
+        # The updates of the note (and of referenced notes) are written once
+        with self.update_session(), self.reference_pool():
+            self._post_to_wordpress_from_note(note_link, force)
+    
+    def _is_published(self, note):
+        """Return whether a note (or note metadata) didn't change since it
+        was published, or found unchanged, by its update sequence number."""
+        return (self.fingerprints is not None and
+                note.updateSequenceNum is not None and
+                note.updateSequenceNum == self.fingerprints.get(
+                    note.guid).get('usn'))
+    
+    def _record_published(self, en_note, **attrs):
+        """Record the update sequence number of a note published, or found
+        unchanged, with other `attrs` of the published item, to skip the note
+        until it changes.
+        
+        The update sequence number of a note with pending updates is
+        recorded when the note is written.
         """
+        if self.fingerprints is None:
+            return
+        if self.session is not None and en_note.guid in self.session:
+            self._unwritten_usns.add(en_note.guid)
+        else:
+            attrs['usn'] = en_note.updateSequenceNum
+        if attrs:
+            self.fingerprints.update(en_note.guid, attrs)
+    
+    def _note_written(self, note):
+        if note.guid in self._unwritten_usns:
+            self._unwritten_usns.discard(note.guid)
+            self.fingerprints.update(note.guid,
+                                     {'usn': note.updateSequenceNum})
+    
+    def _post_to_wordpress_from_note(self, note_link, force):
         # Get note from Evernote
         #: :type en_note: evernote.edam.type.ttypes.Note
         en_note = self.evernote.get_note(note_link)
+        if not force and self._is_published(en_note):
+            logger.info('Skipping posting note %s - not changed since '
+                        'published', en_note.title)
+            return
         # Convert Evernote timestamp (ms from epoch) to DateTime object
         # (http://dev.evernote.com/doc/reference/Types.html#Typedef_Timestamp)
         note_updated = datetime.utcfromtimestamp(en_note.updated/1000)
+        # Load the referenced notes (concurrently) before publishing,
+        #  and before building the item, which uses the parsed note
+        self.load_reference_graph(en_note, max_depth=1).report()
         # Create a WordPress item from note
         #: :type wp_item: WordPressItem
         wp_item = self.wp_item_from_note(en_note)
@@ -527,14 +1011,152 @@ class EvernoteWordpressAdaptor(object):
             for ref_wp_item in wp_item.ref_items:
                 self.create_wordpress_stub_from_note(
                     ref_wp_item, ref_wp_item._underlying_en_note)
+            # Writing the note metadata after publishing updates the note,
+            #  so the timestamps alone would have it published again
+            if not force and self.fingerprints is not None and \
+                    wp_item.fingerprint() == self.fingerprints.get(
+                        en_note.guid).get('fingerprint'):
+                logger.info('Skipping posting note %s - not changed since '
+                            'published', en_note.title)
+                self._record_published(en_note)
+                return
             wp_item.update_item(self.wordpress)
             # Update note metadata from published item (e.g. ID for new item)
             self.update_note_metadata_from_wordpress_post(en_note, wp_item)
+            self._record_published(en_note, fingerprint=wp_item.fingerprint())
+            if self.backlinks is not None:
+                self._index_backlinks(en_note, wp_item)
         else:
             logger.info('Skipping posting note %s - not updated recently',
                         en_note.title)
+            self._record_published(en_note)
+    
+    @staticmethod
+    def _item_ref_guids(wp_item):
+        """Generate GUIDs of notes referenced by a posted item,
+        in its content and its link attributes."""
+        for attr_name in ('parent', 'thumbnail', 'project'):
+            href = getattr(wp_item._wp_attrs.get(attr_name), '_href', None)
+            if href and EvernoteApiWrapper.is_evernote_url(href):
+                yield EvernoteApiWrapper.get_note_guid(href)
+        # The content references were found when the item was posted
+        for href in wp_item._ref_wp_items:
+            yield EvernoteApiWrapper.get_note_guid(href)
+    
+    def _index_backlinks(self, en_note, wp_item):
+        """Update the backlink index with a posted note, and republish the
+        notes referring to it, or to the items it refers to, if these were
+        posted with a new ID or link (e.g. new stubs of referenced items)."""
+        self.backlinks.set_refs(en_note.guid, self._item_ref_guids(wp_item))
+        changed = list()
+        for item in [wp_item] + list(wp_item.ref_items):
+            note = item._underlying_en_note
+            if self.backlinks.set_published(note.guid, str(item.id),
+                                            item.link or None):
+                logger.info('Note "%s" has a new ID or link', note.title)
+                changed.append(note.guid)
+        # The posted note is already up to date
+        self._republishing.add(en_note.guid)
+        try:
+            for guid in changed:
+                self.republish_referrers(guid)
+        finally:
+            self._republishing.discard(en_note.guid)
+    
+    def republish_referrers(self, note_guid):
+        """Republish the notes referring to a note, by the backlink index."""
+        referrers = [guid for guid in self.backlinks.referrers(note_guid)
+                     if guid not in self._republishing]
+        logger.info('Republishing %d notes referring to note %s',
+                    len(referrers), note_guid)
+        for guid in referrers:
+            self._republishing.add(guid)
+            try:
+                # Render the item again, with the new references
+                self.cache.pop(guid, None)
+                self.post_to_wordpress_from_note(guid, force=True)
+            except Exception:
+                logger.exception('Failed republishing note %s', guid)
+            finally:
+                self._republishing.discard(guid)
+    
+    @contextmanager
+    def update_session(self):
+        """Context of a session of note updates, written on exit.
+        
+        Nested contexts are part of the outer session.
+        """
+        if self.session is not None:
+            yield self.session
+            return
+        self.session = NoteUpdateSession(self.evernote, self._note_written)
+        try:
+            yield self.session
+        finally:
+            try:
+                self.session.flush()
+            finally:
+                self.session = None
     
-    def sync(self, query, force=False, preprocess=False, image_notebook=None):
+    def _preparse_notes(self, notes, jobs, force=False):
+        """Generate `notes` after parsing and rendering them in a process pool.
+        
+        Notes are fetched in batches in this process, where all API I/O
+        happens, and the next batch is parsed by the pool while the current
+        batch is consumed.
+        
+        :param notes: Iterable of (offset, note metadata) tuples.
+        :param jobs: Number of parser worker processes.
+        :param force: Whether to parse also notes that didn't change since
+                      published (which are skipped otherwise).
+        """
+        def fetch_batch(batch):
+            contents = list()
+            for _, note in batch:
+                if not force and self._is_published(note):
+                    continue
+                try:
+                    contents.append((note.guid,
+                                     self.evernote.get_note(note.guid).content))
+                except Exception:
+                    # Will fail again (and be reported) when posting the note
+                    logger.debug('Failed fetching note %s for parsing',
+                                 note.guid)
+            return contents
+        def submit(batch):
+            contents = fetch_batch(batch)
+            result = pool.map_async(_parse_note_worker,
+                                    [content for _, content in contents])
+            return batch, contents, result
+        def collect(batch, contents, result):
+            for (guid, content), parsed in zip(contents, result.get()):
+                if parsed:
+                    self._parsed_notes[guid] = (content, parsed)
+            return batch
+        pool = multiprocessing.Pool(jobs, common.reset_handler_locks)
+        try:
+            batch_size = jobs * 4
+            batch, pending = list(), None
+            for offset_note in notes:
+                batch.append(offset_note)
+                if batch_size == len(batch):
+                    submitted = submit(batch)
+                    batch = list()
+                    if pending:
+                        for ready in collect(*pending):
+                            yield ready
+                    pending = submitted
+            submitted = batch and submit(batch)
+            for done in (pending, submitted):
+                if done:
+                    for ready in collect(*done):
+                        yield ready
+            pool.close()
+        finally:
+            pool.terminate()
+    
+    def sync(self, query, force=False, preprocess=False, image_notebook=None,
+             jobs=1, checkpoint=None):
         """Sync between WordPress site and notes matched by `query`.
         
         :param query: Evernote query used to find notes for sync.
@@ -542,31 +1164,200 @@ class EvernoteWordpressAdaptor(object):
                       or always (if set to True).
         :param preprocess:     Whether to perform note preprocess.
         :param image_notebook: Notebook for extracted embedded images.
+        :param jobs: Number of processes for parsing and rendering notes.
+        :param checkpoint: Progress checkpoint to save after every note,
+                           and to resume from.
+        :type checkpoint: checkpoint.Checkpoint
         """
-        for _, note in self.evernote.get_notes_by_query(query):
-            logger.info('Posting note "%s" (GUID %s)', note.title, note.guid)
-            try:
-                if preprocess and note.resources:
-                    self.preprocess_embedded_images(note.guid, image_notebook)
-                self.post_to_wordpress_from_note(note.guid, force)
-            except Exception:
-                logger.exception('Failed posting note "%s" (GUID %s)',
-                                 note.title, note.guid)
+        self._post_notes(self._query_notes('sync', query, checkpoint), force,
+                         preprocess, image_notebook, jobs, checkpoint)
+        if checkpoint:
+            checkpoint.finish()
+    
+    def _query_notes(self, phase, query, checkpoint=None):
+        """Generate (offset, note metadata) tuples of notes matched by
+        `query`, resuming from `checkpoint` of `phase` if given."""
+        def get_notes(start_offset):
+            return self.evernote.get_notes_by_query(query,
+                                                    start_offset=start_offset)
+        if checkpoint:
+            return checkpoint.notes(phase, query, get_notes)
+        return get_notes(0)
+    
+    def _post_notes(self, notes, force, preprocess, image_notebook, jobs,
+                    checkpoint=None):
+        """Post `notes`, given as (offset, note metadata) tuples."""
+        if jobs > 1:
+            notes = self._preparse_notes(notes, jobs, force)
+        with self.update_session() as session, self.reference_pool():
+            for offset, note in notes:
+                if not force and self._is_published(note):
+                    # Skipped before fetching and parsing the note
+                    logger.info('Skipping note "%s" (GUID %s) - not changed '
+                                'since published', note.title, note.guid)
+                    if checkpoint:
+                        checkpoint.save(offset, note)
+                    continue
+                logger.info('Posting note "%s" (GUID %s)', note.title,
+                            note.guid)
+                try:
+                    if preprocess and note.largestResourceSize:
+                        self.preprocess_embedded_images(note.guid,
+                                                        image_notebook)
+                    self.post_to_wordpress_from_note(note.guid, force)
+                    # Write the updates of the note (and of the notes it
+                    #  refers to), before it is checkpointed
+                    session.flush()
+                except NoteUpdateError, e:
+                    logger.exception('Failed writing updates of note "%s" '
+                                     '(GUID %s)', note.title, note.guid)
+                    session.discard(e.guids)
+                except Exception:
+                    logger.exception('Failed posting note "%s" (GUID %s)',
+                                     note.title, note.guid)
+                if checkpoint:
+                    checkpoint.save(offset, note)
+    
+    def forget_note(self, note_guid):
+        """Remove a note, and the item parsed from it, from the caches."""
+        self.cache.pop(note_guid, None)
+        self._parsed_notes.pop(note_guid, None)
+        self.evernote.forget_note(note_guid)
+    
+    def watch(self, query, preprocess=False, image_notebook=None, jobs=1,
+              min_interval=10.0, max_interval=300.0, rounds=None):
+        """Watch notes matched by `query`, and post them when they change.
+        
+        Polls the Evernote account sync state, and when it changes, posts
+        the matched notes that changed since the previous poll (all of
+        them on the first poll). The poll interval starts at `min_interval`,
+        doubles after every poll with no change, up to `max_interval`,
+        and drops back to `min_interval` when something changes.
+        
+        The adaptor, its API clients and caches are kept between polls,
+        and only changed notes are removed from the caches.
+        
+        :param query: Evernote query used to find notes to watch.
+        :param rounds: Number of polls, or `None` to poll until interrupted.
+        """
+        last_update_count = None
+        interval = min_interval
+        poll = 0
+        try:
+            while rounds is None or poll < rounds:
+                if poll:
+                    time.sleep(interval)
+                poll += 1
+                try:
+                    update_count = self.evernote.get_sync_state().updateCount
+                    if update_count != last_update_count:
+                        self._post_changed_notes(query, last_update_count,
+                                                 preprocess, image_notebook,
+                                                 jobs)
+                        # Changes made while posting (including by posting)
+                        #  are picked up on the next poll.
+                        last_update_count = update_count
+                        interval = min_interval
+                        continue
+                    logger.debug('No changes (update count %d)', update_count)
+                except Exception:
+                    logger.exception('Failed polling for changes')
+                interval = min(interval * 2, max_interval)
+        except KeyboardInterrupt:
+            logger.info('Stopped watching')
     
-    def detach(self, query):
+    def _post_changed_notes(self, query, since, preprocess, image_notebook,
+                            jobs):
+        """Post notes matched by `query` with an update sequence number above
+        `since` (or all of them, if `since` is `None`)."""
+        changed = [(offset, note) for offset, note
+                   in self.evernote.get_notes_by_query(query)
+                   if since is None or note.updateSequenceNum > since]
+        logger.info('%d changed notes', len(changed))
+        for _, note in changed:
+            self.forget_note(note.guid)
+        self._post_notes(changed, False, preprocess, image_notebook, jobs)
+    
+    def detach(self, query, checkpoint=None, workers=1, detached=None,
+               force=False, retries=2):
         """Detach sync between WordPress site and notes matched by `query`.
         
+        Notes are detached by `workers` threads, in batches.
+        
         :param query: Evernote query used to find notes to detach.
+        :param checkpoint: Progress checkpoint to save after every note,
+                           and to resume from.
+        :param workers: Number of notes detached concurrently.
+        :param detached: Map of the update sequence numbers of detached notes,
+                         to skip notes not updated since they were detached,
+                         without fetching them.
+        :type detached: common.JsonFileMap
+        :param force: Whether to detach also notes not updated since they
+                      were detached.
+        :param retries: Number of retries of a note that failed detaching.
         """
         attrs_to_update = {'id': '<auto>',
                            'link': '<auto>',
                            'last_modified': '<auto>',
                            'published_date':  '<auto>',}
-        for _, note_meta in self.evernote.get_notes_by_query(query):
-            note = self.evernote.get_note(note_meta.guid,
-                                         with_resource_data=False)
-            logger.info('Detaching note "%s" (GUID %s)', note.title, note.guid)
-            self.update_note_metdata(note, attrs_to_update)
+        def detach_note(note_meta):
+            if not force and detached is not None and \
+                    note_meta.updateSequenceNum and \
+                    note_meta.updateSequenceNum == \
+                    detached.get(note_meta.guid).get('usn'):
+                logger.debug('Skipping detached note "%s" (GUID %s)',
+                             note_meta.title, note_meta.guid)
+                return
+            for attempt in xrange(retries + 1):
+                try:
+                    note = self.evernote.get_note(note_meta.guid,
+                                                  with_resource_data=False)
+                    logger.info('Detaching note "%s" (GUID %s)', note.title,
+                                note.guid)
+                    self.update_note_metdata(note, attrs_to_update)
+                    break
+                except Exception:
+                    if attempt == retries:
+                        logger.exception('Failed detaching note "%s" '
+                                         '(GUID %s)', note_meta.title,
+                                         note_meta.guid)
+                        return
+                    logger.warning('Failed detaching note "%s" (GUID %s), '
+                                   'retrying', note_meta.title,
+                                   note_meta.guid, exc_info=True)
+                    self.evernote.forget_note(note_meta.guid)
+                    time.sleep(2 ** attempt)
+            if detached is not None and note.updateSequenceNum:
+                detached.update(note.guid, {'usn': note.updateSequenceNum},
+                                save=False)
+        def detach_batch(batch):
+            if pool:
+                pool.map(detach_note, [note_meta for _, note_meta in batch])
+            else:
+                for _, note_meta in batch:
+                    detach_note(note_meta)
+            if detached is not None:
+                detached.save()
+            if checkpoint:
+                offset, note_meta = batch[-1]
+                checkpoint.save(offset, note_meta)
+        pool = workers > 1 and ThreadPool(workers)
+        batch_size = pool and workers * 4 or 1
+        try:
+            batch = list()
+            for offset_note in self._query_notes('detach', query, checkpoint):
+                batch.append(offset_note)
+                if len(batch) >= batch_size:
+                    detach_batch(batch)
+                    batch = list()
+            if batch:
+                detach_batch(batch)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+        if checkpoint:
+            checkpoint.finish()
     
     def update_note_metdata(self, note, attrs_to_update):
         """Updates an Evernote WP-item note metadata based on dictionary.
@@ -578,10 +1369,21 @@ class EvernoteWordpressAdaptor(object):
         :type note: evernote.edam.type.ttypes.Note
         :param attrs_to_update: Dictionary of attributes to update.
         :type attrs_to_update: dict
+        :returns: Whether the note was modified.
         """
-        global modified_flag
-        modified_flag = False
-        root = self._parse_xml_from_string(note.content)
+        if self.session is not None:
+            return self.session.update_metadata(note, attrs_to_update)
+        session = NoteUpdateSession(self.evernote)
+        modified = session.update_metadata(note, attrs_to_update)
+        session.flush()
+        return modified
+    
+    @staticmethod
+    def _update_metadata_nodes(root, attrs_to_update):
+        """Update metadata attributes in the parsed note content `root`,
+        and return whether any attribute changed."""
+        # Set by update_node_text (in a list, as closures can't rebind)
+        modified_flag = [False]
         def update_node_text(orig_text):
             # Extract attribute name from element
             text = orig_text and orig_text.strip(' \n\r') or ''
@@ -603,8 +1405,7 @@ class EvernoteWordpressAdaptor(object):
                     logger.debug('Changing note attribute "%s" from "%s" '
                                  'to "%s"', attr_name,
                                  current_val, new_val)
-                    global modified_flag
-                    modified_flag = True
+                    modified_flag[0] = True
                     return '%s=%s' % (attr_name, new_val)
             return orig_text
         for e in root.iter():
@@ -615,18 +1416,7 @@ class EvernoteWordpressAdaptor(object):
                 e.text = update_node_text(e.text)
             e.tail = update_node_text(e.tail)
         # TODO: if metadata field doesn't exist - create one?
-        if modified_flag:
-            logger.info('Writing modified content back to note')
-            note.content = self.evernote_encode('\n'.join([
-                '<?xml version="1.0" encoding="UTF-8" standalone="no"?>',
-                '<!DOCTYPE en-note SYSTEM '
-                '"http://xml.evernote.com/pub/enml2.dtd">',
-                ET.tostring(root)]))
-            # Replacing pairs of spaces with '\xa0 ' or ' \xa0' in order to
-            #  have all whitespace displayed as expected in Evernote editor.
-            self.evernote.updateNote(note)
-        else:
-            logger.info('No changes to note content')
+        return modified_flag[0]
     
     def update_note_metadata_from_wordpress_post(self, note, item):
         """Updates an Evernote WP-item note metadata based on Wordpress item.
@@ -654,15 +1444,35 @@ class EvernoteWordpressAdaptor(object):
         self.update_note_metdata(note, attrs_to_update)
     
     def import_images_to_evernote(self, parent_id, notebook_name,
-                                  set_id=None, set_parent=None):
+                                  set_id=None, set_parent=None,
+                                  download_workers=4, create_workers=1,
+                                  max_bytes=64 * 1024 * 1024):
+        """Import WordPress media items into image notes.
+        
+        Images are downloaded (and hashed) by `download_workers` threads,
+        while image notes of downloaded images are created by
+        `create_workers` threads. Downloads wait while `max_bytes` of
+        downloaded images are waiting to be created.
+        
+        :returns: Number of image notes created.
+        """
         overrided_attrs = dict()
         if set_id:
             overrided_attrs['id'] = set_id
         if set_parent:
             overrided_attrs['parent'] = set_parent
-        for wp_image in self.wordpress.media_item_generator(parent_id):
-            save_wp_image_to_evernote(self.evernote, notebook_name, wp_image,
+        def download(wp_image):
+            logger.debug('Downloading image %s', wp_image.filename)
+            return make_wp_image_note(self.evernote, wp_image,
                                       overrides=overrided_attrs)
+        def create(wp_image_note):
+            return self.evernote.saveNoteToNotebook(wp_image_note,
+                                                    notebook_name)
+        importer = pipeline.Pipeline(
+            [('download', download, download_workers),
+             ('create', create, create_workers)],
+            max_bytes, sizeof=lambda note: note.resources[0].data.size)
+        return importer.run(self.wordpress.media_item_generator(parent_id))
     
     def preprocess_embedded_images(self, note_link, image_notebook,
                                    dryrun=False):
@@ -674,20 +1484,13 @@ class EvernoteWordpressAdaptor(object):
         en_note = self.evernote.get_note(note_link)
         if 0 == len(en_note.resources):
             # No embedded images to preprocess
-            logger.info('No embedded images in note "%s"' % (en_note.title))
+            logger.info('No embedded images in note "%s"', en_note.title)
             return
         en_link = self.evernote.note_link(en_note, en_note.title)
         extracted_hashes = set()
+        resources_by_hash = self.evernote.index_resources_by_hash(
+            en_note.resources)
         
-        def bin_to_hex_str(bin_str):
-            return ''.join(['{:02x}'.format(ord(b)) for b in bin_str])
-        def get_resource_by_hex_hash(hex_hash):
-            """Return the resource object with hash matching the given hex_hash
-            string. If no match, nothing is returned.
-            """
-            for res in en_note.resources:
-                if bin_to_hex_str(res.data.bodyHash) == hex_hash:
-                    return res
         def cleanup(text):
             """Return a cleaned up version of the text, or raise an error."""
             for bad_chr in ('<', '>'):
@@ -714,7 +1517,8 @@ class EvernoteWordpressAdaptor(object):
                 logger.warn('Skipping media tag with no hash attribute: %s',
                             media_tag)
                 return
-            resource = get_resource_by_hex_hash(hex_hash)
+            hex_hash = hex_hash.lower()
+            resource = resources_by_hash.get(hex_hash)
             if not resource:
                 logger.warn('Could not find resource matching hex hash %s',
                             hex_hash)
@@ -756,25 +1560,35 @@ class EvernoteWordpressAdaptor(object):
         en_note.content = self.evernote_encode(
             media_element_re.sub(extract_image, en_note.content))
         # Check if note contains resources that were not extracted
-        for res in en_note.resources:
-            if not bin_to_hex_str(res.data.bodyHash) in extracted_hashes:
+        for hex_hash, res in resources_by_hash.iteritems():
+            if not hex_hash in extracted_hashes:
                 res_name = res.attributes.fileName
                 if not res_name:
-                    res_name = bin_to_hex_str(res.data.bodyHash)
+                    res_name = hex_hash
                 logger.warn('Resource %s not extracted', res_name)
         # Update note
         if not dryrun:
-            logger.info('Writing changes back to Evernote')
-            self.evernote.updateNote(en_note)
+            if self.session is not None:
+                self.session.add(en_note)
+            else:
+                logger.info('Writing changes back to Evernote')
+                self.evernote.updateNote(en_note)
     
-    def preprocess(self, query, image_notebook, dryrun=False):
+    def preprocess(self, query, image_notebook, dryrun=False,
+                   checkpoint=None):
         """Perform preprocess pipeline for notes matching query.
         
         :param query: Evernote query used to find notes to preprocess.
         :param image_notebook: Name of Evernote notebook for extracted images.
-        :param dryrun: If `True`, no modifying actions will be performed.
+        :param dryrun: If `True`, no modifying actions will be performed
+                       (and no checkpoint is saved).
+        :param checkpoint: Progress checkpoint to save after every note,
+                           and to resume from.
         """
-        for _, note in self.evernote.get_notes_by_query(query):
+        if dryrun:
+            checkpoint = None
+        for offset, note in self._query_notes('preprocess', query,
+                                              checkpoint):
             logger.info('Preprocessing note "%s" (GUID %s)',
                         note.title, note.guid)
             try:
@@ -783,16 +1597,223 @@ class EvernoteWordpressAdaptor(object):
             except Exception:
                 logger.exception('Failed preprocessing note "%s" (GUID %s)',
                                  note.title, note.guid)
+            if checkpoint:
+                checkpoint.save(offset, note)
+        if checkpoint:
+            checkpoint.finish()
 
-def save_wp_image_to_evernote(en_wrapper, notebook_name, wp_image,
-                              force=False, overrides={}):
-    # TODO: Do this better...
-    #raise NotImplementedError("I'm broken")
-    # lookup existing WordPress image note
-    #note_title = u'%s <%s>' % (wp_image.filename, wp_image.id)
-    #image_note = en_wrapper.getSingleNoteByTitle(note_title, notebook_name)
-#     if not image_note or force:
-    # prepare resource and note
+class MirrorAdaptor(EvernoteWordpressAdaptor):
+    """Evernote-Wordpress Adaptor for a mirror WordPress site.
+    
+    The attributes set by the site (ID, link and dates) are kept in an
+    ID map of the site, instead of the note metadata, and notes are
+    never modified.
+    """
+    
+    # Item attributes of the site, that are kept in the ID map
+    site_attributes = ('id', 'link', 'last_modified', 'published_date')
+    
+    def __init__(self, en_wrapper, wp_wrapper, site_ids,
+                 shared_parses=None):
+        """Initialize mirror Adaptor instance.
+        
+        :param site_ids: The ID map of the site.
+        :type site_ids: id_map.IdMap
+        """
+        # Fingerprints of the site items are kept in the ID map too
+        super(MirrorAdaptor, self).__init__(en_wrapper, wp_wrapper,
+                                            shared_parses,
+                                            fingerprints=site_ids)
+        self.site_ids = site_ids
+    
+    def wp_item_from_note(self, note_link):
+        if isinstance(note_link, basestring):
+            guid = EvernoteApiWrapper.get_note_guid(note_link)
+        else:
+            guid = note_link.guid
+        cached = guid in self.cache
+        wp_item = super(MirrorAdaptor, self).wp_item_from_note(note_link)
+        if not cached:
+            # Replace the attributes of the primary site from the metadata
+            site_attrs = self.site_ids.get(guid)
+            for attr_name in self.site_attributes:
+                wp_item.set_wp_attribute(attr_name, WordPressAttribute.create(
+                    attr_name, site_attrs.get(attr_name, '<auto>'), wp_item))
+        return wp_item
+    
+    def _is_parse_current(self, parsed_content, note):
+        # Notes are parsed once per sync for all sites, but the primary site
+        #  may have updated its attributes in the note metadata since then,
+        #  and these are replaced from the ID map anyway.
+        return parsed_content is not None
+    
+    def update_note_metdata(self, note, attrs_to_update):
+        """Update the site attributes of a note in the site ID map."""
+        self.site_ids.update(note.guid, dict(
+            (attr_name, value) for attr_name, value
+            in attrs_to_update.iteritems()
+            if attr_name in self.site_attributes))
+
+class MultiSitePublisher(object):
+    """Publishes notes to several WordPress sites concurrently.
+    
+    Every note is fetched and parsed once, and then posted by the adaptor
+    of every site, in a worker thread per site.
+    Sites work through the notes independently, up to `backlog` notes
+    ahead of the slowest site.
+    """
+    
+    def __init__(self, adaptors, backlog=20):
+        """Initialize publisher.
+        
+        :param adaptors: Adaptors of the sites, primary site first,
+                         sharing parsed notes.
+        :type adaptors: list of EvernoteWordpressAdaptor
+        :param backlog: Maximal number of notes queued for a site.
+        """
+        self.adaptors = adaptors
+        self.backlog = backlog
+    
+    @property
+    def primary(self):
+        return self.adaptors[0]
+    
+    def sync(self, query, force=False, preprocess=False, image_notebook=None,
+             checkpoint=None):
+        """Sync notes matched by `query` to all sites.
+        
+        See `EvernoteWordpressAdaptor.sync()`. Notes are preprocessed
+        by the primary adaptor, and the checkpoint is saved after a note
+        was posted to all sites.
+        """
+        shared_parses = self.primary._shared_parses
+        pending = list()
+        pending_lock = threading.Lock()
+        def done(offset_note):
+            # Save checkpoint of last note posted to all sites, in order
+            with pending_lock:
+                for entry in pending:
+                    if entry[0] is offset_note:
+                        entry[1] -= 1
+                        break
+                while pending and 0 == pending[0][1]:
+                    offset, note = pending.pop(0)[0]
+                    if shared_parses is not None:
+                        shared_parses.pop(note.guid, None)
+                    # Write the updates of the note only, as the sites
+                    #  ahead already updated the notes after it
+                    try:
+                        session.flush([note.guid])
+                    except NoteUpdateError, e:
+                        logger.exception('Failed writing updates of note '
+                                         '"%s" (GUID %s)', note.title,
+                                         note.guid)
+                        session.discard(e.guids)
+                    if checkpoint:
+                        checkpoint.save(offset, note)
+        def post(adaptor, site_queue):
+            with adaptor.reference_pool():
+                post_notes(adaptor, site_queue)
+        def post_notes(adaptor, site_queue):
+            while True:
+                offset_note = site_queue.get()
+                if offset_note is None:
+                    break
+                _, note = offset_note
+                try:
+                    adaptor.post_to_wordpress_from_note(note.guid, force)
+                except Exception:
+                    logger.exception('Failed posting note "%s" (GUID %s)',
+                                     note.title, note.guid)
+                # Keep taking notes whatever fails, so that a site never
+                #  blocks the notes queued for it
+                try:
+                    done(offset_note)
+                except Exception:
+                    logger.exception('Failed completing note "%s" (GUID %s)',
+                                     note.title, note.guid)
+        # The note updates of the primary site are written after a note
+        #  was posted to all sites
+        with self.primary.update_session() as session:
+            queues = list()
+            threads = list()
+            completed = False
+            for num, adaptor in enumerate(self.adaptors):
+                site_queue = Queue.Queue(self.backlog)
+                thread = threading.Thread(target=post,
+                                          args=(adaptor, site_queue),
+                                          name='site-%d' % (num))
+                thread.daemon = True
+                thread.start()
+                queues.append(site_queue)
+                threads.append(thread)
+            try:
+                for offset_note in self.primary._query_notes('sync', query,
+                                                             checkpoint):
+                    _, note = offset_note
+                    logger.info('Posting note "%s" (GUID %s) to %d sites',
+                                note.title, note.guid, len(self.adaptors))
+                    if preprocess and note.largestResourceSize:
+                        try:
+                            self.primary.preprocess_embedded_images(
+                                note.guid, image_notebook)
+                        except Exception:
+                            logger.exception('Failed preprocessing note '
+                                             '"%s" (GUID %s)', note.title,
+                                             note.guid)
+                            continue
+                    try:
+                        self.primary.parse_note(
+                            self.primary.evernote.get_note(note.guid))
+                    except Exception:
+                        # Will fail again (and be reported) when posting
+                        #  the note
+                        logger.debug('Failed parsing note %s', note.guid)
+                    with pending_lock:
+                        pending.append([offset_note, len(queues)])
+                    for site_queue in queues:
+                        site_queue.put(offset_note)
+                completed = True
+            finally:
+                for site_queue in queues:
+                    if not completed:
+                        # Drop the queued notes
+                        while not site_queue.empty():
+                            site_queue.get_nowait()
+                    site_queue.put(None)
+                for thread in threads:
+                    thread.join()
+        if checkpoint:
+            checkpoint.finish()
+
+def _parse_note(note_content):
+    """Return a ParsedNote from note content XML string.
+    
+    The content is rendered only for post and page notes.
+    """
+    item_dom = EvernoteWordpressAdaptor._parse_note_xml(note_content)
+    metadata = item_dom.find(".//div[@id='metadata']")
+    content_lines, content_refs = None, None
+    if any(p.text in ('type=post', 'type=page') for p in metadata):
+        content_lines, content_refs = WpEnContent.render_content_lines(
+            item_dom.find(".//div[@id='content']"))
+    links = [a_tag.get('href') for a_tag in item_dom.iter('a')
+             if EvernoteApiWrapper.is_evernote_url(a_tag.get('href'))]
+    return ParsedNote(ET.tostring(metadata), content_lines, content_refs, links)
+
+def _parse_note_worker(note_content):
+    """Parse and render note content in a parser worker process.
+    
+    Return a ParsedNote, or `None` if parsing failed, in which case the note
+    is parsed again (and the error reported) in the main process.
+    """
+    try:
+        return _parse_note(note_content)
+    except Exception:
+        return None
+
+def make_wp_image_note(en_wrapper, wp_image, overrides={}):
+    """Return a new image note of a WordPress image, with image data."""
     resource, resource_tag = en_wrapper.makeResource(wp_image.image_data,
                                                      wp_image.filename)
     note_content = ''
@@ -803,9 +1824,19 @@ def save_wp_image_to_evernote(en_wrapper, notebook_name, wp_image,
             value = getattr(wp_image, attr)
         note_content += '<div>%s=%s</div>\r\n' % (attr, value)
     note_content += '<hr/>\r\n%s' % (resource_tag)
-    wp_image_note = en_wrapper.makeNote(title=wp_image.filename,
-                                        content=note_content,
-                                        resources=[resource])
+    return en_wrapper.makeNote(title=wp_image.filename, content=note_content,
+                               resources=[resource])
+
+def save_wp_image_to_evernote(en_wrapper, notebook_name, wp_image,
+                              force=False, overrides={}):
+    # TODO: Do this better...
+    #raise NotImplementedError("I'm broken")
+    # lookup existing WordPress image note
+    #note_title = u'%s <%s>' % (wp_image.filename, wp_image.id)
+    #image_note = en_wrapper.getSingleNoteByTitle(note_title, notebook_name)
+#     if not image_note or force:
+    # prepare resource and note
+    wp_image_note = make_wp_image_note(en_wrapper, wp_image, overrides)
 #     if image_note:
 #         # note exists
 #         logger.info('WP Image note "%s" exists in Evernote', note_title)
@@ -823,26 +1854,158 @@ def save_wp_image_to_evernote(en_wrapper, notebook_name, wp_image,
 
 ###############################################################################
 
+def _get_wp_wrapper(site_name):
+    wp_account = settings.WORDPRESS[site_name]
+    # Each entry can be either a WordPressCredentials object,
+    # or a name of another entry.
+    while not isinstance(wp_account, settings.WordPressCredentials):
+        wp_account = settings.WORDPRESS[wp_account]
+    logger.debug('Working with WordPress at URL "%s"',
+                 wp_account.xmlrpc_url)
+    return WordPressApiWrapper(wp_account.xmlrpc_url,
+                               wp_account.username,
+                               wp_account.password)
+
 def _get_adaptor(args):
     if args.wordpress:
-        wp_account = settings.WORDPRESS[args.wordpress]
-        # Each entry can be either a WordPressCredentials object,
-        # or a name of another entry.
-        while not isinstance(wp_account, settings.WordPressCredentials):
-            wp_account = settings.WORDPRESS[wp_account]
-        logger.debug('Working with WordPress at URL "%s"',
-                     wp_account.xmlrpc_url)
-        wp_wrapper = WordPressApiWrapper(wp_account.xmlrpc_url,
-                                         wp_account.username,
-                                         wp_account.password)
+        wp_wrapper = _get_wp_wrapper(args.wordpress)
     else:
         wp_wrapper = None
-    en_wrapper = EvernoteApiWrapper(settings.enDevToken_PRODUCTION)
-    return EvernoteWordpressAdaptor(en_wrapper, wp_wrapper)
+    en_wrapper = EvernoteApiWrapper(
+        settings.enDevToken_PRODUCTION,
+        service_host=getattr(settings, 'EVERNOTE_SERVICE_HOST', None),
+        pool_size=getattr(settings, 'EVERNOTE_POOL_SIZE', 4),
+        disk_cache=_get_disk_cache(),
+        page_sizes=common.JsonFileMap(getattr(
+            settings, 'EVERNOTE_PAGE_SIZES_PATH', 'tomato-page-sizes.json')))
+    return EvernoteWordpressAdaptor(
+        en_wrapper, wp_wrapper, backlink_index=backlinks.BacklinkIndex(getattr(
+            settings, 'BACKLINKS_PATH', 'tomato-backlinks.json')),
+        fingerprints=common.JsonFileMap(getattr(
+            settings, 'FINGERPRINTS_PATH', 'tomato-fingerprints.json')))
+
+def sync(adaptor, args):
+    """ArgParse handler for sync command."""
+    if args.plan and not _check_plan(adaptor, args, 'sync'):
+        logger.error('Not running a sync exceeding the Evernote calls budget')
+        sys.exit(1)
+    if not args.mirror:
+        adaptor.sync(args.query, args.force, args.preprocess,
+                     args.image_notebook, args.jobs, _get_checkpoint(args))
+        return
+    # Publish to the primary site and the mirror sites, sharing parsed notes
+    shared_parses = dict()
+    adaptors = [EvernoteWordpressAdaptor(adaptor.evernote, adaptor.wordpress,
+                                         shared_parses, adaptor.backlinks,
+                                         adaptor.fingerprints)]
+    id_map_path = getattr(settings, 'WORDPRESS_ID_MAP_PATH',
+                          'tomato-ids-%s.json')
+    for site_name in args.mirror:
+        adaptors.append(MirrorAdaptor(adaptor.evernote,
+                                      _get_wp_wrapper(site_name),
+                                      id_map.IdMap(id_map_path % (site_name)),
+                                      shared_parses))
+    MultiSitePublisher(adaptors).sync(args.query, args.force, args.preprocess,
+                                      args.image_notebook,
+                                      _get_checkpoint(args))
+
+def preprocess(adaptor, args):
+    """ArgParse handler for preprocess command."""
+    if args.plan and not _check_plan(adaptor, args, 'preprocess'):
+        logger.error('Not running a preprocess exceeding the Evernote calls '
+                     'budget')
+        sys.exit(1)
+    adaptor.preprocess(args.query,
+                       image_notebook=args.image_notebook,
+                       dryrun=args.dryrun,
+                       checkpoint=_get_checkpoint(args))
+
+def _get_checkpoint(args):
+    return checkpoint.Checkpoint(args.checkpoint, args.resume, args.limit)
+
+def _check_plan(adaptor, args, phase):
+    """Print the plan of `phase` command over the query notes,
+    and return whether it is within the Evernote calls budget.
+    
+    A plan exceeding the budget is printed with a split to runs that are
+    within the hourly quota.
+    """
+    plan = planner.Plan(phase, args.query,
+                        adaptor.evernote.get_page_size(args.query),
+                        getattr(args, 'preprocess', False))
+    plan.add_notes(adaptor._query_notes(phase, args.query,
+                                        _get_checkpoint(args)))
+    quota = settings.EVERNOTE_HOURLY_QUOTA
+    budget = quota if args.evernote_budget is None else args.evernote_budget
+    latencies = (getattr(args, 'latencies', None) and
+                 planner.load_latencies(args.latencies))
+    for line in plan.report(budget, quota, latencies):
+        print line
+    if plan.evernote_calls <= budget:
+        return True
+    runs = plan.runs(budget, quota)
+    print ('Exceeds the budget of %d Evernote calls (hourly quota %d). '
+           'Split it to %d runs, an hour apart, with the same options:' %
+           (budget, quota, len(runs)))
+    for num, count in enumerate(runs):
+        print '  --limit %d %s "%s"%s' % (count, phase, args.query,
+                                          num and ' --resume' or '')
+    return False
+
+def plan(adaptor, args):
+    """ArgParse handler for plan command."""
+    if not _check_plan(adaptor, args, args.phase):
+        sys.exit(1)
+
+_local_cache = None
+
+def _get_disk_cache():
+    """Return the local disk cache, opened on first use."""
+    global _local_cache
+    if _local_cache is None:
+        max_age_days = getattr(settings, 'CACHE_MAX_AGE_DAYS', 30)
+        _local_cache = disk_cache.DiskCache(
+            getattr(settings, 'CACHE_PATH', 'tomato-cache'),
+            int(getattr(settings, 'CACHE_MAX_MB', 1024) * 1024 * 1024),
+            max_age_days and max_age_days * 24 * 3600)
+    return _local_cache
+
+def cache(unused_adaptor, args):
+    """ArgParse handler for cache command."""
+    local_cache = _get_disk_cache()
+    if 'prune' == args.action:
+        evicted = local_cache.prune(
+            args.max_mb and int(args.max_mb * 1024 * 1024),
+            args.max_age_days and args.max_age_days * 24 * 3600)
+        print 'Evicted %d values' % (evicted)
+    elif 'verify' == args.action:
+        problems = local_cache.verify(args.repair)
+        for problem in problems:
+            print problem
+        print '%d problems%s' % (len(problems),
+                                 problems and args.repair and ' repaired' or '')
+        if problems and not args.repair:
+            sys.exit(1)
+        return
+    stats = local_cache.stats()
+    for name in ('oldest_stored', 'last_accessed'):
+        if stats[name]:
+            stats[name] = datetime.fromtimestamp(stats[name]).strftime(
+                '%Y-%m-%d %H:%M:%S')
+    print 'Cache "%(path)s": %(values)d values in %(segments)d segments' % (
+        stats)
+    print '  %.1f MB (%.1f MB uncompressed) of %.1f MB' % (
+        stats['bytes'] / 1048576.0, stats['raw_bytes'] / 1048576.0,
+        stats['max_bytes'] / 1048576.0)
+    print ('  Oldest stored: %(oldest_stored)s, last accessed: '
+           '%(last_accessed)s' % (stats))
 
 def post_note(adaptor, args):
     """ArgParse handler for post-note command."""
     adaptor.post_to_wordpress_from_note(args.en_link)
+    if args.referrers:
+        adaptor.republish_referrers(
+            EvernoteApiWrapper.get_note_guid(args.en_link))
 
 post_parser = subparsers.add_parser('post-note',
                                     help='Create a WordPress post from '
@@ -850,6 +2013,9 @@ post_parser = subparsers.add_parser('post-note',
 post_parser.add_argument('en_link',
                          help='Evernote note to post '
                               '(full link, or just GUID)')
+post_parser.add_argument('--referrers', action='store_true',
+                         help='Also republish the posted notes referring '
+                              'to the note, by the backlink index')
 post_parser.set_defaults(func=post_note)
 
 sync_parser = subparsers.add_parser('sync',
@@ -862,17 +2028,62 @@ sync_parser.add_argument('--preprocess', action='store_true',
                          help='Perform preprocessing too')
 sync_parser.add_argument('--image_notebook',
                          help='Notebook for extracted embedded images')
-sync_parser.set_defaults(func=lambda adaptor, args:
-                         adaptor.sync(args.query, args.force, args.preprocess,
-                                      args.image_notebook))
+sync_parser.add_argument('--jobs', type=int, default=1,
+                         help='Number of processes for parsing notes')
+sync_parser.add_argument('--resume', action='store_true',
+                         help='Resume an interrupted sync of the query '
+                              'from the checkpoint')
+sync_parser.add_argument('--mirror', action='append', metavar='SITE',
+                         help='Also post to a mirror WordPress site from '
+                              'settings, keeping its IDs in a site ID map. '
+                              'May be repeated.')
+sync_parser.add_argument('--plan', action='store_true',
+                         help='Plan the sync first, and refuse to run it if '
+                              'it exceeds the Evernote calls budget')
+sync_parser.set_defaults(func=sync)
+
+watch_parser = subparsers.add_parser('watch',
+                                     help='Watch Evernote for changes, and '
+                                          'post changed notes')
+watch_parser.add_argument('query',
+                          help='Evernote query for notes to watch')
+watch_parser.add_argument('--preprocess', action='store_true',
+                          help='Perform preprocessing too')
+watch_parser.add_argument('--image_notebook',
+                          help='Notebook for extracted embedded images')
+watch_parser.add_argument('--jobs', type=int, default=1,
+                          help='Number of processes for parsing notes')
+watch_parser.add_argument('--min_interval', type=float, default=10.0,
+                          help='Seconds between polls after a change '
+                               '(default: %(default)s)')
+watch_parser.add_argument('--max_interval', type=float, default=300.0,
+                          help='Maximal seconds between polls with no '
+                               'changes (default: %(default)s)')
+watch_parser.set_defaults(func=lambda adaptor, args:
+                          adaptor.watch(args.query, args.preprocess,
+                                        args.image_notebook, args.jobs,
+                                        args.min_interval, args.max_interval))
 
 detach_parser = subparsers.add_parser('detach',
                                       help='Detach Evernote-WordPress '
                                            'synchronization')
 detach_parser.add_argument('query',
                            help='Evernote query for notes to detach')
+detach_parser.add_argument('--workers', type=int, default=4,
+                           help='Number of notes detached concurrently')
+detach_parser.add_argument('--force', action='store_true',
+                           help='Detach also notes that were not updated '
+                                'since they were detached')
+detach_parser.add_argument('--resume', action='store_true',
+                           help='Resume an interrupted detach of the query '
+                                'from the checkpoint')
 detach_parser.set_defaults(func=lambda adaptor, args:
-                           adaptor.detach(args.query))
+                           adaptor.detach(args.query, _get_checkpoint(args),
+                                          args.workers,
+                                          common.JsonFileMap(getattr(
+                                              settings, 'DETACHED_NOTES_PATH',
+                                              'tomato-detached.json')),
+                                          args.force))
 
 import_images_parser = subparsers.add_parser(
     'import-images',
@@ -885,10 +2096,23 @@ import_images_parser.add_argument('--set_id',
                                   help='Override ID value with this.')
 import_images_parser.add_argument('--set_parent',
                                   help='Override parent value with this.')
+import_images_parser.add_argument('--download_workers', type=int, default=4,
+                                  help='Number of concurrent image downloads.')
+import_images_parser.add_argument('--create_workers', type=int, default=1,
+                                  help='Number of concurrent image note '
+                                       'creations.')
+import_images_parser.add_argument('--max_mb', type=float, default=64,
+                                  help='Megabytes of downloaded images waiting '
+                                       'for notes to be created, over which '
+                                       'downloads wait (default: '
+                                       '%(default)s).')
 import_images_parser.set_defaults(func=lambda adaptor, args:
                                   adaptor.import_images_to_evernote(
                                       args.parent, args.notebook,
-                                      args.set_id, args.set_parent))
+                                      args.set_id, args.set_parent,
+                                      args.download_workers,
+                                      args.create_workers,
+                                      int(args.max_mb * 1024 * 1024)))
 
 preprocess_parser = subparsers.add_parser(
     'preprocess',
@@ -899,11 +2123,49 @@ preprocess_parser.add_argument('--image_notebook',
                                help='Notebook for extracted embedded images')
 preprocess_parser.add_argument('--dryrun', action='store_true',
                                help='Don\'t perform the actions')
-preprocess_parser.set_defaults(
-    func=lambda adaptor, args:
-    adaptor.preprocess(args.query,
-                       image_notebook=args.image_notebook,
-                       dryrun=args.dryrun))
+preprocess_parser.add_argument('--resume', action='store_true',
+                               help='Resume an interrupted preprocess of the '
+                                    'query from the checkpoint')
+preprocess_parser.add_argument('--plan', action='store_true',
+                               help='Plan the preprocess first, and refuse to '
+                                    'run it if it exceeds the Evernote calls '
+                                    'budget')
+preprocess_parser.set_defaults(func=preprocess)
+
+plan_parser = subparsers.add_parser(
+    'plan',
+    help='Estimate the API calls, bytes and time of a sync or preprocess, '
+         'without running it')
+plan_parser.add_argument('phase', choices=('sync', 'preprocess'),
+                         help='Command to plan')
+plan_parser.add_argument('query',
+                         help='Evernote query for notes of the command')
+plan_parser.add_argument('--preprocess', action='store_true',
+                         help='Plan a sync with preprocessing too')
+plan_parser.add_argument('--resume', action='store_true',
+                         help='Plan resuming an interrupted run from the '
+                              'checkpoint')
+plan_parser.add_argument('--latencies', metavar='METRICS_JSON',
+                         help='Estimate time with the API call latencies '
+                              'of a previous run (see --metrics_json)')
+plan_parser.set_defaults(func=plan)
+
+cache_parser = subparsers.add_parser(
+    'cache',
+    help='Show statistics of the local caches, evict values from them, or '
+         'verify them')
+cache_parser.add_argument('action', choices=('stats', 'prune', 'verify'),
+                          help='Cache command')
+cache_parser.add_argument('--max_mb', type=float,
+                          help='Megabytes to prune the cache to (default: '
+                               'the cache size in settings)')
+cache_parser.add_argument('--max_age_days', type=float,
+                          help='Prune values stored more days ago (default: '
+                               'the maximal age in settings)')
+cache_parser.add_argument('--repair', action='store_true',
+                          help='Remove the corrupt values and orphan files '
+                               'found by verify')
+cache_parser.set_defaults(func=cache)
 
 ###############################################################################
 
@@ -913,8 +2175,27 @@ def _custom_fields(adaptor, unused_args):
 
 def main():
     args = wp_en_parser.parse_args()
-    adaptor = _get_adaptor(args)
-    args.func(adaptor, args)
+    if getattr(settings, 'LOG_JSON', False):
+        common.set_json_log_records()
+    exporter = None
+    if args.metrics_prom or args.metrics_json:
+        exporter = metrics.MetricsExporter(args.metrics_prom,
+                                           args.metrics_json,
+                                           args.metrics_interval).start()
+    def run_command():
+        adaptor = _get_adaptor(args)
+        args.func(adaptor, args)
+    try:
+        if args.profile:
+            profiling.run(run_command, args.profile, args.profile_output,
+                          args.profile_top)
+        else:
+            run_command()
+    finally:
+        if exporter:
+            exporter.stop()
+        if _local_cache is not None:
+            _local_cache.save()
 
 if '__main__' == __name__:
     main()
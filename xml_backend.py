@@ -0,0 +1,249 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""XML parsing backends for Evernote note content.
+
+All backends return ElementTree API trees, with XHTML entities resolved
+and non-breaking spaces replaced by plain spaces, so the rest of the
+program doesn't care which backend parsed a note.
+
+The lxml backend is used when lxml is installed, unless overridden by
+`settings.XML_BACKEND`. The stdlib backend is always available.
+"""
+
+import re
+from htmlentitydefs import name2codepoint
+from xml.etree import ElementTree as ET
+from xml.etree import cElementTree as cET
+
+import settings
+import common
+
+logger = common.logger.getChild('xml-backend')
+
+# XHTML entities, excluding the ones predefined by XML
+XHTML_ENTITIES = dict((name, unichr(codepoint))
+                      for name, codepoint in name2codepoint.iteritems()
+                      if name not in ('quot', 'amp', 'apos', 'lt', 'gt'))
+
+class _EndOfPrefix(Exception):
+    """Raised by a prefix tree builder to stop parsing."""
+
+class _PrefixTreeBuilder(object):
+    """Parser target that builds a tree up to the first `stop_tag` element.
+    
+    Elements that are still open when `stop_tag` starts are kept with the
+    content parsed so far.
+    """
+
+    def __init__(self, stop_tag, element_factory):
+        self._stop_tag = stop_tag
+        self._factory = element_factory
+        self._stack = list()
+        self._data = list()
+        self._last = None
+        self._tail = False
+        self._stopped = False
+        self.root = None
+
+    def _flush(self):
+        if self._data:
+            text = ''.join(self._data)
+            if self._tail:
+                self._last.tail = text
+            else:
+                self._last.text = text
+            self._data = list()
+
+    def start(self, tag, attrib):
+        if self._stopped:
+            return
+        if tag == self._stop_tag:
+            self._stopped = True
+            raise _EndOfPrefix()
+        self._flush()
+        elem = self._factory(tag, dict(attrib))
+        if self._stack:
+            self._stack[-1].append(elem)
+        else:
+            self.root = elem
+        self._stack.append(elem)
+        self._last = elem
+        self._tail = False
+
+    def end(self, tag):
+        if self._stopped:
+            return
+        self._flush()
+        self._last = self._stack.pop()
+        self._tail = True
+
+    def data(self, data):
+        if not self._stopped:
+            self._data.append(data)
+
+    def close(self):
+        self._flush()
+        return self.root
+
+class XmlBackend(object):
+    """XML parsing backend base class.
+    
+    Subclasses implement `_prepare()` and `_make_parser()`.
+    """
+
+    name = None
+    element_factory = None
+    # Size of chunks fed to the parser when parsing a document prefix
+    prefix_chunk_size = 4096
+
+    def _prepare(self, xml_string):
+        """Return `xml_string` ready to be fed to the parser."""
+        raise NotImplementedError()
+
+    def _make_parser(self, target=None):
+        """Return a new parser, building the tree with `target`."""
+        raise NotImplementedError()
+
+    def fromstring(self, xml_string):
+        """Return the root Element parsed from `xml_string`.
+
+        :param xml_string: UTF-8 encoded string, or unicode string.
+        """
+        parser = self._make_parser()
+        parser.feed(self._prepare(xml_string))
+        return parser.close()
+
+    def parse_until(self, xml_string, stop_tag):
+        """Return the root Element parsed from `xml_string`, up to the first
+        `stop_tag` element, without parsing the rest of the document.
+
+        :param xml_string: UTF-8 encoded string, or unicode string.
+        """
+        target = _PrefixTreeBuilder(stop_tag, self.element_factory)
+        parser = self._make_parser(target)
+        xml_string = self._prepare(xml_string)
+        try:
+            for pos in xrange(0, len(xml_string), self.prefix_chunk_size):
+                parser.feed(xml_string[pos:pos + self.prefix_chunk_size])
+            parser.close()
+        except _EndOfPrefix:
+            pass
+        return target.close()
+
+class StdlibXmlBackend(XmlBackend):
+    """XML parsing backend using the standard library expat parser."""
+
+    name = 'stdlib'
+    element_factory = ET.Element
+
+    def _prepare(self, xml_string):
+        if isinstance(xml_string, str):
+            xml_string = xml_string.decode('utf-8')
+        return xml_string.replace(u'\xa0', u' ').encode('utf-8')
+
+    def _make_parser(self, target=None):
+        parser = ET.XMLParser(target=target)
+        # Default XMLParser is not full XHTML, so it doesn't know about all
+        # valid XHTML entities (such as &nbsp;), so the following code is
+        # needed in order to allow these entities.
+        # (see: http://stackoverflow.com/questions/7237466 and
+        #       http://stackoverflow.com/questions/14744945 )
+        # Valid XML entities: quot, amp, apos, lt and gt.
+        parser.parser.UseForeignDTD(True)
+        parser.entity.update(XHTML_ENTITIES)
+        parser.entity['nbsp'] = ' '
+        return parser
+
+class _TreeBuilderTarget(object):
+    """lxml parser target that builds a tree with the C ElementTree builder.
+    
+    Only `start` goes through Python, to copy the attributes lxml passes
+    to a real dictionary.
+    """
+
+    def __init__(self):
+        self._builder = cET.TreeBuilder()
+        self.end = self._builder.end
+        self.data = self._builder.data
+        self.close = self._builder.close
+
+    def start(self, tag, attrib):
+        return self._builder.start(tag, dict(attrib))
+
+class LxmlXmlBackend(XmlBackend):
+    """XML parsing backend using the libxml2 parser, through lxml.
+
+    Parses UTF-8 strings as is, and resolves XHTML entities natively,
+    by declaring the entities used by the document in an internal DTD
+    subset in place of the (remote) ENML DTD.
+    The tree is built by the C ElementTree builder.
+
+    :raise ImportError: If lxml is not installed.
+    """
+
+    name = 'lxml'
+    element_factory = cET.Element
+
+    _doctype_re = re.compile(r'<!DOCTYPE[^>\[]*>')
+    _xml_decl_re = re.compile(r'^\s*<\?xml[^>]*\?>')
+    _entity_ref_re = re.compile(r'&([a-zA-Z][a-zA-Z0-9]*);')
+
+    def __init__(self):
+        from lxml import etree
+        self._etree = etree
+        self._entity_decls = dict(
+            (name, '<!ENTITY %s "&#%d;">' % (name, ord(char)))
+            for name, char in XHTML_ENTITIES.iteritems())
+        # Non-breaking spaces are normalized to plain spaces
+        self._entity_decls['nbsp'] = '<!ENTITY nbsp "&#32;">'
+
+    def _declare_entities(self, xml_string):
+        """Return `xml_string` with an internal DTD subset declaring the
+        XHTML entities it uses."""
+        decls = ''.join(self._entity_decls[name] for name
+                        in set(self._entity_ref_re.findall(xml_string))
+                        if name in self._entity_decls)
+        if not decls:
+            return xml_string
+        doctype = '<!DOCTYPE en-note [%s]>' % (decls)
+        xml_string, count = self._doctype_re.subn(doctype, xml_string, 1)
+        if 0 == count:
+            xml_decl = self._xml_decl_re.match(xml_string)
+            pos = xml_decl and xml_decl.end() or 0
+            xml_string = xml_string[:pos] + doctype + xml_string[pos:]
+        return xml_string
+
+    def _prepare(self, xml_string):
+        if isinstance(xml_string, unicode):
+            xml_string = xml_string.encode('utf-8')
+        return self._declare_entities(xml_string.replace('\xc2\xa0', ' '))
+
+    def _make_parser(self, target=None):
+        # lxml parsers are not thread safe - use a new one for every parse
+        return self._etree.XMLParser(target=target or _TreeBuilderTarget(),
+                                     no_network=True)
+
+_backends = dict()
+
+def get_backend(name=None):
+    """Return an XML backend instance.
+
+    :param name: Backend name ('lxml' or 'stdlib'). If not specified,
+                 use `settings.XML_BACKEND`, or the best available backend.
+    :raise ImportError: If the requested backend is not available.
+    """
+    name = name or getattr(settings, 'XML_BACKEND', None)
+    if name not in _backends:
+        if name in ('stdlib',):
+            _backends[name] = StdlibXmlBackend()
+        elif name in ('lxml',):
+            _backends[name] = LxmlXmlBackend()
+        elif name is None:
+            try:
+                _backends[name] = LxmlXmlBackend()
+            except ImportError:
+                logger.debug('lxml not available, using stdlib XML parser')
+                _backends[name] = StdlibXmlBackend()
+        else:
+            raise ValueError('Invalid XML backend "%s"' % (name))
+    return _backends[name]